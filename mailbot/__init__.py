@@ -8,19 +8,28 @@ __version__ = distribution.version
 
 from .callback import Callback  # noqa
 from .exceptions import RegisterException  # noqa
+from .keywords import Keywords  # noqa
 from .mailbot import MailBot  # noqa
+from .rules import RulesIndex  # noqa
 
 
 CALLBACKS_MAP = {}
+RULES_INDEX = RulesIndex()
 
 
 def register(callback_class, rules=None):
-    """Register a callback class, optionnally with rules."""
+    """Register a callback class, optionnally with rules.
+
+    The regexps of the rules are compiled once and for all in the
+    ``RULES_INDEX``.
+
+    """
     if callback_class in CALLBACKS_MAP:
         raise RegisterException('%s is already registered' % callback_class)
 
     apply_rules = getattr(callback_class, 'rules', {})
     if rules:
         apply_rules.update(rules)
+    RULES_INDEX.add(callback_class, apply_rules)
     CALLBACKS_MAP[callback_class] = apply_rules
     return apply_rules
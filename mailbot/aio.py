@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""asyncio flavour of MailBot, with callbacks that may be coroutines.
+
+This module needs python 3.5+, and isn't imported by the ``mailbot`` package.
+
+"""
+
+import asyncio
+import inspect
+import re
+from datetime import datetime, timedelta, timezone
+
+from .exceptions import IMAPError
+from .message import ParsedMessage
+
+
+LITERAL = re.compile(br'\{(\d+)\}\r\n$')
+TOKEN = re.compile(br'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+class Literal(bytes):
+    """A literal string ({size}\\r\\n<bytes>) in a server response."""
+
+
+def quote(value):
+    """Return the value as an IMAP quoted string."""
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def parse_response(chunks):
+    """Parse a response (lines and literals) in a list of tokens.
+
+    Parenthesized lists are returned as lists, everything else as bytes.
+
+    """
+    stack = [[]]
+    for chunk in chunks:
+        if isinstance(chunk, Literal):
+            stack[-1].append(bytes(chunk))
+            continue
+        position = 0
+        while True:
+            match = TOKEN.match(chunk, position)
+            if match is None:
+                break
+            position = match.end()
+            opening, closing, quoted, atom = match.groups()
+            if opening:
+                stack.append([])
+            elif closing:
+                tokens = stack.pop()
+                stack[-1].append(tokens)
+            elif quoted is not None:
+                stack[-1].append(re.sub(br'\\(.)', br'\1', quoted))
+            else:
+                stack[-1].append(atom)
+    return stack[0]
+
+
+def parse_internaldate(value):
+    """Return the INTERNALDATE as a naive UTC datetime."""
+    date = datetime.strptime(value.decode('ascii').strip(),
+                             '%d-%b-%Y %H:%M:%S %z')
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def sequence_set(uids):
+    return ','.join(str(uid) for uid in uids).encode('ascii')
+
+
+class AsyncIMAPClient(object):
+    """Minimal asyncio IMAP4rev1 client, with an IMAPClient like API.
+
+    Commands are sent one at a time, and always use UIDs.
+
+    """
+
+    def __init__(self, host, port=None, ssl=False):
+        self.host = host
+        self.port = port or (993 if ssl else 143)
+        self.ssl = ssl
+        self.reader = self.writer = None
+        self.tag = 0
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl or None)
+        await self.read_response()  # greeting
+
+    async def read_response(self):
+        """Read a response line, with its literals, if any."""
+        chunks = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('Connection closed by the server')
+            match = LITERAL.search(line)
+            if match is None:
+                chunks.append(line.rstrip(b'\r\n'))
+                return chunks
+            chunks.append(line[:match.start()])
+            size = int(match.group(1))
+            chunks.append(Literal(await self.reader.readexactly(size)))
+
+    async def command(self, name, *args):
+        """Send the command, return the parsed untagged responses."""
+        async with self.lock:
+            self.tag += 1
+            tag = ('M%04d' % self.tag).encode('ascii')
+            self.writer.write(b' '.join((tag, name.encode('ascii')) + args) +
+                              b'\r\n')
+            await self.writer.drain()
+            untagged = []
+            while True:
+                chunks = await self.read_response()
+                if chunks[0].startswith(tag + b' '):
+                    break
+                if chunks[0].startswith(b'* '):
+                    untagged.append(parse_response(chunks)[1:])
+        status = chunks[0].split(b' ', 2)[1:]
+        if status[0].upper() != b'OK':
+            raise IMAPError(b' '.join(status).decode('utf-8', 'replace'))
+        return untagged
+
+    async def login(self, username, password):
+        await self.command('LOGIN', quote(username), quote(password))
+
+    async def logout(self):
+        try:
+            await self.command('LOGOUT')
+        finally:
+            self.writer.close()
+
+    async def noop(self):
+        return await self.command('NOOP')
+
+    async def select_folder(self, folder):
+        result = {}
+        for response in await self.command('SELECT', quote(folder)):
+            if len(response) == 2 and response[0].isdigit():  # n EXISTS
+                result[response[1].decode('ascii').upper()] = int(response[0])
+            elif (len(response) > 2 and response[0] == b'OK' and
+                  response[1].startswith(b'[') and
+                  isinstance(response[2], bytes)):
+                key, value = response[1][1:], response[2].rstrip(b']')
+                if value.isdigit():  # UIDVALIDITY, UIDNEXT...
+                    result[key.decode('ascii').upper()] = int(value)
+        return result
+
+    async def search(self, criteria):
+        criteria = [criterion.encode('ascii') for criterion in criteria]
+        uids = []
+        for response in await self.command('UID', b'SEARCH', *criteria):
+            if response[0].upper() == b'SEARCH':
+                uids.extend(int(uid) for uid in response[1:])
+        return uids
+
+    async def fetch(self, uids, items):
+        """Return a dict of {uid: {item: value}}, like IMAPClient."""
+        if not uids:
+            return {}
+        items = ' '.join(items).encode('ascii')
+        result = {}
+        for response in await self.command('UID', b'FETCH', sequence_set(uids),
+                                           b'(' + items + b')'):
+            if len(response) < 3 or response[1].upper() != b'FETCH':
+                continue
+            data = {'SEQ': int(response[0])}
+            pairs = response[2]
+            for key, value in zip(pairs[::2], pairs[1::2]):
+                key = key.decode('ascii').upper()
+                if key in ('UID', 'RFC822.SIZE'):
+                    value = int(value)
+                elif key == 'FLAGS':
+                    value = tuple(flag.decode('utf-8') for flag in value)
+                elif key == 'INTERNALDATE':
+                    value = parse_internaldate(value)
+                data[key] = value
+            if 'UID' not in data:  # unsolicited, eg flags changed elsewhere
+                continue
+            result[data.pop('UID')] = data
+        return result
+
+    async def store(self, uids, action, flags):
+        if uids:
+            flags = ' '.join(flags).encode('utf-8')
+            await self.command('UID', b'STORE', sequence_set(uids), action,
+                               b'(' + flags + b')')
+
+    async def add_flags(self, uids, flags):
+        await self.store(uids, b'+FLAGS.SILENT', flags)
+
+    async def remove_flags(self, uids, flags):
+        await self.store(uids, b'-FLAGS.SILENT', flags)
+
+
+class AsyncMailBot(object):
+    """MailBot for asyncio: all the IMAP related methods are coroutines.
+
+    Use ``await mailbot.connect()`` (or ``async with mailbot:``) before
+    processing the messages. The ``trigger`` method of the callbacks may
+    return an awaitable (eg, be a coroutine), which is awaited: the callbacks
+    of up to ``concurrency`` messages run concurrently.
+
+    """
+    home_folder = 'INBOX'
+    imapclient = AsyncIMAPClient
+    concurrency = 10
+
+    def __init__(self, host, username, password, port=None, ssl=False,
+                 timeout=None, concurrency=None):
+        """Create the MailBot, see ``MailBot.__init__``."""
+        self.host = host
+        self.username = username
+        self.password = password
+        self.imap_options = {'port': port, 'ssl': ssl}
+        self.timeout = timeout
+        if concurrency is not None:
+            self.concurrency = concurrency
+        self.client = None
+
+    async def connect(self):
+        """Connect and login to the server, then select the home folder."""
+        self.client = self.imapclient(self.host, **self.imap_options)
+        await self.client.connect()
+        await self.client.login(self.username, self.password)
+        await self.client.select_folder(self.home_folder)
+
+    async def logout(self):
+        await self.client.logout()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.logout()
+
+    async def get_message_ids(self):
+        """Return the list of IDs of messages to process."""
+        return await self.client.search(['Unseen', 'Unflagged'])
+
+    async def get_messages(self):
+        """Return the list of messages to process."""
+        ids = await self.get_message_ids()
+        return await self.client.fetch(ids, ['RFC822'])
+
+    async def process_message(self, message, callback_class, rules):
+        """Check if callback matches rules, and if so, trigger."""
+        callback = callback_class(message, rules)
+        if callback.check_rules():
+            result = callback.trigger()
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+
+    async def process_callbacks(self, msg):
+        """Check the fetched message against each registered callback.
+
+        The matching callbacks are triggered concurrently.
+
+        """
+        from . import CALLBACKS_MAP, RULES_INDEX
+        message = ParsedMessage(msg['RFC822'])
+        await asyncio.gather(*[
+            self.process_message(message, callback_class, rules)
+            for callback_class, rules in RULES_INDEX.candidates(CALLBACKS_MAP,
+                                                                message)])
+
+    async def process_messages(self):
+        """Process messages: check which callbacks should be triggered."""
+        await self.reset_timeout_messages()
+        messages = await self.get_messages()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def process(uid, msg):
+            async with semaphore:
+                await self.mark_processing(uid)
+                await self.process_callbacks(msg)
+                await self.mark_processed(uid)
+
+        await asyncio.gather(*[process(uid, msg)
+                               for uid, msg in sorted(messages.items())])
+
+    async def reset_timeout_messages(self):
+        """Remove the \\Flagged and \\Seen flags from mails that are too old.
+
+        See ``MailBot.reset_timeout_messages``.
+
+        """
+        if self.timeout is None:
+            return
+
+        ids = await self.client.search(['Flagged', 'Seen'])
+        messages = await self.client.fetch(ids, ['INTERNALDATE'])
+
+        date_pivot = datetime.utcnow() - timedelta(seconds=self.timeout)
+        to_reset = [msg_id for msg_id, data in messages.items()
+                    if data['INTERNALDATE'] < date_pivot]
+
+        if to_reset:
+            await self.client.remove_flags(to_reset, ['\\Flagged', '\\Seen'])
+
+    async def mark_processing(self, uid):
+        """Mark the message corresponding to uid as being processed."""
+        await self.client.add_flags([uid], ['\\Flagged', '\\Seen'])
+
+    async def mark_processed(self, uid):
+        """Mark the message corresponding to uid as processed."""
+        await self.client.remove_flags([uid], ['\\Flagged'])
+        await self.client.add_flags([uid], ['\\Seen'])
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Attachments of the mails, listed and downloaded on demand.
+
+The attachments of a mail are listed from its BODYSTRUCTURE, fetched from the
+server, without downloading them. Each attachment may then be downloaded on
+its own, by chunks of its section (``BODY.PEEK[section]<offset.length>``), and
+decoded on the fly: a callback only needing a small attachment of a 30 MB
+mail only downloads this attachment.
+
+If the whole mail was downloaded already, the attachments are listed and
+extracted from the mail itself instead.
+
+"""
+
+from __future__ import absolute_import
+
+import binascii
+import re
+from collections import namedtuple
+from email.utils import collapse_rfc2231_value, decode_params, unquote
+
+from .compat import string_types, text_type
+from .message import decode_header_value, ParsedMessage
+
+
+CHUNK_SIZE = 64 * 1024
+NOT_BASE64 = re.compile(br'[^A-Za-z0-9+/=]')
+
+Attachment = namedtuple('Attachment',
+                        'section filename content_type size encoding')
+Attachment.__doc__ = """An attachment of a mail.
+
+The section is the IMAP section of its part (eg '2' or '1.3'), and the size
+is the size of its encoded content, in bytes.
+
+"""
+
+
+def to_text(value):
+    """Return the text of a BODYSTRUCTURE value (bytes with IMAPClient)."""
+    if value is None or isinstance(value, text_type):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return text_type(value)
+
+
+def get_param(params, name):
+    """Return the decoded value of the parameter (RFC 2231), or None."""
+    if not params:
+        return None
+    pairs = [(to_text(params[index]).lower(), to_text(params[index + 1]))
+             for index in range(0, len(params) - 1, 2)]
+    for key, value in decode_params([('', '')] + pairs)[1:]:
+        if key == name:
+            return decode_header_value(unquote(collapse_rfc2231_value(value)))
+    return None
+
+
+def is_multipart(structure):
+    return isinstance(structure[0], (list, tuple))
+
+
+def parse_bodystructure(structure, section=''):
+    """Return the list of the attachments of the BODYSTRUCTURE.
+
+    The parts with a filename, or an "attachment" disposition, are
+    attachments. The mails attached (message/rfc822 parts) are attachments
+    too: their own parts aren't listed.
+
+    """
+    if is_multipart(structure):
+        if isinstance(structure[0], list):  # IMAPClient's BodyData
+            parts = structure[0]
+        else:
+            parts = [part for part in structure
+                     if isinstance(part, (list, tuple))]
+        attachments = []
+        for index, part in enumerate(parts, 1):
+            attachments.extend(parse_bodystructure(
+                part, '%s.%d' % (section, index) if section else str(index)))
+        return attachments
+
+    maintype = to_text(structure[0]).lower()
+    subtype = to_text(structure[1]).lower()
+    if maintype == 'text':  # the number of lines comes first
+        extension = 8
+    elif (maintype, subtype) == ('message', 'rfc822'):  # envelope...
+        extension = 10
+    else:
+        extension = 7
+    disposition = None
+    if len(structure) > extension + 1 and structure[extension + 1]:
+        disposition = structure[extension + 1]
+    filename = None
+    if disposition is not None:
+        filename = get_param(disposition[1], 'filename')
+    if filename is None:
+        filename = get_param(structure[2], 'name')
+    attached = (disposition is not None and
+                to_text(disposition[0]).lower() == 'attachment')
+    if filename is None and not attached and maintype != 'message':
+        return []
+    return [Attachment(section or '1', filename,
+                       '%s/%s' % (maintype, subtype), int(structure[6]),
+                       (to_text(structure[5]) or '7bit').lower())]
+
+
+def iter_message_parts(message, section=''):
+    """Yield the (section, part) of the leaf parts of the ``email.Message``.
+
+    The mails attached (message/rfc822 parts) are leaves.
+
+    """
+    if (message.is_multipart() and
+            message.get_content_maintype() != 'message'):
+        for index, part in enumerate(message.get_payload(), 1):
+            for found in iter_message_parts(
+                    part, '%s.%d' % (section, index) if section
+                    else str(index)):
+                yield found
+    else:
+        yield section or '1', message
+
+
+def get_message_attachments(message):
+    """Return the list of the attachments of the ``email.Message``."""
+    attachments = []
+    for section, part in iter_message_parts(message):
+        filename = part.get_filename()
+        disposition = part.get('Content-Disposition', '').split(';')[0]
+        attached = disposition.strip().lower() == 'attachment'
+        maintype = part.get_content_maintype()
+        if filename is None and not attached and maintype != 'message':
+            continue
+        if filename is not None:
+            filename = decode_header_value(filename)
+        payload = part.get_payload()
+        size = len(payload) if isinstance(payload, string_types + (bytes,)) \
+            else len(payload[0].as_string())
+        attachments.append(Attachment(
+            section, filename, part.get_content_type(), size,
+            (part.get('Content-Transfer-Encoding') or '7bit').lower()))
+    return attachments
+
+
+def get_email_message(message):
+    """Return the ``email.Message`` of a ParsedMessage, or the message."""
+    if isinstance(message, ParsedMessage):
+        return message.message
+    return message
+
+
+def get_attachments(message):
+    """Return the list of the attachments of the message.
+
+    If only the headers of a ParsedMessage were downloaded, its
+    BODYSTRUCTURE is fetched (once) using its ``fetcher``.
+
+    """
+    if not getattr(message, 'headers_only', False):
+        return get_message_attachments(get_email_message(message))
+    if message.bodystructure is None:
+        message.bodystructure = get_fetcher(message).fetch_bodystructure()
+    return parse_bodystructure(message.bodystructure)
+
+
+def get_fetcher(message):
+    fetcher = getattr(message, 'fetcher', None)
+    if fetcher is None:
+        raise ValueError("Only the headers of the mail were downloaded, "
+                         "and its parts can't be fetched from here")
+    return fetcher
+
+
+def iter_attachment(message, attachment, chunk_size=CHUNK_SIZE):
+    """Yield the decoded content of the attachment, by chunks.
+
+    If only the headers of a ParsedMessage were downloaded, the attachment
+    is fetched by chunks of ``chunk_size`` bytes using its ``fetcher``.
+
+    """
+    if getattr(message, 'headers_only', False):
+        chunks = get_fetcher(message).iter_section(attachment.section,
+                                                   chunk_size)
+        for data in decode_chunks(chunks, attachment.encoding):
+            yield data
+        return
+    for section, part in iter_message_parts(get_email_message(message)):
+        if section == attachment.section:
+            if part.get_content_maintype() == 'message':
+                attached = part.get_payload()[0]
+                data = getattr(attached, 'as_bytes', attached.as_string)()
+            else:
+                data = part.get_payload(decode=True) or b''
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+            return
+    raise ValueError('No part %s in the mail' % attachment.section)
+
+
+def save_attachment(message, attachment, target, chunk_size=CHUNK_SIZE):
+    """Write the decoded attachment to the target, return its size.
+
+    The target is a path, or a binary file-like object.
+
+    """
+    if isinstance(target, string_types):
+        with open(target, 'wb') as target_file:
+            return save_attachment(message, attachment, target_file,
+                                   chunk_size)
+    size = 0
+    for data in iter_attachment(message, attachment, chunk_size):
+        target.write(data)
+        size += len(data)
+    return size
+
+
+def decode_chunks(chunks, encoding):
+    """Yield the chunks decoded from their Content-Transfer-Encoding.
+
+    A chunk may end anywhere: the end of a base64 quantum, or of a quoted
+    printable line, is kept for the next chunk.
+
+    """
+    if encoding == 'base64':
+        rest = b''
+        for chunk in chunks:
+            data = rest + NOT_BASE64.sub(b'', chunk)
+            end = len(data) - len(data) % 4
+            rest = data[end:]
+            if end:
+                yield binascii.a2b_base64(data[:end])
+        if rest:  # badly padded
+            yield binascii.a2b_base64(rest + b'=' * (-len(rest) % 4))
+    elif encoding == 'quoted-printable':
+        rest = b''
+        for chunk in chunks:
+            data = rest + chunk
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end:
+                yield binascii.a2b_qp(data[:end])
+        if rest:
+            yield binascii.a2b_qp(rest)
+    else:  # 7bit, 8bit, binary
+        for chunk in chunks:
+            yield chunk
+
+
+class PartFetcher(object):
+    """Fetch the BODYSTRUCTURE and the parts of a mail from the server."""
+
+    def __init__(self, client, uid):
+        self.client = client
+        self.uid = uid
+
+    def get_item(self, items, prefix):
+        """Fetch the items, return the value of the one with this prefix."""
+        response = self.client.fetch([self.uid], items).get(self.uid, {})
+        for key, value in response.items():
+            if to_text(key).upper().startswith(prefix):
+                return value
+        return None
+
+    def fetch_bodystructure(self):
+        return self.get_item(['BODYSTRUCTURE'], 'BODYSTRUCTURE')
+
+    def iter_section(self, section, chunk_size=CHUNK_SIZE):
+        """Yield the raw content of the section, by chunks."""
+        offset = 0
+        while True:
+            data = self.get_item(
+                ['BODY.PEEK[%s]<%d.%d>' % (section, offset, chunk_size)],
+                'BODY[%s]' % section) or b''
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8', 'surrogateescape')
+            if data:
+                yield data
+            if len(data) < chunk_size:
+                return
+            offset += len(data)
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the mail processing pipeline: fetch, parse, rules, trigger.
+
+The mails of synthetic corpora (see ``mailbot.benchmarks.corpus``) are
+delivered to the fake IMAP server (see ``mailbot.fakeimap``), and processed
+by a MailBot with a number of registered callbacks. Run them with::
+
+    python -m mailbot.benchmarks --save baseline.json
+    python -m mailbot.benchmarks --compare baseline.json
+
+This needs the test dependencies, and python 3.4+ for the peak memory.
+
+"""
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Command line interface of the benchmarks."""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import platform
+import sys
+
+from .corpus import CORPORA
+from .runner import (compare, format_comparison, format_results, get_name,
+                     run_scenario)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m mailbot.benchmarks',
+        description='Benchmark the mail processing pipeline of MailBot.')
+    parser.add_argument('--corpus', nargs='+', choices=sorted(CORPORA),
+                        default=['tiny', 'encoded', 'attachment', 'large'])
+    parser.add_argument('--callbacks', nargs='+', type=int,
+                        default=[10, 100, 1000],
+                        help='numbers of registered callbacks')
+    parser.add_argument('--messages', type=int, default=100,
+                        help='number of mails per run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs per scenario')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help="don't measure the peak memory")
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--fetch-size', type=int)
+    parser.add_argument('--header-first', action='store_true')
+    parser.add_argument('--save', metavar='PATH',
+                        help='save the results to this JSON file')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='compare the results to this saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change reported as a regression')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    options = {'batch_size': args.batch_size, 'fetch_size': args.fetch_size,
+               'header_first': args.header_first}
+    results = {}
+    for corpus in args.corpus:
+        for callbacks in args.callbacks:
+            result = run_scenario(corpus, callbacks, messages=args.messages,
+                                  repeat=args.repeat, memory=args.memory,
+                                  **options)
+            results[get_name(result)] = result
+    print(format_results(results))
+
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump({'python': platform.python_version(),
+                       'results': results}, results_file, indent=2,
+                      sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        rows = compare(results, baseline, args.threshold)
+        print()
+        print(format_comparison(rows))
+        if any(row[-1] for row in rows):  # regressions
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Synthetic corpora of mails, and callbacks to match them.
+
+Each corpus is a function returning the raw mail (bytes, like IMAPClient
+returns them on python 3) of the given index. The corpora are deterministic:
+the same index always gives the same mail.
+
+"""
+
+from __future__ import absolute_import
+
+from os.path import dirname, join
+
+from .. import Callback
+
+try:
+    from base64 import encodebytes
+except ImportError:  # python 2
+    from base64 import encodestring as encodebytes
+
+
+MAILS_DIR = join(dirname(dirname(__file__)), 'tests', 'mails')
+
+
+def read_mail(name):
+    with open(join(MAILS_DIR, name), 'rb') as mail_file:
+        return mail_file.read()
+
+
+def tiny(index):
+    """A short plain text mail, with a subject matched by some callbacks."""
+    return ('From: Sender %d <sender%d@example.com>\r\n'
+            'To: bot@example.com\r\n'
+            'Subject: Report %d\r\n'
+            '\r\n'
+            'Order #%d was shipped.\r\n' % (index, index, index, index)
+            ).encode('ascii')
+
+
+def encoded(index):
+    """The mail with encoded headers and an 8bit body of the tests."""
+    return read_mail('mail_encoded_headers.txt')
+
+
+def attachment(index):
+    """The mail with a small attachment of the tests."""
+    return read_mail('mail_with_attachment.txt')
+
+
+def large(index, size=1024 * 1024):
+    """A text body followed by a base64 attachment of ``size`` bytes."""
+    data = bytes(bytearray(range(256))) * (size // 256 + 1)
+    data = encodebytes(data[:size])
+    return (('From: sender%d@example.com\r\n'
+             'To: bot@example.com\r\n'
+             'Subject: Report %d\r\n'
+             'Content-Type: multipart/mixed; boundary=boundary\r\n'
+             '\r\n'
+             '--boundary\r\n'
+             'Content-Type: text/plain; charset=utf-8\r\n'
+             '\r\n'
+             'Order #%d was shipped, see the attached data.\r\n'
+             '--boundary\r\n'
+             'Content-Type: application/octet-stream\r\n'
+             'Content-Disposition: attachment; filename=data.bin\r\n'
+             'Content-Transfer-Encoding: base64\r\n'
+             '\r\n' % (index, index, index)).encode('ascii') +
+            data.replace(b'\n', b'\r\n') + b'--boundary--\r\n')
+
+
+CORPORA = {'tiny': tiny, 'encoded': encoded, 'attachment': attachment,
+           'large': large}
+
+
+class BenchmarkCallback(Callback):
+    """Count the triggers, the ``stats`` are set by the runner.
+
+    The rules and the triggers are timed by MailBot (see
+    ``runner.StatsMetrics``): overriding ``check_rules`` would disable the
+    prefilter of the rules index, which real callbacks go through.
+
+    """
+    stats = None
+
+    def trigger(self):
+        self.stats.count('triggered')
+
+
+def make_callbacks(count):
+    """Return a dict of {callback_class: rules} of ``count`` callbacks.
+
+    Each callback matches the 'Report <n>' subject of the tiny and large mails
+    of index n, every other callback also has a rule on the body.
+
+    """
+    callbacks = {}
+    for index in range(count):
+        rules = {'subject': [r'Report %d\b' % index],
+                 'from': [r'sender%d@' % index]}
+        if index % 2:
+            rules['body'] = [r'Order #(\d+)']
+        callback_class = type('Callback%d' % index, (BenchmarkCallback,), {})
+        callbacks[callback_class] = rules
+    return callbacks
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""Run the benchmark scenarios, and compare their results to a baseline."""
+
+from __future__ import absolute_import, division
+
+import gc
+import math
+from collections import defaultdict
+from contextlib import contextmanager
+
+from ..mailbot import MailBot
+from ..metrics import NULL_TIMER, NullMetrics, Timer
+from ..fakeimap import FakeIMAPClient, FakeIMAPServer
+from .corpus import BenchmarkCallback, CORPORA, make_callbacks
+
+try:
+    from time import perf_counter as clock
+except ImportError:  # python 2
+    from time import time as clock
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+
+# metric: True if higher is better
+METRICS = {'messages_per_second': True,
+           'round_trips_per_message': False,
+           'peak_memory': False}
+
+
+def percentile(values, percent):
+    """Return the percentile of the sorted values (nearest rank)."""
+    index = int(math.ceil(percent / 100 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def median(values):
+    return percentile(sorted(values), 50)
+
+
+class Stats(object):
+    """Timings of the stages of the pipeline, and counters."""
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def timer(self, stage):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.timings[stage].append(clock() - start)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def summary(self):
+        """Return the count and percentiles (in ms) of each stage."""
+        result = {}
+        for stage, timings in self.timings.items():
+            timings = sorted(timings)
+            result[stage] = dict(
+                [('count', len(timings))] +
+                [(name, percentile(timings, percent) * 1000)
+                 for name, percent in [('p50', 50), ('p90', 90),
+                                       ('p99', 99), ('max', 100)]])
+        return result
+
+
+class StatsMetrics(NullMetrics):
+    """Add the durations of the rules and triggers of MailBot to the stats.
+
+    The other metrics are discarded.
+
+    """
+    enabled = True
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def observe(self, name, value, **labels):
+        if name == 'callback_seconds':
+            self.stats.timings[labels['step']].append(value)
+
+    def timer(self, name, **labels):
+        if name == 'callback_seconds':
+            return Timer(self, name, labels)
+        return NULL_TIMER
+
+
+class TimedIMAPClient(FakeIMAPClient):
+    """Time the IMAP commands, and count the downloaded bytes.
+
+    The mails fetched are copies, as if they were read from a socket, for
+    the peak memory to include them.
+
+    """
+    downloaded = ('RFC822', 'BODY[]', 'BODY[HEADER]')
+
+    def search(self, criteria):
+        with self.server.stats.timer('search'):
+            return super(TimedIMAPClient, self).search(criteria)
+
+    def fetch(self, uids, items):
+        with self.server.stats.timer('fetch'):
+            result = super(TimedIMAPClient, self).fetch(uids, items)
+            for response in result.values():
+                for item, value in response.items():
+                    if item in self.downloaded:
+                        response[item] = copy(value)
+                        self.server.stats.count('bytes', len(value))
+        return result
+
+    def add_flags(self, uids, flags):
+        with self.server.stats.timer('store'):
+            return super(TimedIMAPClient, self).add_flags(uids, flags)
+
+    def remove_flags(self, uids, flags):
+        with self.server.stats.timer('store'):
+            return super(TimedIMAPClient, self).remove_flags(uids, flags)
+
+
+def copy(value):
+    """Return a copy of the bytes (the mails of the corpora are bytes)."""
+    if isinstance(value, bytes):
+        return bytes(bytearray(value))
+    return value
+
+
+class BenchmarkIMAPServer(FakeIMAPServer):
+
+    def __init__(self, stats):
+        super(BenchmarkIMAPServer, self).__init__()
+        self.stats = stats
+
+    def client(self, host, **kwargs):
+        self.connections += 1
+        return TimedIMAPClient(self)
+
+
+class BenchmarkMailBot(MailBot):
+    """Time the processing (parsing, rules, triggers) of each message."""
+    stats = None
+
+    def process_callbacks(self, msg, uid=None):
+        with self.stats.timer('message'):
+            return super(BenchmarkMailBot, self).process_callbacks(msg, uid)
+
+
+def run_once(mails, callbacks, stats, options, trace=False):
+    """Process the mails once, return the processing results.
+
+    Only ``process_messages`` is measured: delivering the mails and
+    connecting to the server aren't.
+
+    """
+    server = BenchmarkIMAPServer(stats)
+    for mail in mails:
+        server.deliver(mail)
+    BenchmarkCallback.stats = stats
+    bot = BenchmarkMailBot('localhost', 'user', 'password', lazy=True,
+                           callbacks=callbacks, metrics=StatsMetrics(stats),
+                           **options)
+    bot.stats = stats
+    bot.imapclient = server.client
+    bot.connect()
+    del server.commands[:]
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    start = clock()
+    processed = bot.process_messages()
+    elapsed = clock() - start
+    round_trips = len(server.commands)
+    peak_memory = None
+    if trace:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    bot.disconnect()
+    return {'processed': processed, 'elapsed': elapsed,
+            'round_trips': round_trips, 'peak_memory': peak_memory}
+
+
+def run_scenario(corpus, callbacks, messages=100, repeat=3, memory=True,
+                 **options):
+    """Run the scenario ``repeat`` times, and return its results.
+
+    The corpus is the name of one of the ``CORPORA``, and callbacks the
+    number of callbacks. The options are given to MailBot (batch_size,
+    header_first...). The peak memory is measured in an extra run, as
+    tracing the memory allocations slows everything down.
+
+    """
+    make_mail = CORPORA[corpus]
+    mails = [make_mail(index) for index in range(messages)]
+    callbacks_map = make_callbacks(callbacks)
+    stats = Stats()
+    runs = [run_once(mails, callbacks_map, stats, options)
+            for _ in range(repeat)]
+    peak_memory = None
+    if memory and tracemalloc is not None:
+        peak_memory = run_once(mails, callbacks_map, Stats(), options,
+                               trace=True)['peak_memory']
+    processed = runs[0]['processed'] or 1
+    return {
+        'corpus': corpus,
+        'callbacks': callbacks,
+        'messages': messages,
+        'options': options,
+        'messages_per_second': median(
+            [run['processed'] / run['elapsed'] for run in runs]),
+        'stages': stats.summary(),
+        'round_trips_per_message': runs[0]['round_trips'] / processed,
+        'bytes_per_message': stats.counters['bytes'] / repeat / processed,
+        'triggered': stats.counters['triggered'] // repeat,
+        'peak_memory': peak_memory,
+    }
+
+
+def get_name(result):
+    return '%s/%d callbacks' % (result['corpus'], result['callbacks'])
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compare the results to the baseline ones, by scenario name.
+
+    Return a list of (name, metric, baseline value, value, change, regressed)
+    where change is the relative change, and regressed is True if the
+    metric is more than ``threshold`` worse than the baseline.
+
+    """
+    rows = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in sorted(METRICS.items()):
+            old = baseline[name].get(metric)
+            new = results[name].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            rows.append((name, metric, old, new, change, worse > threshold))
+    return rows
+
+
+def format_results(results):
+    """Return a human readable report of the results."""
+    lines = []
+    for name in sorted(results):
+        result = results[name]
+        peak_memory = result['peak_memory']
+        lines.append(
+            '%s: %.1f msg/s, %.2f round trips/msg, %.0f bytes/msg, '
+            '%d triggered, peak memory %s' % (
+                name, result['messages_per_second'],
+                result['round_trips_per_message'],
+                result['bytes_per_message'], result['triggered'],
+                'n/a' if peak_memory is None
+                else '%.1f KiB' % (peak_memory / 1024)))
+        for stage, timings in sorted(result['stages'].items()):
+            lines.append(
+                '    %-8s %6d calls  p50 %8.3fms  p90 %8.3fms  '
+                'p99 %8.3fms  max %8.3fms' % (
+                    stage, timings['count'], timings['p50'], timings['p90'],
+                    timings['p99'], timings['max']))
+    return '\n'.join(lines)
+
+
+def format_comparison(rows):
+    """Return a human readable report of a comparison."""
+    return '\n'.join(
+        '%s %s: %.4g -> %.4g (%+.1f%%)%s' % (
+            name, metric, old, new, change * 100,
+            ' REGRESSION' if regressed else '')
+        for name, metric, old, new, change, regressed in rows)
@@ -2,18 +2,81 @@
 
 from __future__ import absolute_import
 
-from collections import defaultdict
-from email.header import decode_header
-from re import findall
+import logging
+from collections import defaultdict, OrderedDict
 
-from .compat import text_type, encoded_padding
+from . import attachments
+from .compat import string_types
+from .message import decode_header_value, get_text_body, ParsedMessage
+from .regexps import findall, TimeoutError
+
+
+logger = logging.getLogger(__name__)
+
+
+REGEXP_SPECIALS = frozenset('\\.^$*+?{}[]|()')
+
+
+def get_rule_cost(item, regexps):
+    """Estimate the cost of checking the item against the regexps.
+
+    Headers are cheaper than the body, which has to be found and decoded, and
+    literal strings are cheaper than regexps.
+
+    """
+    cost = 2 if item == 'body' else 0
+    if isinstance(regexps, string_types):
+        regexps = [regexps]
+    if not isinstance(regexps, (list, tuple)):
+        return cost
+    for regexp in regexps:
+        pattern = getattr(regexp, 'pattern', regexp)
+        if (not isinstance(pattern, string_types) or
+                REGEXP_SPECIALS.intersection(pattern)):
+            return cost + 1
+    return cost
+
+
+def order_rules(rules):
+    """Return the (item, regexps) of the rules, the cheapest first."""
+    return sorted(rules.items(), key=lambda rule: get_rule_cost(*rule))
 
 
 class Callback(object):
-    """Base class for callbacks."""
+    """Base class for callbacks.
+
+    Set ``needs_body`` to False on callbacks that only need the headers of the
+    mails they're triggered on: in the ``header_first`` mode, MailBot won't
+    download the full mail for them if they have no rule on the body.
+
+    The rules are checked the cheapest first (see ``get_rule_cost``), and the
+    checks stop at the first item not matching: ``self.matches`` is only
+    complete if all the items match. Set ``full_evaluation`` to True to check
+    all the items, in the order of the rules, anyway.
+
+    To protect the mailbox from regexps backtracking for too long, set
+    ``max_item_length`` (the items longer than that many characters are
+    not checked), or a ``regexp_engine`` (see ``mailbot.regexps``): with the
+    'regex' engine, the matching of each regexp is interrupted after
+    ``regexp_timeout`` seconds (the default engine can't interrupt it, so
+    registering a callback with a ``regexp_timeout`` and another engine
+    raises RegisterException). A rule over budget doesn't match, and is added
+    to ``self.over_budget``, as an (item, reason) tuple.
+
+    The attachments of the mail may be listed with ``get_attachments``, and
+    saved with ``save_attachment``: for a callback with ``needs_body`` False,
+    in the ``header_first`` mode, only the attachments saved are downloaded.
+
+    """
+    needs_body = True
+    full_evaluation = False
+    max_item_length = None
+    regexp_timeout = None
+    regexp_engine = None
 
     def __init__(self, message, rules):
         self.matches = defaultdict(list)
+        self.over_budget = []
         self.message = message
         self.rules = rules
 
@@ -21,7 +84,10 @@ class Callback(object):
         """Does this message conform to the all the rules provided?
 
         For each item in the rules dictionnary (item, [regexp1, regexp2...]),
-        call ``self.check_item``.
+        call ``self.check_item``, until an item doesn't match (unless
+        ``full_evaluation`` is True). The rules are checked the cheapest
+        first, or in their own order if they're an OrderedDict (as compiled
+        by ``register``).
 
         """
         if rules is None:
@@ -30,16 +96,27 @@ class Callback(object):
         if not rules:  # if no (or empty) rules, it's a catchall callback
             return True
 
-        rules_tests = [self.check_item(item, regexps)
-                       for item, regexps in rules.items()]
+        if self.full_evaluation:
+            rules_tests = [self.check_item(item, regexps)
+                           for item, regexps in rules.items()]
+            return all(rules_tests)  # True only if at least one value is
 
-        return all(rules_tests)  # True only if at least one value is
+        if isinstance(rules, OrderedDict):
+            items = rules.items()
+        else:
+            items = order_rules(rules)
+        for item, regexps in items:
+            if not self.check_item(item, regexps):
+                return False
+        return True
 
     def check_item(self, item, regexps, message=None):
         """Search the email's item using the given regular expressions.
 
         Item is one of subject, from, to, cc, body.
 
+        The regexps may also be ``mailbot.keywords.Keywords``.
+
         Store the result of searching the item with the regular expressions in
         self.matches[item]. If the search doesn't match anything, this will
         result in a None, otherwise it'll be a ``re.MatchObject``.
@@ -48,25 +125,56 @@ class Callback(object):
         if message is None:
             message = self.message
 
-        if item not in message and item != 'body':  # bad item, not found
+        value = self.get_value(item, message)
+        if value is None:  # bad item, not found
             return None
 
-        # if item is not in header, then item == 'body'
-        if item == 'body':
-            value = self.get_email_body(message)
-        else:
-            value = message[item]
-            # decode header (might be encoded as latin-1, utf-8...
-            value = encoded_padding.join(
-                chunk.decode(encoding or 'ASCII')
-                if not isinstance(chunk, text_type) else chunk
-                for chunk, encoding in decode_header(value))
+        if (self.max_item_length is not None and
+                len(value) > self.max_item_length):
+            return self.exceed_budget(item, 'length')
 
         for regexp in regexps:  # store all captures for easy access
-            self.matches[item] += findall(regexp, value)
+            found = self.findall(regexp, value)
+            if found is None:
+                self.matches.pop(item, None)  # the rule doesn't match
+                return self.exceed_budget(item, 'timeout')
+            self.matches[item] += found
 
         return any(self.matches[item])
 
+    def findall(self, regexp, value):
+        """Return the matches, or None if over the ``regexp_timeout``."""
+        try:
+            return findall(regexp, value, self.regexp_timeout)
+        except TimeoutError:
+            return None
+
+    def exceed_budget(self, item, reason):
+        logger.warning("Rule on %s of %s over budget (%s), not matching",
+                       item, type(self).__name__, reason)
+        self.over_budget.append((item, reason))
+        return False
+
+    def get_value(self, item, message=None):
+        """Return the decoded value of the item, or None if it's not found.
+
+        Item is one of subject, from, to, cc, body.
+
+        """
+        if message is None:
+            message = self.message
+
+        if item not in message and item != 'body':  # bad item, not found
+            return None
+
+        # if item is not in header, then item == 'body'
+        if item == 'body':
+            return self.get_email_body(message)
+
+        if isinstance(message, ParsedMessage):  # decoded once for all
+            return message.get_header(item)
+        return decode_header_value(message[item])
+
     def get_email_body(self, message=None):
         """Return the message text body.
 
@@ -77,21 +185,34 @@ class Callback(object):
         if message is None:
             message = self.message
 
+        if isinstance(message, ParsedMessage):  # decoded once for all
+            return message.get_body()
+
         if not hasattr(message, 'walk'):  # not an email.Message instance?
             return None
 
-        for part in message.walk():
-            content_type = part.get_content_type()
-            filename = part.get_filename()
-            if content_type == 'text/plain' and filename is None:
-                # text body of the mail, not an attachment
-                encoding = part.get_content_charset() or 'ASCII'
-                content = part.get_payload()
-                if not isinstance(content, text_type):
-                    content = part.get_payload(decode=True).decode(encoding)
-                return content
-
-        return ''
+        return get_text_body(message)
+
+    def get_attachments(self):
+        """Return the list of the ``Attachment`` of the mail.
+
+        If only the headers of the mail were downloaded, the attachments are
+        listed from its BODYSTRUCTURE, without downloading them.
+
+        """
+        return attachments.get_attachments(self.message)
+
+    def save_attachment(self, attachment, target,
+                        chunk_size=attachments.CHUNK_SIZE):
+        """Write the decoded attachment to the target, return its size.
+
+        The target is a path, or a binary file-like object. If only the
+        headers of the mail were downloaded, the attachment is downloaded by
+        chunks of ``chunk_size`` bytes, and never kept in memory as a whole.
+
+        """
+        return attachments.save_attachment(self.message, attachment, target,
+                                           chunk_size)
 
     def trigger(self):
         """Called when a mail matching the registered rules is received."""
@@ -8,6 +8,8 @@ import sys
 # up
 encoded_padding = ''
 text_type = str
+string_types = (str,)
 if sys.version < '3':
     encoded_padding = ' '
     text_type = unicode  # noqa
+    string_types = (basestring,)  # noqa
@@ -3,3 +3,15 @@
 
 class RegisterException(Exception):
     """Exception raised on a registration error."""
+
+
+class RegexpWarning(UserWarning):
+    """Warning issued when registering a regexp which may take forever."""
+
+
+class IMAPError(Exception):
+    """Exception raised when the IMAP server rejects a command."""
+
+
+class RulesError(Exception):
+    """Exception raised when the rules of a callback failed in a worker."""
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+"""In-memory fake IMAP server, with an IMAPClient-like client.
+
+Use ``FakeIMAPServer.client`` as the ``imapclient`` attribute of a MailBot, and
+``FakeIMAPServer.deliver`` to receive mails (str, or bytes like IMAPClient
+returns them on python 3).
+
+It's used by the tests and the benchmarks (see ``mailbot.benchmarks``).
+
+"""
+
+from __future__ import absolute_import
+
+import re
+import socket
+from datetime import datetime
+from threading import Condition
+
+from imapclient import IMAPClient
+
+from .mime import parse_mail
+
+
+PARTIAL = re.compile(r'BODY\.PEEK\[([\d.]+)\]<(\d+)\.(\d+)>$')
+
+
+def get_bodystructure(message):
+    """Return the BODYSTRUCTURE of the ``email.Message``, like IMAPClient."""
+    if message.is_multipart():
+        return ([get_bodystructure(part) for part in message.get_payload()],
+                message.get_content_subtype())
+    params = tuple(value for pair in message.get_params()[1:]
+                   for value in pair) or None
+    payload = message.get_payload()
+    structure = (message.get_content_maintype(),
+                 message.get_content_subtype(), params, None, None,
+                 message.get('Content-Transfer-Encoding', '7bit'),
+                 len(payload))
+    if message.get_content_maintype() == 'text':
+        structure += (payload.count('\n'),)
+    disposition = None
+    if 'Content-Disposition' in message:
+        dparams = message.get_params(header='Content-Disposition')
+        disposition = (dparams[0][0], tuple(
+            value for pair in dparams[1:] for value in pair) or None)
+    return structure + (None, disposition, None, None)
+
+
+def get_section(message, section):
+    """Return the part of the ``email.Message`` at this IMAP section."""
+    for index in section.split('.'):
+        if message.is_multipart():
+            message = message.get_payload()[int(index) - 1]
+    return message
+
+
+class FakeIMAPServer(object):
+    """A single folder mailbox, shared by all the clients connected to it."""
+
+    capabilities = ('IMAP4REV1', 'IDLE')
+
+    def __init__(self, capabilities=None):
+        if capabilities is not None:
+            self.capabilities = capabilities
+        self.messages = {}
+        self.next_uid = 1
+        self.uidvalidity = 1
+        self.modseq = 1
+        self.condition = Condition()
+        self.generation = 0  # incremented each time connections are dropped
+        self.connections = 0
+        self.logins = 0
+        self.commands = []
+        self.fetched = []  # the items of all the FETCH commands
+        self.failures = 0
+
+    def client(self, host, **kwargs):
+        """Connect to this server: this mimics ``IMAPClient.__init__``."""
+        if self.failures:  # server unreachable
+            self.failures -= 1
+            raise socket.error('Connection refused')
+        self.connections += 1
+        return FakeIMAPClient(self)
+
+    def deliver(self, raw, flags=(), internaldate=None):
+        """Receive a new mail, return its UID."""
+        with self.condition:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages[uid] = {
+                'RFC822': raw,
+                'FLAGS': set(flags),
+                'INTERNALDATE': internaldate or datetime.utcnow()}
+            self.touch(uid)
+            self.condition.notify_all()
+        return uid
+
+    def touch(self, uid):
+        """The flags of the message changed: update its MODSEQ."""
+        self.modseq += 1
+        self.messages[uid]['MODSEQ'] = self.modseq
+
+    def disconnect(self, failures=0):
+        """Drop all the connections, and refuse the next ``failures`` ones."""
+        with self.condition:
+            self.generation += 1
+            self.failures = failures
+            self.condition.notify_all()
+
+    def flags(self, uid):
+        return set(self.messages[uid]['FLAGS'])
+
+
+class FakeIMAP(object):
+    """The imaplib connection of IMAPClient, keeping untagged responses."""
+
+    def __init__(self):
+        self.untagged_responses = {}
+
+
+class FakeIMAPClient(object):
+    """Implement the subset of the IMAPClient API used by MailBot.
+
+    Like a real server, the new messages are notified along the response of
+    any command: by NOOP and IDLE, or kept in the ``untagged_responses`` of
+    imaplib for the other commands.
+
+    """
+    notifying_commands = ('NOOP', 'IDLE', 'DONE')
+
+    def __init__(self, server):
+        self.server = server
+        self._imap = FakeIMAP()
+        self.generation = server.generation
+        self.known = len(server.messages)  # number of messages notified
+        self.normalise_times = True
+        self.condstore = False
+        self.selected = False
+
+    def _command(self, name):
+        """Register the command, check the connection is still alive."""
+        self._check_connection()
+        self.server.commands.append(name)
+        if name not in self.notifying_commands:
+            with self.server.condition:
+                for exists, response in self._new_messages():
+                    self._imap.untagged_responses.setdefault(
+                        response, []).append(str(exists).encode('ascii'))
+
+    def _check_connection(self):
+        if self.generation != self.server.generation:
+            raise socket.error('Connection reset by peer')
+
+    def _new_messages(self):
+        """Return the untagged EXISTS response, if there are new messages."""
+        exists = len(self.server.messages)
+        if exists > self.known:
+            self.known = exists
+            return [(exists, 'EXISTS')]
+        return []
+
+    def has_capability(self, capability):
+        return capability.upper() in self.server.capabilities
+
+    def enable(self, *capabilities):
+        self._command('ENABLE')
+        if self.selected:
+            raise IMAPClient.Error('ENABLE is only allowed in AUTH state')
+        if 'CONDSTORE' in capabilities and self.has_capability('CONDSTORE'):
+            self.condstore = True
+            return ['CONDSTORE']
+        return []
+
+    def login(self, username, password):
+        self._command('LOGIN')
+        self.server.logins += 1
+
+    def logout(self):
+        self._command('LOGOUT')
+        self.generation = None  # dead connection
+
+    def select_folder(self, folder):
+        self._command('SELECT')
+        self.selected = True
+        response = {'EXISTS': len(self.server.messages),
+                    'UIDVALIDITY': self.server.uidvalidity,
+                    'UIDNEXT': self.server.next_uid}
+        if self.condstore:
+            response['HIGHESTMODSEQ'] = self.server.modseq
+        return response
+
+    def noop(self):
+        self._command('NOOP')
+        with self.server.condition:
+            return 'NOOP completed', self._new_messages()
+
+    def idle(self):
+        self._command('IDLE')
+
+    def idle_check(self, timeout=None):
+        with self.server.condition:
+            responses = self._new_messages()
+            if not responses:
+                self.server.condition.wait(timeout)
+                responses = self._new_messages()
+        self._check_connection()
+        return responses
+
+    def idle_done(self):
+        self._command('DONE')
+        with self.server.condition:
+            return 'IDLE terminated', self._new_messages()
+
+    def search(self, criteria):
+        self._command('SEARCH')
+        uids = []
+        for uid, data in sorted(self.server.messages.items()):
+            tokens = list(criteria)
+            matches = True
+            while tokens:  # all the criteria must match
+                matches = self._match(uid, data, tokens) and matches
+            if matches:
+                uids.append(uid)
+        return uids
+
+    def _match(self, uid, data, tokens):
+        """Consume the tokens of a search key, return True if it matches."""
+        criterion = tokens.pop(0)
+        if isinstance(criterion, list):  # parenthesized list of keys
+            inner = list(criterion)
+            matches = True
+            while inner:
+                matches = self._match(uid, data, inner) and matches
+            return matches
+        criterion = str(criterion).upper()
+        if criterion in self.text_keys:
+            return self._match_text(data, self.text_keys[criterion],
+                                    tokens.pop(0))
+        if criterion == 'HEADER':
+            name = tokens.pop(0)
+            return self._match_text(data, name, tokens.pop(0))
+        if criterion == 'ALL':
+            return True
+        if criterion == 'OR':
+            first = self._match(uid, data, tokens)
+            second = self._match(uid, data, tokens)
+            return first or second
+        if criterion == 'NOT':
+            return not self._match(uid, data, tokens)
+        if criterion == 'UID':
+            return uid in self._uid_set(tokens.pop(0))
+        if criterion == 'KEYWORD':
+            return tokens.pop(0) in data['FLAGS']
+        if criterion == 'UNKEYWORD':
+            return tokens.pop(0) not in data['FLAGS']
+        if criterion == 'BEFORE':  # the time is disregarded
+            return data['INTERNALDATE'].date() < tokens.pop(0)
+        if criterion == 'SINCE':
+            return data['INTERNALDATE'].date() >= tokens.pop(0)
+        if criterion == 'MODSEQ':
+            return data['MODSEQ'] >= int(tokens.pop(0))
+        if criterion.startswith('UN'):
+            return '\\' + criterion[2:].capitalize() not in data['FLAGS']
+        return '\\' + criterion.capitalize() in data['FLAGS']
+
+    text_keys = {'FROM': 'from', 'TO': 'to', 'CC': 'cc', 'BCC': 'bcc',
+                 'SUBJECT': 'subject', 'BODY': None}
+
+    def _match_text(self, data, name, string):
+        """Case insensitive substring search in a header, or the body."""
+        message = parse_mail(data['RFC822'])
+        if name is None:
+            value = message.get_payload()
+            if not isinstance(value, str):  # multipart: search all the parts
+                value = data['RFC822']
+                if not isinstance(value, str):
+                    value = value.decode('utf-8', 'replace')
+        else:
+            value = message[name]
+            if value is None:
+                return False
+        return string.lower() in value.lower()
+
+    def _uid_set(self, value):
+        """Return the set of UIDs of a sequence set like '1,3:5,7:*'."""
+        last = max(self.server.messages) if self.server.messages else 0
+        uids = set()
+        for part in str(value).split(','):
+            start, _, end = part.partition(':')
+            start = last if start == '*' else int(start)
+            end = start if not end else last if end == '*' else int(end)
+            uids.update(range(min(start, end), max(start, end) + 1))
+        return uids
+
+    def fetch(self, uids, items):
+        self._command('FETCH')
+        result = {}
+        self.server.fetched.extend(items)
+        for uid in uids:
+            if uid not in self.server.messages:
+                continue
+            data = self.server.messages[uid]
+            result[uid] = response = {'SEQ': uid}
+            for item in items:
+                if item == 'RFC822':
+                    response['RFC822'] = data['RFC822']
+                    if '\\Seen' not in data['FLAGS']:
+                        data['FLAGS'].add('\\Seen')
+                        self.server.touch(uid)
+                elif item == 'BODY.PEEK[]':
+                    response['BODY[]'] = data['RFC822']
+                elif item == 'RFC822.SIZE':
+                    response['RFC822.SIZE'] = len(data['RFC822'])
+                elif item == 'BODY.PEEK[HEADER]':
+                    raw = data['RFC822']
+                    if isinstance(raw, bytes) and not isinstance(raw, str):
+                        end = re.search(br'\r?\n\r?\n|\Z', raw).end()
+                        response['BODY[HEADER]'] = raw[:end]
+                        continue
+                    message = parse_mail(raw)
+                    response['BODY[HEADER]'] = ''.join(
+                        '%s: %s\r\n' % header
+                        for header in message.items()) + '\r\n'
+                elif item in ('INTERNALDATE', 'FLAGS', 'MODSEQ'):
+                    response[item] = data[item]
+                elif item == 'BODYSTRUCTURE':
+                    response[item] = get_bodystructure(
+                        parse_mail(data['RFC822']))
+                elif PARTIAL.match(item):
+                    section, offset, length = PARTIAL.match(item).groups()
+                    payload = get_section(parse_mail(data['RFC822']),
+                                          section).get_payload()
+                    if not isinstance(payload, bytes):
+                        payload = payload.encode('ascii', 'surrogateescape')
+                    response['BODY[%s]<%s>' % (section, offset)] = payload[
+                        int(offset):int(offset) + int(length)]
+        return result
+
+    def add_flags(self, uids, flags):
+        self._command('STORE')
+        for uid in uids:
+            self.server.messages[uid]['FLAGS'].update(flags)
+            self.server.touch(uid)
+
+    def remove_flags(self, uids, flags):
+        self._command('STORE')
+        for uid in uids:
+            self.server.messages[uid]['FLAGS'].difference_update(flags)
+            self.server.touch(uid)
+
+    def get_flags(self, uids):
+        self._command('FETCH')
+        return dict((uid, tuple(sorted(self.server.messages[uid]['FLAGS'])))
+                    for uid in uids)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Backends storing the processing state of the mails on the IMAP server.
+
+A backend gives the search criteria of the mails to process and of the mails
+being processed, and changes the state of the mails. Backends have no state
+of their own, so a single instance may be shared by many MailBots.
+
+"""
+
+from __future__ import absolute_import
+
+
+# the mails processed according to the default backend, or read by a human
+SEEN = ['Seen', 'Unflagged']
+
+
+class FlagsBackend(object):
+    """Use the standard \\Flagged and \\Seen flags (the default).
+
+    The mails being processed are \\Flagged and \\Seen, the processed ones
+    \\Seen only. Those flags are also used by the mail clients: a mail read
+    or flagged by a human is never processed.
+
+    """
+    unprocessed = ['Unseen', 'Unflagged']
+    processing = ['Flagged', 'Seen']
+    # downloading the mail marks it as \\Seen
+    fetch_item = 'RFC822'
+
+    def mark_processing(self, client, uids):
+        client.add_flags(uids, ['\\Flagged', '\\Seen'])
+
+    def mark_processed(self, client, uids):
+        client.remove_flags(uids, ['\\Flagged'])
+        client.add_flags(uids, ['\\Seen'])
+
+    def mark_processed_batch(self, client, uids):
+        # they're already \\Seen, as they were marked as processing
+        client.remove_flags(uids, ['\\Flagged'])
+
+    def mark_skipped(self, client, uids):
+        client.add_flags(uids, ['\\Seen'])
+
+    def reset(self, client, uids):
+        client.remove_flags(uids, ['\\Flagged', '\\Seen'])
+
+
+class KeywordsBackend(FlagsBackend):
+    """Use custom IMAP keywords, leaving the flags of the mails untouched.
+
+    The mails being processed have both the ``done`` and ``processing``
+    keywords, the processed ones the ``done`` keyword only: each state
+    change is a single STORE command. The mails are downloaded without being
+    marked as \\Seen.
+
+    The server must support custom keywords (see the PERMANENTFLAGS of the
+    folder).
+
+    Every mail without the ``done`` keyword is to be processed, whatever its
+    flags: before switching an existing folder to this backend, mark the
+    mails already processed with ``MailBot.adopt_messages``, or the whole
+    history of the folder is processed again.
+
+    """
+    fetch_item = 'BODY.PEEK[]'
+
+    def __init__(self, processing='$MailbotProcessing', done='$MailbotDone'):
+        self.processing_keyword = processing
+        self.done_keyword = done
+        self.unprocessed = ['UNKEYWORD', done]
+        self.processing = ['KEYWORD', processing]
+
+    def mark_processing(self, client, uids):
+        client.add_flags(uids, [self.done_keyword, self.processing_keyword])
+
+    def mark_processed(self, client, uids):
+        client.remove_flags(uids, [self.processing_keyword])
+
+    mark_processed_batch = mark_processed
+
+    def mark_skipped(self, client, uids):
+        client.add_flags(uids, [self.done_keyword])
+
+    def reset(self, client, uids):
+        client.remove_flags(uids, [self.done_keyword,
+                                   self.processing_keyword])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Keywords rules: match any of a (large) set of literal strings.
+
+A ``Keywords`` may be used in the rules instead of a regexp::
+
+    register(MyCallback, {'subject': [Keywords(customer_ids)]})
+
+All its keywords are compiled in a single Aho-Corasick automaton when the
+callback is registered: each item of a mail is scanned once, in a time
+linear in its length, whatever the number of keywords. Each keyword found is
+added to ``self.matches`` of the callback, as many times as it's found.
+
+"""
+
+from __future__ import absolute_import
+
+from collections import deque
+
+
+class Keywords(object):
+    """Rule matching any of the keywords.
+
+    If ``ignore_case`` is True, the keywords are found whatever their case.
+    If ``whole_words`` is True, the keywords are only found if they're not
+    part of a longer word: "ID-12" is then not found in "ID-123".
+
+    """
+
+    def __init__(self, keywords, ignore_case=False, whole_words=False):
+        self.keywords = [keyword for keyword in keywords if keyword]
+        self.ignore_case = ignore_case
+        self.whole_words = whole_words
+        self.automaton = None
+
+    def __repr__(self):
+        return '<Keywords: %d keywords>' % len(self.keywords)
+
+    def normalize(self, text):
+        return text.lower() if self.ignore_case else text
+
+    def compile(self):
+        """Build the automaton (if not already done), return self."""
+        if self.automaton is None:
+            self.automaton = build_automaton(
+                (self.normalize(keyword), keyword)
+                for keyword in self.keywords)
+        return self
+
+    def findall(self, text):
+        """Return the list of the keywords found, in the order they end."""
+        goto, fail, output = self.compile().automaton
+        text = self.normalize(text)
+        found = []
+        state = 0
+        for position, char in enumerate(text):
+            next_state = goto[state].get(char)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto[state].get(char)
+            state = next_state or 0
+            for length, keyword in output[state]:
+                if self.whole_words and not is_whole_word(
+                        text, position + 1 - length, position + 1):
+                    continue
+                found.append(keyword)
+        return found
+
+
+def build_automaton(keywords):
+    """Return the Aho-Corasick automaton of the (string, keyword) pairs.
+
+    The automaton is a (goto, fail, output) tuple of lists, indexed by
+    state: the transitions of each state ({char: state}), the state to fall
+    back to when there's no transition, and the (length, keyword) found when
+    reaching the state.
+
+    """
+    goto, fail, output = [{}], [0], [[]]
+    for string, keyword in keywords:
+        state = 0
+        for char in string:
+            if char not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                output.append([])
+                goto[state][char] = len(goto) - 1
+            state = goto[state][char]
+        if (len(string), keyword) not in output[state]:
+            output[state].append((len(string), keyword))
+
+    # breadth first, so the fail state of a state is always done before it
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fallback = fail[state]
+            while fallback and char not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(char, 0)
+            # the keywords ending here also end with the shorter ones
+            output[next_state].extend(output[fail[next_state]])
+    return goto, fail, output
+
+
+def is_whole_word(text, start, end):
+    """Is the text[start:end] not part of a longer word?"""
+    return ((start == 0 or not is_word_char(text[start - 1])) and
+            (end == len(text) or not is_word_char(text[end])))
+
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Ledger of the callbacks done, to trigger each of them only once per mail.
+
+When a MailBot is killed in the middle of a run, the mails being processed
+are reset after the ``timeout``, and processed again: all their callbacks
+are triggered again, even the ones which already did their job. When a
+MailBot has a ``ledger``, each callback done is recorded, by mailbox, with
+the UIDVALIDITY and UID of the mail and its Message-ID, and the callbacks
+already done for a mail are skipped when it is processed again.
+
+A callback done but not recorded yet when MailBot is killed is still
+triggered again: the ledger narrows this window to the time of a single
+write, but can't close it.
+
+"""
+
+from __future__ import absolute_import
+
+import sqlite3
+from threading import Lock
+from time import time
+
+
+SCHEMA = """
+PRAGMA auto_vacuum = INCREMENTAL;
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    callback TEXT NOT NULL,
+    message_id TEXT,
+    completed_at REAL NOT NULL,
+    PRIMARY KEY (key, uidvalidity, uid, callback)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS completions_message_id
+    ON completions (key, message_id);
+CREATE INDEX IF NOT EXISTS completions_age ON completions (completed_at);
+"""
+
+
+class Ledger(object):
+    """Record the callbacks done in a SQLite database (thread safe).
+
+    The database is in memory by default, or in the file at ``path`` to
+    survive restarts (which is the whole point). The entries are kept by
+    mailbox ``key`` (see ``MailBot.get_state_key``), so a single ledger may be
+    shared by many MailBots.
+
+    The entries older than ``max_age`` seconds are removed by ``compact``, so
+    the ledger only keeps the recent mails: ``max_age`` must be longer than
+    the ``timeout`` of the MailBots, for the mails to still be in the ledger
+    when they are reset.
+
+    """
+
+    def __init__(self, path=':memory:', max_age=7 * 24 * 60 * 60):
+        self.max_age = max_age
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.executescript(SCHEMA)
+
+    def get_completed(self, key, uidvalidity, uid, message_id=None):
+        """Return the set of the names of the callbacks done for the mail.
+
+        The mail is found by UID, or by Message-ID: a mail whose UID changed
+        (with the UIDVALIDITY of the folder) is still found.
+
+        """
+        query = ('SELECT callback FROM completions WHERE key = ? AND '
+                 '(uidvalidity = ? AND uid = ?')
+        params = [key, uidvalidity or 0, uid]
+        if message_id:
+            query += ' OR message_id = ?'
+            params.append(message_id)
+        with self.lock:
+            rows = self.db.execute(query + ')', params).fetchall()
+        return set(callback for callback, in rows)
+
+    def add(self, key, uidvalidity, uid, message_id, callback, now=None):
+        """Record that the callback (its name) is done for the mail."""
+        now = time() if now is None else now
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO completions (key, uidvalidity, uid, '
+                'callback, message_id, completed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, uidvalidity or 0, uid, callback, message_id or None,
+                 now))
+
+    def compact(self, now=None):
+        """Remove the entries older than ``max_age``, return their number.
+
+        The space freed is given back to the file system.
+
+        """
+        now = time() if now is None else now
+        with self.lock:
+            with self.db:
+                removed = self.db.execute(
+                    'DELETE FROM completions WHERE completed_at < ?',
+                    (now - self.max_age,)).rowcount
+            if removed:
+                self.db.execute('PRAGMA incremental_vacuum').fetchall()
+        return removed
+
+    def __len__(self):
+        with self.lock:
+            count, = self.db.execute(
+                'SELECT COUNT(*) FROM completions').fetchone()
+            return count
+
+    def close(self):
+        self.db.close()
@@ -1,10 +1,92 @@
 # -*- coding: utf-8 -*-
 
+import logging
+import socket
+from collections import deque
 from datetime import datetime, timedelta
-from email import message_from_string
+from functools import partial
+from itertools import islice
+from threading import Event
+from time import time
+from timeit import default_timer
 
 from imapclient import IMAPClient
 
+from .attachments import PartFetcher
+from .compat import string_types
+from .exceptions import RulesError
+from .flags import FlagsBackend, SEEN
+from .matching import check_supported, MatchPool
+from .message import ParsedMessage
+from .metrics import InstrumentedClient, NullMetrics
+from .retry import describe, get_callback_name, MESSAGE
+from .rules import RulesIndex
+
+
+logger = logging.getLogger(__name__)
+MATCHES = 'MAILBOT.MATCHES'  # item added to the messages matched in a pool
+
+
+def chunks(iterable, size):
+    """Yield lists of at most ``size`` items taken from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_executor(executor, workers=None):
+    """Return an executor: 'thread' or 'process' for a new pool executor."""
+    if executor not in ('thread', 'process'):
+        return executor
+    try:
+        from concurrent import futures
+    except ImportError:  # pragma: no cover
+        raise ImportError("The 'futures' package is needed on python 2")
+    if executor == 'thread':
+        return futures.ThreadPoolExecutor(max_workers=workers or 5)
+    return futures.ProcessPoolExecutor(max_workers=workers)
+
+
+def trigger_callback(callback):
+    """Trigger the callback: module level function to be picklable."""
+    return callback.trigger()
+
+
+def get_response_item(response, key):
+    """Return the item of a response, whether its keys are str or bytes."""
+    if key in response:
+        return response[key]
+    return response.get(key.encode('ascii'))
+
+
+def get_raw_mail(msg):
+    """Return the raw mail (or its headers only) of a fetch response."""
+    # the raw mail is kept as is (bytes with IMAPClient on python 3)
+    raw = get_response_item(msg, 'RFC822')
+    if raw is None:  # fetched with BODY.PEEK[]
+        raw = get_response_item(msg, 'BODY[]')
+    if raw is None:  # only the headers were needed and fetched
+        raw = get_response_item(msg, 'BODY[HEADER]')
+    return raw
+
+
+def is_headers_only(msg):
+    """Were only the headers of the mail fetched?"""
+    return (get_response_item(msg, 'RFC822') is None and
+            get_response_item(msg, 'BODY[]') is None)
+
+
+def has_new_messages(responses):
+    """Are there EXISTS or RECENT untagged responses in the responses?"""
+    new_messages = ('EXISTS', b'EXISTS', 'RECENT', b'RECENT')
+    for response in responses:
+        if any(token in new_messages for token in response):
+            return True
+    return False
+
 
 class MailBot(object):
     """MailBot mail class, where the magic is happening.
@@ -16,56 +98,825 @@ class MailBot(object):
     """
     home_folder = 'INBOX'
     imapclient = IMAPClient
+    client = None
+    pool = None
+    state_store = None
+    sync_state = None  # state to save once the messages are processed
+    reset_ids = ()  # messages reset by ``reset_timeout_messages``
+    callbacks = None
+    rules_index = None
+    max_messages = None
+    server_filter = False
+    fast_reset = False
+    state_backend = FlagsBackend()
+    metrics = NullMetrics()
+    retry_queue = None
+    ledger = None
+    uidvalidity = None  # of the home folder, recorded in the ledger
+    batch_size = None
+    fetch_size = None
+    fetch_bytes = None
+    header_first = False
+    executor = None
+    max_pending = 10
+    match_workers = None
+    match_pool = None
+    idle_timeout = 29 * 60  # RFC 2177: re-issue IDLE at least every 29 min
+    poll_interval = 60  # seconds between two NOOPs, for servers without IDLE
+    stop_latency = 1  # max seconds between two checks of a stop request
+    reconnect_delay = 1  # first delay before reconnecting, doubled each time
+    max_reconnect_delay = 5 * 60
+    connection_errors = (socket.error, IMAPClient.AbortError)
+    _stopping = None
 
     def __init__(self, host, username, password, port=None, use_uid=True,
-                 ssl=False, stream=False, timeout=None):
+                 ssl=False, stream=False, timeout=None, batch_size=None,
+                 fetch_size=None, fetch_bytes=None, header_first=False,
+                 executor=None, workers=None, max_pending=None, folder=None,
+                 callbacks=None, max_messages=None, lazy=False, pool=None,
+                 state_store=None, server_filter=False, fast_reset=False,
+                 state_backend=None, metrics=None, retry_queue=None,
+                 ledger=None, match_workers=None):
         """Create, connect and login the MailBot.
 
-        All parameters except from ``timeout`` are used by IMAPClient.
+        The ``host``, ``port``, ``use_uid``, ``ssl`` and ``stream`` parameters
+        are used by IMAPClient. If ``lazy`` is True, MailBot doesn't connect
+        until ``connect`` is called.
+
+        The pool parameter is a ``mailbot.pool.ConnectionPool``: the
+        connection is then borrowed from the pool, and given back to it
+        instead of being logged out, to be reused by the next MailBot.
+
+        The state_store parameter enables the incremental mode, see
+        ``get_new_message_ids``: it's a store from ``mailbot.state`` (or any
+        object with the same ``get`` and ``set`` methods).
+
+        The folder parameter is the folder to process, instead of the
+        ``home_folder``, and the callbacks parameter is a dict of
+        {callback_class: rules} to use instead of the registered callbacks.
+
+        The max_messages parameter is the maximum number of messages handled
+        by each ``process_messages`` run.
+
+        The state_backend parameter is the backend storing the processing
+        state of the mails on the server (see ``mailbot.flags``), the
+        \\Flagged and \\Seen flags by default.
+
+        The retry_queue parameter enables the failure isolation: a callback
+        raising an exception doesn't stop the processing, and is triggered
+        again later (see ``mailbot.retry.RetryQueue``).
+
+        The ledger parameter records the callbacks done for each mail, so
+        they aren't triggered again if the mail is processed again (see
+        ``mailbot.ledger.Ledger``).
+
+        The metrics parameter is the object the metrics are reported to, see
+        ``mailbot.metrics``: they're discarded by default.
+
+        The server_filter parameter enables the server side filtering: the
+        messages which can't match the rules of any callback are marked as
+        processed without being downloaded (see ``search_messages``).
 
         The timeout parameter is the number of seconds a mail is allowed to
         stay in the processing state.  Mails older than this timeout will have
         their processing flag removed on the next ``process_messages`` run,
-        allowing MailBot to try processing them again.
+        allowing MailBot to try processing them again. The fast_reset
+        parameter enables the faster (but for the date searches) reset, see
+        ``get_timeout_ids``.
+
+        The batch_size parameter enables the batched processing mode: mails
+        are marked as processing and processed by chunks of ``batch_size``
+        UIDs, with a single STORE command for each state change.
+
+        The fetch_size and fetch_bytes parameters enable the streaming fetch:
+        mails are downloaded by chunks of at most ``fetch_size`` mails and at
+        most ``fetch_bytes`` bytes (a mail bigger than ``fetch_bytes`` is
+        downloaded alone), and processed before the next chunk is downloaded.
+
+        The header_first parameter enables the two-phase fetch: only the
+        headers of the mails are downloaded first, and the full mails are
+        only downloaded if a callback may need their body (see
+        ``needs_body``).
+
+        The executor parameter enables the concurrent execution of the
+        callbacks: it's either a ``concurrent.futures.Executor`` instance, or
+        'thread' (for I/O bound callbacks) or 'process' (for CPU bound
+        callbacks) to use a new pool executor with ``workers`` workers. At
+        most ``max_pending`` messages (twice the number of workers by
+        default) are fetched and waiting for their callbacks to be done.
+
+        The match_workers parameter enables the parsing of the mails and the
+        checking of the rules in a pool of ``match_workers`` processes, the
+        callbacks being triggered in this process (see
+        ``mailbot.matching``): it needs python 3.7+.
 
         """
-        self.client = self.imapclient(host, port=port, use_uid=use_uid,
-                                      ssl=ssl, stream=stream)
-        self.client.login(username, password)
-        self.client.select_folder(self.home_folder)
-        self.client.normalise_times = False  # deal with UTC everywhere
+        self.host = host
+        self.username = username
+        self.password = password
+        self.imap_options = {'port': port, 'use_uid': use_uid, 'ssl': ssl,
+                             'stream': stream}
+        if pool is not None:
+            self.pool = pool
+        if state_store is not None:
+            self.state_store = state_store
+        if folder is not None:
+            self.home_folder = folder
+        if callbacks is not None:
+            self.set_callbacks(callbacks)
+        self.max_messages = max_messages
+        self.server_filter = server_filter
+        if state_backend is not None:
+            self.state_backend = state_backend
+        if metrics is not None:
+            self.metrics = metrics
+        if retry_queue is not None:
+            self.retry_queue = retry_queue
+        if ledger is not None:
+            self.ledger = ledger
+        if not lazy:
+            self.connect()
         self.timeout = timeout
+        self.fast_reset = fast_reset
+        self.leases = {}  # uid: time the mail was claimed by this MailBot
+        self.batch_size = batch_size
+        self.fetch_size = fetch_size
+        self.fetch_bytes = fetch_bytes
+        self.header_first = header_first
+        self.executor = get_executor(executor, workers)
+        if max_pending is not None:
+            self.max_pending = max_pending
+        elif workers:
+            self.max_pending = 2 * workers
+        if match_workers is not None:
+            check_supported()
+            self.match_workers = match_workers
+
+    def connect(self):
+        """Connect and login to the server, then select the home folder.
+
+        If MailBot has a ``pool``, the connection is borrowed from it.
+
+        """
+        if self.pool is not None:
+            self.client = self.pool.acquire(self.host, self.username,
+                                            self.password, self.imap_options,
+                                            imapclient=self.imapclient)
+        else:
+            self.client = self.imapclient(self.host, **self.imap_options)
+        if self.metrics.enabled:  # count the IMAP commands
+            self.client = InstrumentedClient(self.client, self.metrics)
+        if self.pool is None:
+            self.client.login(self.username, self.password)
+        if (self.state_store is not None and
+                self.client.has_capability('CONDSTORE') and
+                self.client.has_capability('ENABLE')):
+            # get the HIGHESTMODSEQ when selecting the folder
+            if self.pool is not None:  # maybe enabled by a previous MailBot
+                self.pool.enable(self.get_client(), 'CONDSTORE')
+            else:
+                self.client.enable('CONDSTORE')
+        info = self.client.select_folder(self.home_folder)
+        self.uidvalidity = get_response_item(info, 'UIDVALIDITY')
+        self.pop_new_messages()  # the EXISTS response of the SELECT
+        self.client.normalise_times = False  # deal with UTC everywhere
+
+    def get_client(self):
+        """Return the IMAPClient, unwrapped if the commands are counted."""
+        if isinstance(self.client, InstrumentedClient):
+            return self.client.client
+        return self.client
+
+    def disconnect(self):
+        """Logout, or give the connection back to the pool, if connected.
+
+        The ``match_pool`` is shut down too: it's started again by the next
+        ``process_messages``.
+
+        """
+        match_pool, self.match_pool = self.match_pool, None
+        if match_pool is not None:
+            match_pool.shutdown()
+        client, self.client = self.get_client(), None
+        if client is None:
+            return
+        if self.pool is not None:
+            self.pool.release(client)
+            return
+        try:
+            client.logout()
+        except Exception:  # the connection is most probably already dead
+            pass
+
+    def reconnect(self):
+        """Drop the current connection (if still possible), and connect."""
+        if self.pool is not None:
+            self.pool.release(self.get_client(), discard=True)
+        else:
+            try:
+                self.client.logout()
+            except Exception:  # the connection is most probably already dead
+                pass
+        self.connect()
+
+    def set_callbacks(self, callbacks):
+        """Use these {callback_class: rules} instead of the registered ones.
+
+        The rules are compiled in an index of their own, which may raise
+        RegisterException (see ``mailbot.register``).
+
+        """
+        rules_index = RulesIndex()
+        for callback_class, rules in callbacks.items():
+            rules_index.add(callback_class, rules or {})
+        self.callbacks = callbacks
+        self.rules_index = rules_index
+
+    def get_callbacks(self):
+        """Return the dict of {callback_class: rules} to check messages."""
+        if self.callbacks is not None:
+            return self.callbacks
+        from . import CALLBACKS_MAP
+        return CALLBACKS_MAP
+
+    def get_rules_index(self):
+        """Return the index of compiled rules of ``get_callbacks``."""
+        if self.rules_index is not None:
+            return self.rules_index
+        from . import RULES_INDEX
+        return RULES_INDEX
 
     def get_message_ids(self):
         """Return the list of IDs of messages to process."""
-        return self.client.search(['Unseen', 'Unflagged'])
+        if self.state_store is not None:
+            return self.get_new_message_ids()
+        return self.search_messages(self.state_backend.unprocessed)
+
+    def search_messages(self, criteria):
+        """Return the IDs of the messages matching the search criteria.
+
+        If ``server_filter`` is True, and the rules of the callbacks can be
+        translated to an IMAP search key (see ``RulesIndex.search_key``), the
+        messages which can't match any callback are marked as processed
+        straight away, and only the other ones are returned.
+
+        """
+        search_key = None
+        if self.server_filter:
+            search_key = self.get_rules_index().search_key(
+                self.get_callbacks())
+        if search_key is None:
+            return self.client.search(criteria)
+        self.mark_skipped(self.client.search(criteria + ['NOT'] + search_key))
+        return self.client.search(criteria + search_key)
+
+    def get_state_key(self):
+        return '%s@%s/%s' % (self.username, self.host, self.home_folder)
+
+    def get_new_message_ids(self):
+        """Return the IDs of messages to process, using the saved state.
+
+        Instead of searching the whole folder, only the messages above the
+        highest UID already processed are searched, and, if the server
+        supports CONDSTORE, the messages whose flags changed since the last
+        run (for example, reset by another MailBot). The messages reset by
+        this MailBot are also returned.
+
+        If the UIDVALIDITY of the folder changed, the saved UIDs are
+        meaningless: the whole folder is searched again.
+
+        """
+        # selecting the folder again gives fresh UIDVALIDITY, UIDNEXT and
+        # HIGHESTMODSEQ, for a small and constant cost
+        info = self.client.select_folder(self.home_folder)
+        uidvalidity = get_response_item(info, 'UIDVALIDITY')
+        uidnext = get_response_item(info, 'UIDNEXT')
+        modseq = get_response_item(info, 'HIGHESTMODSEQ')
+        self.uidvalidity = uidvalidity
+
+        state = self.state_store.get(self.get_state_key())
+        if state is None or state['uidvalidity'] != uidvalidity:
+            if state is not None:
+                logger.warning("UIDVALIDITY of %s changed, full resync",
+                               self.get_state_key())
+            state = {'uidvalidity': uidvalidity, 'uid': 0, 'modseq': None}
+            ids = self.search_messages(self.state_backend.unprocessed)
+        else:
+            criteria = ['UID', '%s:*' % (state['uid'] + 1)]
+            if modseq is not None and state['modseq'] is not None:
+                criteria = ['OR'] + criteria + ['MODSEQ', state['modseq'] + 1]
+            ids = self.search_messages(criteria +
+                                       self.state_backend.unprocessed)
+            ids = sorted(set(ids).union(self.reset_ids))
+
+        # all the messages below UIDNEXT are processed by this run, unless
+        # ``max_messages`` is reached (see ``get_limited_message_ids``)
+        uid = max([state['uid']] + list(ids))
+        if uidnext is not None:
+            uid = max(uid, uidnext - 1)
+        self.sync_state = {'uidvalidity': uidvalidity, 'uid': uid,
+                           'modseq': modseq}
+        return ids
+
+    def save_sync_state(self):
+        """Save the state of the run, now that its messages are processed."""
+        sync_state, self.sync_state = self.sync_state, None
+        if sync_state is not None:
+            self.state_store.set(self.get_state_key(), sync_state)
+
+    def get_limited_message_ids(self):
+        """Return the IDs of messages to process, at most ``max_messages``."""
+        with self.metrics.timer('stage_seconds', stage='search'):
+            ids = self.get_message_ids()
+        if self.max_messages is not None and len(ids) > self.max_messages:
+            ids = sorted(ids)
+            if self.sync_state is not None:
+                # the next run must search the messages left over
+                self.sync_state['uid'] = ids[self.max_messages] - 1
+            ids = ids[:self.max_messages]
+        return ids
 
     def get_messages(self):
         """Return the list of messages to process."""
-        ids = self.get_message_ids()
-        return self.client.fetch(ids, ['RFC822'])
+        ids = self.get_limited_message_ids()
+        return self.fetch_messages(ids, [self.state_backend.fetch_item])
+
+    def fetch_messages(self, ids, items):
+        """Fetch the items of the messages, reporting the fetch metrics."""
+        with self.metrics.timer('stage_seconds', stage='fetch'):
+            messages = self.client.fetch(ids, items)
+        if self.metrics.enabled:
+            if self.state_backend.fetch_item in items:  # full mails
+                self.metrics.increment('messages_fetched', len(messages))
+            self.metrics.increment('bytes_downloaded', sum(
+                len(value) for msg in messages.values()
+                for value in msg.values()
+                if isinstance(value, string_types + (bytes,))))
+        return messages
+
+    def get_fetch_batches(self, ids):
+        """Split the list of IDs in batches honoring the fetch limits."""
+        if not self.fetch_bytes:
+            return chunks(ids, self.fetch_size)
+
+        sizes = self.client.fetch(ids, ['RFC822.SIZE'])
+        batches = []
+        batch, batch_bytes = [], 0
+        for msg_id in ids:
+            if msg_id not in sizes:  # deleted in the meantime
+                continue
+            size = get_response_item(sizes[msg_id], 'RFC822.SIZE')
+            full = self.fetch_size and len(batch) >= self.fetch_size
+            if batch and (full or batch_bytes + size > self.fetch_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(msg_id)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def iter_messages(self):
+        """Yield the (uid, message) to process, one at a time.
+
+        Unless ``fetch_size``, ``fetch_bytes`` or ``header_first`` is set, this
+        simply iterates over ``get_messages``. Otherwise, mails are downloaded
+        by batches, and only the current batch is kept in memory.
+
+        """
+        if not (self.fetch_size or self.fetch_bytes or self.header_first):
+            for uid, msg in self.get_messages().items():
+                yield uid, msg
+            return
+
+        ids = sorted(self.get_limited_message_ids())
+        for batch in self.get_fetch_batches(ids):
+            if self.header_first:
+                messages = self.fetch_needed_bodies(batch)
+            else:
+                messages = self.fetch_messages(
+                    batch, [self.state_backend.fetch_item])
+            for uid in batch:
+                msg = messages.pop(uid, None)
+                if msg is not None:  # deleted in the meantime
+                    yield uid, msg
+
+    def iter_matched(self, messages):
+        """Yield the (uid, message), matched ahead in the ``match_pool``.
+
+        The ``Future`` of the matches of each message is added to it, in its
+        MATCHES item. The messages following the one yielded (twice as many
+        as workers) are being matched in the meantime.
+
+        """
+        if self.match_pool is None:
+            self.match_pool = MatchPool(self.get_callbacks(),
+                                        self.match_workers)
+        pending = deque()
+        for uid, msg in messages:
+            msg = dict(msg)
+            msg[MATCHES] = self.match_pool.submit(get_raw_mail(msg))
+            pending.append((uid, msg))
+            if len(pending) > 2 * self.match_pool.workers:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+    def fetch_needed_bodies(self, ids):
+        """Fetch the headers, and the full mails only if they are needed.
+
+        Mails for which ``needs_body`` is False are returned with their
+        headers only, in the 'BODY[HEADER]' item instead of 'RFC822'.
+
+        """
+        messages = self.fetch_messages(ids, ['BODY.PEEK[HEADER]'])
+        needed = [uid for uid in ids if uid in messages and self.needs_body(
+            ParsedMessage(get_response_item(messages[uid], 'BODY[HEADER]')))]
+        if needed:
+            messages.update(self.fetch_messages(
+                needed, [self.state_backend.fetch_item]))
+        return messages
+
+    def needs_body(self, message):
+        """Does any callback need the body of this (headers only) message?
+
+        This is the case if the header rules of a callback match, and this
+        callback either has a rule on the body, or its ``needs_body``
+        attribute is True (the default). With a ``retry_queue``, a failure
+        while checking the rules downloads the full mail, for the failure to
+        be handled when processing it.
+
+        """
+        if self.retry_queue is None:
+            return self.check_needs_body(message)
+        try:
+            return self.check_needs_body(message)
+        except Exception:
+            return True
+
+    def check_needs_body(self, message):
+        rules_index = self.get_rules_index()
+        matcher = rules_index.matcher(message)
+        for callback_class, rules in self.get_callbacks().items():
+            rules = rules_index.get(callback_class, rules)
+            if 'body' not in rules and not getattr(callback_class,
+                                                   'needs_body', True):
+                continue
+            if not matcher.may_match(callback_class, headers_only=True):
+                continue
+            header_rules = dict((item, regexps)
+                                for item, regexps in rules.items()
+                                if item != 'body')
+            if callback_class(message, header_rules).check_rules():
+                return True
+        return False
 
     def process_message(self, message, callback_class, rules):
-        """Check if callback matches rules, and if so, trigger."""
+        """Check if callback matches rules, and if so, trigger.
+
+        If MailBot has an executor, the callback is triggered in the executor
+        and a ``Future`` is returned.
+
+        With a ``retry_queue``, a failure while checking the rules is handled
+        like a failure of the callback (see ``trigger``).
+
+        """
         callback = callback_class(message, rules)
-        if callback.check_rules():
-            return callback.trigger()
+        try:
+            if self.metrics.enabled:
+                return self.process_message_measured(callback)
+            if callback.check_rules():
+                return self.trigger(callback)
+        except Exception as error:
+            if self.retry_queue is None:
+                raise
+            self.trigger_failed(callback, error)
+
+    def process_message_measured(self, callback):
+        """Same as ``process_message``, reporting the callback metrics."""
+        name = type(callback).__name__
+        with self.metrics.timer('callback_seconds', callback=name,
+                                step='rules'):
+            matched = callback.check_rules()
+        for item, reason in getattr(callback, 'over_budget', ()):
+            self.metrics.increment('rules_over_budget', callback=name,
+                                   item=item, reason=reason)
+        if not matched:
+            return None
+        self.metrics.increment('messages_matched', callback=name)
+        if self.executor is None:
+            with self.metrics.timer('callback_seconds', callback=name,
+                                    step='trigger'):
+                return self.trigger(callback)
+        start = default_timer()
+        future = self.trigger(callback)
+
+        def done(future):  # the duration includes the wait in the executor
+            self.metrics.observe('callback_seconds', default_timer() - start,
+                                 callback=name, step='trigger')
+        future.add_done_callback(done)
+        return future
+
+    def trigger(self, callback):
+        """Trigger the callback, or submit it to the executor, if any.
+
+        Failures are reported to ``trigger_failed``. With a ``retry_queue``,
+        the exception is then swallowed, the callback being retried later.
+
+        """
+        if self.executor is not None:
+            future = self.executor.submit(trigger_callback, callback)
+            if (self.retry_queue is not None or self.ledger is not None or
+                    self.metrics.enabled):
+                future.add_done_callback(partial(self.trigger_done, callback))
+            return future
+        try:
+            result = callback.trigger()
+        except Exception as error:
+            self.trigger_failed(callback, error)
+            if self.retry_queue is None:
+                raise
+        else:
+            self.trigger_succeeded(callback)
+            return result
+
+    def trigger_done(self, callback, future):
+        error = future.exception()
+        if error is not None:
+            self.trigger_failed(callback, error)
+        else:
+            self.trigger_succeeded(callback)
+
+    def trigger_succeeded(self, callback):
+        """Record the callback done for the mail in the ``ledger``."""
+        uid = getattr(callback.message, 'uid', None)
+        if self.ledger is None or uid is None:
+            return
+        self.ledger.add(self.get_state_key(), self.uidvalidity, uid,
+                        callback.message['Message-ID'],
+                        get_callback_name(type(callback)))
+
+    def trigger_failed(self, callback, error):
+        """Report the failure, and add the callback to the retry queue."""
+        callback_class = type(callback)
+        self.metrics.increment('messages_failed',
+                               callback=callback_class.__name__)
+        if self.retry_queue is None:
+            return
+        logger.warning("Callback %s failed, will retry",
+                       callback_class.__name__, exc_info=error)
+        message = callback.message
+        raw = getattr(message, 'raw', None)
+        if raw is None:  # not a lazy ParsedMessage
+            raw = message.as_string()
+        self.retry_queue.add(self.get_state_key(),
+                             get_callback_name(callback_class), raw,
+                             message['Message-ID'], describe(error),
+                             getattr(message, 'uid', None), self.uidvalidity,
+                             getattr(message, 'headers_only', False))
+
+    def retry_callbacks(self):
+        """Trigger again the callbacks of the ``retry_queue`` due now.
+
+        Only the failed callback is checked and triggered again, and
+        recorded in the ``ledger``, if any, once done. If it isn't registered
+        anymore, the entry is moved to the dead letters.
+
+        The parts of a mail downloaded with its headers only are fetched
+        from the server again, by UID: if the UIDVALIDITY of the folder
+        changed, the entry is moved to the dead letters.
+
+        """
+        callbacks = dict((get_callback_name(callback_class),
+                          (callback_class, rules))
+                         for callback_class, rules
+                         in self.get_callbacks().items())
+        rules_index = self.get_rules_index()
+        for entry in self.retry_queue.get_due(self.get_state_key()):
+            if entry.callback not in callbacks:
+                self.retry_queue.give_up(entry.id, 'Unknown callback')
+                continue
+            message = ParsedMessage(entry.raw)
+            message.uid = entry.uid
+            if entry.headers_only:
+                if entry.uid is None or entry.uidvalidity != self.uidvalidity:
+                    self.retry_queue.give_up(entry.id, 'UIDVALIDITY changed')
+                    continue
+                message.headers_only = True
+                message.fetcher = PartFetcher(self.client, entry.uid)
+            callback_class, rules = callbacks[entry.callback]
+            callback = callback_class(message,
+                                      rules_index.get(callback_class, rules))
+            try:
+                if callback.check_rules():
+                    callback.trigger()
+            except Exception as error:
+                self.metrics.increment('messages_failed',
+                                       callback=callback_class.__name__)
+                if self.retry_queue.failed(entry.id, describe(error)):
+                    logger.error("Callback %s failed %s times, giving up",
+                                 callback_class.__name__, entry.attempts + 1,
+                                 exc_info=error)
+            else:
+                self.retry_queue.done(entry.id)
+                if self.ledger is not None and entry.uid is not None:
+                    self.ledger.add(self.get_state_key(), entry.uidvalidity,
+                                    entry.uid, entry.message_id,
+                                    entry.callback)
+
+    def process_callbacks(self, msg, uid=None):
+        """Check the fetched message against each registered callback.
+
+        With a ``ledger``, the callbacks already done for the message of this
+        UID are skipped. With a ``retry_queue``, a failure of a callback (or of
+        its rules) goes to the queue, and a message which can't be processed
+        at all goes to its dead letters: the processing goes on.
+
+        Unless the callbacks are triggered in an executor, they may fetch the
+        attachments of a message downloaded with its headers only (see
+        ``Callback.get_attachments``).
+
+        Return the list of the ``Future`` of the callbacks triggered in the
+        executor, if any.
+
+        """
+        try:
+            # shared by all the callbacks, so each item is only decoded once,
+            # and the mail is only parsed as far as the callbacks need it
+            message = ParsedMessage(get_raw_mail(msg))
+            message.uid = uid
+            message.headers_only = is_headers_only(msg)
+            if self.executor is None and uid is not None:
+                # the connection can't be shared with the executor
+                message.fetcher = PartFetcher(self.client, uid)
+            completed = self.get_completed(message)
+            if MATCHES in msg:  # already matched in the match pool
+                return self.process_matches(message, msg[MATCHES], completed)
+            candidates = list(self.get_rules_index().candidates(
+                self.get_callbacks(), message))
+        except Exception as error:
+            if self.retry_queue is None:
+                raise
+            self.message_failed(msg, uid, error)
+            return []
+        futures = []
+        for callback_class, rules in candidates:
+            if self.is_completed(callback_class, completed, uid):
+                continue
+            result = self.process_message(message, callback_class, rules)
+            if self.executor is not None and result is not None:
+                futures.append(result)
+        return futures
+
+    def message_failed(self, msg, uid, error):
+        """Move a message which can't be processed to the dead letters."""
+        logger.error("Message %s can't be processed, giving up", uid,
+                     exc_info=error)
+        self.metrics.increment('messages_failed', callback=MESSAGE)
+        raw = get_raw_mail(msg)
+        if raw is None:
+            raw = b''
+        self.retry_queue.add_dead_letter(self.get_state_key(), MESSAGE, raw,
+                                         error=describe(error), uid=uid,
+                                         uidvalidity=self.uidvalidity,
+                                         headers_only=is_headers_only(msg))
+
+    def process_matches(self, message, matches_future, completed):
+        """Trigger the callbacks matched by the ``match_pool``.
+
+        A callback whose rules failed in the worker raises a ``RulesError``,
+        or, with a ``retry_queue``, is handled like a failure of the callback
+        (see ``trigger``): the other callbacks are still triggered.
+
+        Return the list of the ``Future`` of the callbacks triggered in the
+        executor, if any.
+
+        """
+        with self.metrics.timer('stage_seconds', stage='match'):
+            results = matches_future.result()
+        rules_index = self.get_rules_index()
+        futures = []
+        for index, matches, over_budget, error in results:
+            callback_class, rules = self.match_pool.get_callback(index)
+            name = callback_class.__name__
+            for item, reason in over_budget:
+                self.metrics.increment('rules_over_budget', callback=name,
+                                       item=item, reason=reason)
+            if error is not None:
+                if self.retry_queue is None:
+                    raise RulesError(error)
+                callback = callback_class(
+                    message, rules_index.get(callback_class, rules))
+                self.trigger_failed(callback, RulesError(error))
+                continue
+            if matches is None or self.is_completed(callback_class,
+                                                    completed, message.uid):
+                continue
+            self.metrics.increment('messages_matched', callback=name)
+            callback = callback_class(message,
+                                      rules_index.get(callback_class, rules))
+            callback.matches.update(matches)
+            result = self.trigger(callback)
+            if self.executor is not None and result is not None:
+                futures.append(result)
+        return futures
+
+    def is_completed(self, callback_class, completed, uid):
+        """Is the callback in the ``completed`` ones, see ``get_completed``?"""
+        if not completed or get_callback_name(callback_class) not in completed:
+            return False
+        logger.info("Callback %s already done for message %s",
+                    callback_class.__name__, uid)
+        self.metrics.increment('callbacks_skipped',
+                               callback=callback_class.__name__)
+        return True
+
+    def get_completed(self, message):
+        """Return the names of the callbacks done for the message."""
+        if self.ledger is None or message.uid is None:
+            return ()
+        return self.ledger.get_completed(self.get_state_key(),
+                                         self.uidvalidity, message.uid,
+                                         message['Message-ID'])
 
     def process_messages(self):
-        """Process messages: check which callbacks should be triggered."""
-        from . import CALLBACKS_MAP
-        self.reset_timeout_messages()
-        messages = self.get_messages()
+        """Process messages: check which callbacks should be triggered.
 
-        for uid, msg in messages.items():
-            self.mark_processing(uid)
-            message = message_from_string(msg['RFC822'])
-            for callback_class, rules in CALLBACKS_MAP.items():
-                self.process_message(message, callback_class, rules)
-            self.mark_processed(uid)
+        If MailBot has an executor, a message is only marked as processed once
+        all its triggered callbacks are done, and no more than
+        ``max_pending`` messages are waiting for their callbacks to be done.
+
+        Return the number of messages processed.
+
+        """
+        with self.metrics.timer('stage_seconds', stage='reset'):
+            self.reset_timeout_messages()
+        if self.retry_queue is not None:
+            with self.metrics.timer('stage_seconds', stage='retry'):
+                self.retry_callbacks()
+        self.sync_state = None
+        processed = 0
+        pending = []  # (uids, futures) waiting to be marked processed
+        messages = self.iter_messages()
+        if self.match_workers:
+            messages = self.iter_matched(messages)
+        for batch in chunks(messages, self.batch_size or 1):
+            uids = [uid for uid, msg in batch]
+            processed += len(uids)
+            self.claim(uids)
+            futures = []
+            for uid, msg in batch:
+                with self.metrics.timer('stage_seconds', stage='process'):
+                    futures.extend(self.process_callbacks(msg, uid))
+            pending.append((uids, futures))
+
+            done = [(uids, futures) for uids, futures in pending
+                    if all(future.done() for future in futures)]
+            for uids, futures in done:
+                pending.remove((uids, futures))
+                self.complete(uids, futures)
+            # backpressure: wait for the workers to catch up
+            while sum(len(uids) for uids, futures in pending) > \
+                    self.max_pending:
+                self.complete(*pending.pop(0))
+        for uids, futures in pending:
+            self.complete(uids, futures)
+        self.save_sync_state()
+        if self.ledger is not None:
+            self.ledger.compact()
+        return processed
+
+    def claim(self, uids):
+        """Mark the messages as being processed, one by one or by batch."""
+        if self.fast_reset:
+            now = time()
+            self.leases.update((uid, now) for uid in uids)
+        with self.metrics.timer('stage_seconds', stage='mark'):
+            if self.batch_size:
+                self.mark_processing_batch(uids)
+            else:
+                for uid in uids:
+                    self.mark_processing(uid)
+
+    def complete(self, uids, futures=()):
+        """Wait for the callbacks to be done, then mark messages processed."""
+        for future in futures:
+            if self.retry_queue is None:
+                future.result()  # raise the callback exception, if any
+            else:  # wait, the failures go to the retry queue
+                future.exception()
+        with self.metrics.timer('stage_seconds', stage='mark'):
+            if self.batch_size:
+                self.mark_processed_batch(uids)
+            else:
+                for uid in uids:
+                    self.mark_processed(uid)
+        if self.fast_reset:
+            for uid in uids:
+                self.leases.pop(uid, None)
 
     def reset_timeout_messages(self):
-        """Remove the \\Flagged and \\Seen flags from mails that are too old.
+        """Reset the state of the mails processing for too long.
 
         This makes sure that no mail stays in a processing state without
         actually being processed. This could happen if a callback timeouts,
@@ -75,22 +926,185 @@ class MailBot(object):
         if self.timeout is None:
             return
 
-        ids = self.client.search(['Flagged', 'Seen'])
-        messages = self.client.fetch(ids, ['INTERNALDATE'])
+        to_reset = self.get_timeout_ids()
+        if to_reset:
+            self.state_backend.reset(self.client, to_reset)
+        self.reset_ids = to_reset  # maybe below the saved UID
+
+    def get_timeout_ids(self):
+        """Return the IDs of the mails in a processing state for too long.
+
+        By default, the INTERNALDATE of all the mails in a processing state
+        is fetched, to compare it to the ``timeout``.
+
+        If ``fast_reset`` is True, the mails older than the timeout by more
+        than a day are found with a date search, without fetching anything,
+        and only the INTERNALDATE of the more recent ones is fetched. The
+        mails claimed by this MailBot are also reset if their lease (the time
+        they were claimed) is older than the timeout, and never reset before
+        that.
 
+        """
         # compare datetimes without tzinfo, as UTC
         date_pivot = datetime.utcnow() - timedelta(seconds=self.timeout)
-        to_reset = [msg_id for msg_id, data in messages.items()
-                    if data['INTERNALDATE'].replace(tzinfo=None) < date_pivot]
+        if not self.fast_reset:
+            ids = self.client.search(self.state_backend.processing)
+            return self.filter_older(ids, date_pivot)
 
-        if to_reset:
-            self.client.remove_flags(to_reset, ['\\Flagged', '\\Seen'])
+        # the date searches disregard the time and the timezone: one more day
+        day = date_pivot.date() - timedelta(days=1)
+        processing = self.state_backend.processing
+        expired = set(self.client.search(processing + ['BEFORE', day]))
+        recent = self.client.search(processing + ['SINCE', day])
+        expired.update(self.filter_older(recent, date_pivot))
+
+        lease_pivot = time() - self.timeout
+        for uid, claimed in list(self.leases.items()):
+            if claimed < lease_pivot:
+                expired.add(uid)
+                del self.leases[uid]
+            else:  # still being processed
+                expired.discard(uid)
+        return sorted(expired)
+
+    def filter_older(self, ids, date_pivot):
+        """Return the IDs of the mails received before the date pivot."""
+        if not ids:
+            return []
+        messages = self.client.fetch(ids, ['INTERNALDATE'])
+        return [msg_id for msg_id, data in messages.items()
+                if data['INTERNALDATE'].replace(tzinfo=None) < date_pivot]
 
     def mark_processing(self, uid):
         """Mark the message corresponding to uid as being processed."""
-        self.client.add_flags([uid], ['\\Flagged', '\\Seen'])
+        self.state_backend.mark_processing(self.client, [uid])
 
     def mark_processed(self, uid):
         """Mark the message corresponding to uid as processed."""
-        self.client.remove_flags([uid], ['\\Flagged'])
-        self.client.add_flags([uid], ['\\Seen'])
+        self.state_backend.mark_processed(self.client, [uid])
+
+    def mark_skipped(self, uids):
+        """Mark the messages which can't match any callback as processed."""
+        if uids:
+            self.state_backend.mark_skipped(self.client, uids)
+
+    def adopt_messages(self, criteria=None):
+        """Mark the messages already in the folder as processed.
+
+        Meant for switching an existing folder to another ``state_backend``:
+        the messages matching the search ``criteria`` (by default, the ones
+        \\Seen and not \\Flagged, processed according to the default
+        backend) are marked as processed, without triggering any callback.
+        Return the number of messages adopted.
+
+        """
+        if criteria is None:
+            criteria = SEEN
+        uids = self.client.search(list(criteria) +
+                                  self.state_backend.unprocessed)
+        self.mark_skipped(uids)
+        return len(uids)
+
+    def mark_processing_batch(self, uids):
+        """Mark all the messages corresponding to uids as being processed."""
+        if uids:
+            self.state_backend.mark_processing(self.client, uids)
+
+    def mark_processed_batch(self, uids):
+        """Mark all the messages corresponding to uids as processed.
+
+        The messages were marked as processing by ``mark_processing_batch``:
+        with the default backend, removing the \\Flagged flag is enough.
+
+        """
+        if uids:
+            self.state_backend.mark_processed_batch(self.client, uids)
+
+    def run_forever(self):
+        """Process messages as soon as they're received, until ``stop``.
+
+        Messages are first processed, then MailBot waits for new messages
+        using IMAP IDLE (or NOOP polling if the server doesn't support IDLE),
+        and processes them as soon as they're received.
+
+        If the connection is lost, MailBot reconnects, waiting for
+        ``reconnect_delay`` seconds, doubled on each failed attempt, up to
+        ``max_reconnect_delay`` seconds.
+
+        """
+        stopping = self._stopping = self._stopping or Event()
+        delay = self.reconnect_delay
+        try:
+            while not stopping.is_set():
+                try:
+                    self.process_messages()
+                    delay = self.reconnect_delay  # connection is fine
+                    while not stopping.is_set():
+                        new_messages = self.wait_for_messages()
+                        # also reset the timed out messages from time to time
+                        if new_messages or self.timeout is not None:
+                            self.process_messages()
+                except self.connection_errors:
+                    logger.warning("Connection lost, reconnecting in %ss",
+                                   delay, exc_info=True)
+                    if stopping.wait(delay):
+                        break
+                    delay = min(delay * 2, self.max_reconnect_delay)
+                    try:
+                        self.reconnect()
+                    except self.connection_errors:
+                        logger.warning("Reconnection failed", exc_info=True)
+        finally:
+            self._stopping = None
+            self.disconnect()
+
+    def stop(self):
+        """Ask ``run_forever`` to return as soon as possible."""
+        self._stopping = self._stopping or Event()
+        self._stopping.set()
+
+    def pop_new_messages(self):
+        """Return True if new messages were notified since the last call.
+
+        The server may notify a new message (with an untagged EXISTS
+        response) along the response of any command, like the SEARCH, FETCH
+        or STORE of ``process_messages``: imaplib keeps those responses, which
+        ``idle_check`` and ``noop`` don't return. They're removed, so each one
+        is only seen once.
+
+        """
+        imap = getattr(self.get_client(), '_imap', None)
+        if imap is None:
+            return False
+        return bool(imap.untagged_responses.pop('EXISTS', None))
+
+    def wait_for_messages(self):
+        """Wait for new messages, return True if some were received.
+
+        Return True straight away if new messages were notified during the
+        previous commands (see ``pop_new_messages``). Return False after
+        ``idle_timeout`` seconds (or ``poll_interval`` seconds for servers
+        without IDLE), or if ``stop`` was called.
+
+        """
+        if self.pop_new_messages():
+            return True
+        stopping = self._stopping or Event()
+        if not self.client.has_capability('IDLE'):
+            stopping.wait(self.poll_interval)
+            if stopping.is_set():
+                return False
+            return has_new_messages(self.client.noop()[1])
+
+        deadline = time() + self.idle_timeout
+        new_messages = False
+        self.client.idle()
+        try:
+            while (not new_messages and not stopping.is_set() and
+                   time() < deadline):
+                new_messages = has_new_messages(
+                    self.client.idle_check(timeout=self.stop_latency))
+        finally:
+            # the messages notified before the end of the IDLE
+            responses = self.client.idle_done()[1]
+        return new_messages or has_new_messages(responses)
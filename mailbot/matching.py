@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Parse the mails and check the rules in a pool of worker processes.
+
+With many callbacks and large mails, parsing the mails and checking the rules
+keeps a single core busy. When a MailBot has ``match_workers``, the raw mails
+are sent to a ``MatchPool`` instead: each worker parses the mail, checks the
+rules of all the callbacks, and only sends back the callbacks matching, with
+their ``matches``. The callbacks are then triggered, and the mails flagged, by
+MailBot in the main process.
+
+The callbacks and their rules are sent to the workers (and their rules
+compiled) once, when the pool starts: the callback classes must be defined at
+the module level, and their ``check_rules`` is called in the workers. This
+needs python 3.7+ (for the ``initializer`` of the ``ProcessPoolExecutor``).
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import warnings
+
+from .exceptions import RegexpWarning
+from .message import ParsedMessage
+from .retry import describe
+from .rules import RulesIndex
+
+
+WORKER = {}  # the callbacks and their compiled rules, in a worker
+SUPPORTED = sys.version_info >= (3, 7)
+
+
+def check_supported():
+    """Raise a ValueError if the match pool can't run on this python."""
+    if not SUPPORTED:
+        raise ValueError("The match pool (match_workers) needs python 3.7+")
+
+
+def init_worker(callbacks):
+    """Compile the rules of the list of (callback_class, rules) once."""
+    rules_index = RulesIndex()
+    with warnings.catch_warnings():  # already reported by the main process
+        warnings.simplefilter('ignore', RegexpWarning)
+        for callback_class, rules in callbacks:
+            rules_index.add(callback_class, rules or {})
+    WORKER['callbacks'] = callbacks
+    WORKER['rules_index'] = rules_index
+
+
+def match_message(raw):
+    """Check the raw mail against the rules of the callbacks of the worker.
+
+    Return a list of (index of the callback, matches, over budget rules,
+    error) for the callbacks matching, with rules over budget, or whose rules
+    raised an exception. The matches are None if the callback doesn't match,
+    and the error is the description of the exception, if any: the other
+    callbacks are still checked.
+
+    """
+    callbacks = WORKER['callbacks']
+    rules_index = WORKER['rules_index']
+    message = ParsedMessage(raw)
+    matcher = rules_index.matcher(message)
+    results = []
+    for index, (callback_class, rules) in enumerate(callbacks):
+        if not matcher.may_match(callback_class):
+            continue
+        callback = callback_class(message, rules_index.get(callback_class,
+                                                           rules))
+        try:
+            matched = callback.check_rules()
+        except Exception as error:
+            results.append((index, None, [], describe(error)))
+            continue
+        over_budget = getattr(callback, 'over_budget', [])
+        if matched or over_budget:
+            results.append((index, dict(callback.matches) if matched else None,
+                            over_budget, None))
+    return results
+
+
+class MatchPool(object):
+    """Pool of ``workers`` processes (the number of CPUs by default).
+
+    The callbacks are a dict of {callback_class: rules}, see
+    ``MailBot.get_callbacks``.
+
+    """
+
+    def __init__(self, callbacks, workers=None):
+        check_supported()
+        from concurrent.futures import ProcessPoolExecutor
+        self.callbacks = list(callbacks.items())
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=init_worker,
+                                            initargs=(self.callbacks,))
+
+    def submit(self, raw):
+        """Return the ``Future`` of the ``match_message`` of the raw mail."""
+        return self.executor.submit(match_message, raw)
+
+    def get_callback(self, index):
+        """Return the (callback_class, rules) of this index."""
+        return self.callbacks[index]
+
+    def shutdown(self):
+        self.executor.shutdown()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+from email.header import decode_header
+
+from .compat import string_types, text_type, encoded_padding
+from .mime import find_text_part, parse_mail, parse_mail_headers
+
+
+def decode_8bit(data):
+    """Decode raw 8-bit text of unknown charset: UTF-8, or else latin-1."""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def decode_chunk(chunk, encoding):
+    """Decode a chunk of a header, whatever its (declared) encoding."""
+    if isinstance(chunk, text_type):
+        return chunk
+    # raw 8-bit headers (not RFC 2047 encoded) are 'unknown-8bit'
+    if encoding in (None, 'unknown-8bit'):
+        return decode_8bit(chunk)
+    try:
+        return chunk.decode(encoding)
+    except LookupError:  # unknown charset
+        return decode_8bit(chunk)
+    except UnicodeDecodeError:
+        return chunk.decode(encoding, 'replace')
+
+
+def decode_header_value(value):
+    """Decode the header (might be encoded as latin-1, utf-8...)."""
+    return encoded_padding.join(decode_chunk(chunk, encoding)
+                                for chunk, encoding in decode_header(value))
+
+
+def get_text_body(message):
+    """Return the first 'text/plain' part of the message without filename."""
+    for part in message.walk():
+        content_type = part.get_content_type()
+        filename = part.get_filename()
+        if content_type == 'text/plain' and filename is None:
+            # text body of the mail, not an attachment
+            encoding = part.get_content_charset()
+            content = part.get_payload()
+            if not isinstance(content, text_type):
+                content = part.get_payload(decode=True)
+                if encoding is None:
+                    return decode_8bit(content)
+                return content.decode(encoding)
+            if encoding is None and u'\ufffd' in content:
+                # raw 8-bit text without charset, parsed from bytes: the
+                # email package replaced it, get the bytes back
+                return decode_8bit(part.get_payload(decode=True))
+            return content
+
+    return ''
+
+
+class ParsedMessage(object):
+    """Wrap an ``email.Message``, decoding each of its items only once.
+
+    All the callbacks checked against a mail share the same ParsedMessage,
+    which behaves like the wrapped ``email.Message``.
+
+    The raw mail (str or bytes) may be given instead of the ``email.Message``:
+    it is then parsed lazily, and bytes are never decoded as a whole. The
+    headers are parsed on their own, the text body is found without parsing
+    the attachments, and the whole mail is only parsed if the wrapped
+    ``email.Message`` is needed.
+
+    MailBot sets the ``uid`` of the mail in the folder, if known. If only the
+    headers of the mail were downloaded, ``headers_only`` is True, and its
+    attachments are fetched with its ``fetcher`` (see
+    ``mailbot.attachments``), if any.
+
+    """
+    uid = None
+    headers_only = False
+    fetcher = None
+    bodystructure = None  # fetched on demand, with the fetcher
+
+    def __init__(self, message):
+        self.raw = None
+        if isinstance(message, string_types + (bytes,)):
+            self.raw, message = message, None
+        self._message = message
+        self._headers = None
+        self.headers = {}
+        self.body = None
+
+    def __getattr__(self, name):
+        if '_message' not in self.__dict__:  # eg when unpickling
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+    @property
+    def message(self):
+        """The wrapped ``email.Message``, parsed on first access."""
+        if self._message is None:
+            self._message = parse_mail(self.raw)
+        return self._message
+
+    def get_headers(self):
+        """Return an ``email.Message`` with (at least) the mail headers."""
+        if self._message is not None:
+            return self._message
+        if self._headers is None:
+            self._headers = parse_mail_headers(self.raw)
+        return self._headers
+
+    def __getitem__(self, name):
+        return self.get_headers()[name]
+
+    def __contains__(self, name):
+        return name in self.get_headers()
+
+    def __iter__(self):
+        return iter(self.get_headers())
+
+    def __len__(self):
+        return len(self.get_headers())
+
+    def __str__(self):
+        return str(self.message)
+
+    def get_header(self, name):
+        """Return the decoded header, or None if it's not found."""
+        if name not in self.headers:
+            value = self.get_headers()[name]
+            if value is not None:
+                value = decode_header_value(value)
+            self.headers[name] = value
+        return self.headers[name]
+
+    def get_body(self):
+        """Return the decoded text body."""
+        if self.body is None:
+            if self._message is not None:
+                self.body = get_text_body(self._message)
+            else:
+                self.body = self.get_lazy_body()
+        return self.body
+
+    def get_lazy_body(self):
+        """Return the decoded text body, only parsing its own part."""
+        span = find_text_part(self.raw)
+        if span is None:
+            return ''
+        start, end = span
+        if (start, end) == (0, len(self.raw)):  # the whole mail is needed
+            return get_text_body(self.message)
+        return get_text_body(parse_mail(self.raw[start:end]))
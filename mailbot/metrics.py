@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Instrumentation of MailBot: counters and latency histograms.
+
+MailBot reports its metrics to its ``metrics`` object, a NullMetrics by
+default, which discards everything: MailBot then skips the instrumentation
+altogether. Use a Metrics to collect them in memory (and export them in the
+Prometheus text format), or a StatsDMetrics to also send them to a StatsD
+server. Any object with the same methods may be used.
+
+The metrics reported by MailBot are:
+
+* counters: ``messages_fetched``, ``bytes_downloaded``, ``messages_matched``,
+  ``messages_failed`` and ``callbacks_skipped`` (by ``callback``),
+  ``rules_over_budget`` (by ``callback``, ``item`` and ``reason``: length,
+  timeout), ``imap_commands`` (by ``command``)
+* histograms, in seconds: ``stage_seconds`` (by ``stage``: reset, retry,
+  search, fetch, match, process, mark) and ``callback_seconds`` (by
+  ``callback`` and ``step``: rules, trigger)
+
+"""
+
+from __future__ import absolute_import
+
+import re
+import socket
+from bisect import bisect_left
+from threading import Lock
+from timeit import default_timer
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class Timer(object):
+    """Context manager observing the time spent in its block."""
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, default_timer() - self.start,
+                             **self.labels)
+
+
+NULL_TIMER = NullTimer()
+
+
+class NullMetrics(object):
+    """Discard all the metrics (the default)."""
+    enabled = False
+
+    def increment(self, name, value=1, **labels):
+        """Increment the counter by ``value``."""
+
+    def observe(self, name, value, **labels):
+        """Add the value (a duration in seconds) to the histogram."""
+
+    def timer(self, name, **labels):
+        """Return a context manager observing the duration of its block."""
+        return NULL_TIMER
+
+
+class Metrics(NullMetrics):
+    """Collect the metrics in memory (thread safe)."""
+    enabled = True
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5, 10)
+
+    def __init__(self, prefix='mailbot', buckets=None):
+        self.prefix = prefix
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self.lock = Lock()
+        self.counters = {}  # (name, labels): value
+        self.histograms = {}  # (name, labels): [count per bucket, sum]
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * (len(self.buckets) + 1), 0]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def get_counter(self, name, **labels):
+        """Return the value of the counter, 0 if it was never incremented."""
+        with self.lock:
+            return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def get_histogram(self, name, **labels):
+        """Return the (count, sum) of the observed values."""
+        with self.lock:
+            histogram = self.histograms.get(
+                (name, tuple(sorted(labels.items()))))
+            if histogram is None:
+                return 0, 0
+            return sum(histogram[0]), histogram[1]
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, [list(counts), total])
+                                for key, (counts, total)
+                                in self.histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            name = '%s_%s_total' % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), (counts, total) in histograms:
+            name = '%s_%s' % (self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulated = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulated += count
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', str(bound)),)),
+                    cumulated))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels),
+                                          float(total)))
+            lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                            cumulated))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+class StatsDMetrics(Metrics):
+    """Collect the metrics, and send each of them to a StatsD server.
+
+    The metrics are sent over UDP, without waiting for (or caring about) the
+    server. The values of the labels are appended to the metric names, eg
+    ``mailbot.messages_matched.MyCallback``.
+
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='mailbot',
+                 buckets=None):
+        super(StatsDMetrics, self).__init__(prefix, buckets)
+        family, _, _, _, self.address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_DGRAM)[0]
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+
+    def get_name(self, name, labels):
+        return '.'.join([self.prefix, name] + [
+            re.sub(r'[^\w-]', '_', str(value))
+            for _, value in sorted(labels.items())])
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except socket.error:  # metrics must never break the processing
+            pass
+
+    def increment(self, name, value=1, **labels):
+        super(StatsDMetrics, self).increment(name, value, **labels)
+        self.send('%s:%s|c' % (self.get_name(name, labels), value))
+
+    def observe(self, name, value, **labels):
+        super(StatsDMetrics, self).observe(name, value, **labels)
+        self.send('%s:%.3f|ms' % (self.get_name(name, labels), value * 1000))
+
+
+class InstrumentedClient(object):
+    """Wrap an IMAPClient, counting the ``imap_commands`` sent through it."""
+    commands = frozenset([
+        'login', 'logout', 'select_folder', 'search', 'fetch', 'add_flags',
+        'remove_flags', 'set_flags', 'get_flags', 'noop', 'idle',
+        'idle_done', 'enable', 'expunge'])
+
+    def __init__(self, client, metrics):
+        self.__dict__['client'] = client
+        self.__dict__['metrics'] = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name not in self.commands:
+            return attribute
+
+        def command(*args, **kwargs):
+            self.metrics.increment('imap_commands', command=name)
+            return attribute(*args, **kwargs)
+        return command
+
+    def __setattr__(self, name, value):  # eg normalise_times
+        setattr(self.client, name, value)
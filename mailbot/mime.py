@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Scan raw mails (str or bytes) to find their text body, without parsing them.
+
+The email package parses (and copies) all the parts of a mail, attachments
+included, while only its text body is needed to check the rules.
+The scanner only parses the headers of the parts, in the order of
+``email.Message.walk``, skips the payloads of the other parts, and stops as
+soon as the text body is found.
+
+"""
+
+from __future__ import absolute_import
+
+import re
+from email import message_from_string
+from email.parser import HeaderParser
+
+from .compat import text_type
+
+try:
+    from email import message_from_bytes
+    from email.parser import BytesHeaderParser
+except ImportError:  # python 2, where str are bytes
+    message_from_bytes = message_from_string
+    BytesHeaderParser = None
+
+
+def compile_pattern(pattern, raw, flags=0):
+    """Compile the pattern to search in the raw mail, str or bytes.
+
+    The compiled patterns are cached by the re module.
+
+    """
+    if not isinstance(raw, text_type) and not isinstance(pattern, bytes):
+        pattern = pattern.encode('ascii', 'surrogateescape')
+    return re.compile(pattern, flags)
+
+
+EMPTY_HEADERS = r'\r?\n'
+HEADERS_END = r'\r?\n\r?\n'
+LINE_BREAK_END = r'\r?\n\Z'
+# the email package also splits lines on single \r characters
+BARE_CR = r'\r(?!\n)'
+
+
+class ScanError(Exception):
+    """The scanner can't tell how the email package would parse the mail."""
+
+
+def parse_mail(raw):
+    """Parse the raw mail with the email package, bytes staying bytes."""
+    if isinstance(raw, text_type):
+        return message_from_string(raw)
+    return message_from_bytes(raw)
+
+
+def parse_header_block(block):
+    """Parse a block of headers, bytes staying bytes."""
+    if isinstance(block, text_type) or BytesHeaderParser is None:
+        return HeaderParser().parsestr(block)
+    return BytesHeaderParser().parsebytes(block)
+
+
+def parse_headers(raw, start, end):
+    """Parse the headers of the part of the mail starting at ``start``.
+
+    Return the headers, as an email.Message without payload, and the
+    position of the body of the part.
+
+    """
+    match = compile_pattern(EMPTY_HEADERS, raw).match(raw, start, end)
+    if match is not None:
+        return HeaderParser().parsestr(''), match.end()
+    match = compile_pattern(HEADERS_END, raw).search(raw, start, end)
+    body = match.end() if match is not None else end
+    headers = parse_header_block(raw[start:body])
+    if headers.defects or headers.get_payload():
+        raise ScanError('Malformed headers')
+    return headers, body
+
+
+def parse_mail_headers(raw):
+    """Return the headers of the mail, as an email.Message without payload."""
+    try:
+        return parse_headers(raw, 0, len(raw))[0]
+    except ScanError:  # let the email package deal with it
+        return parse_header_block(raw)
+
+
+def strip_line_break(raw, start, end):
+    """Return the end of the part, without its last line break."""
+    match = compile_pattern(LINE_BREAK_END, raw).search(
+        raw, max(start, end - 2), end)
+    return match.start() if match is not None else end
+
+
+def iter_parts(raw, start, end, boundary):
+    """Yield the (start, end) of the parts of a multipart body."""
+    delimiter = compile_pattern(
+        r'^--%s(--)?[ \t]*\r?(?:\n|\Z)' % re.escape(boundary), raw,
+        re.MULTILINE)
+    part_start = None
+    for match in delimiter.finditer(raw, start, end):
+        if part_start is not None:
+            # the line break before the delimiter is part of the delimiter
+            yield part_start, strip_line_break(raw, part_start, match.start())
+        if match.group(1):  # close delimiter
+            return
+        part_start = match.end()
+    if part_start is not None:  # no close delimiter
+        yield part_start, strip_line_break(raw, part_start, end)
+
+
+def scan_message(raw, start, end, default_type='text/plain'):
+    """Return the (start, end) of the text body part, or None."""
+    headers, body = parse_headers(raw, start, end)
+    headers.set_default_type(default_type)
+    content_type = headers.get_content_type()
+    if content_type == 'text/plain' and headers.get_filename() is None:
+        return start, end
+    if headers.get_content_maintype() == 'multipart':
+        boundary = headers.get_boundary()
+        if boundary is None:  # parsed as a single part
+            return None
+        part_type = 'text/plain'
+        if content_type == 'multipart/digest':
+            part_type = 'message/rfc822'
+        for part_start, part_end in iter_parts(raw, body, end, boundary):
+            span = scan_message(raw, part_start, part_end, part_type)
+            if span is not None:
+                return span
+    elif content_type == 'message/delivery-status':
+        raise ScanError('Delivery status')  # parsed as a list of headers
+    elif headers.get_content_maintype() == 'message':
+        return scan_message(raw, body, end)
+    return None
+
+
+def find_text_part(raw):
+    """Return the (start, end) of the part holding the text body of the mail.
+
+    This is the first 'text/plain' part without filename, like in
+    ``mailbot.message.get_text_body``. Return None if there is no such part,
+    or the whole mail if it can't be scanned.
+
+    """
+    if compile_pattern(BARE_CR, raw).search(raw):
+        return 0, len(raw)
+    try:
+        return scan_message(raw, 0, len(raw))
+    except ScanError:
+        return 0, len(raw)
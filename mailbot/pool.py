@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import logging
+from contextlib import contextmanager
+from threading import Condition
+
+from imapclient import IMAPClient
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """Authenticated IMAP connections, kept alive to be reused.
+
+    A connection is borrowed with ``acquire``, for the exclusive use of a
+    MailBot (or a thread), and given back with ``release``, instead of being
+    logged out. Connections are pooled by account (host, username and
+    connection options), so many MailBots may share the connections of the
+    same account.
+
+    Before being handed out again, a pooled connection is checked with a
+    NOOP: a dead connection is dropped, and a new one is opened instead.
+
+    A connection is given back with its folder still selected: the
+    extensions needing an ENABLE command, only allowed before selecting a
+    folder, are enabled with ``enable``, once per connection.
+
+    """
+    imapclient = IMAPClient
+    max_connections = None
+    max_idle = 10
+
+    def __init__(self, max_connections=None, max_idle=None, imapclient=None):
+        """Create an empty pool.
+
+        The max_connections parameter is the maximum number of connections
+        (borrowed or not) for each account: ``acquire`` blocks until a
+        connection is released if it's reached. The max_idle parameter is the
+        maximum number of unused connections kept for each account.
+
+        """
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_idle is not None:
+            self.max_idle = max_idle
+        if imapclient is not None:
+            self.imapclient = imapclient
+        self.condition = Condition()
+        self.idle = {}  # account: list of unused connections
+        self.counts = {}  # account: number of connections
+        self.borrowed = {}  # id(connection): (account, connection)
+        self.enabled = {}  # id(connection): set of the enabled extensions
+
+    def get_account(self, host, username, imap_options):
+        return (host, username, tuple(sorted(imap_options.items())))
+
+    def acquire(self, host, username, password, imap_options=None,
+                imapclient=None):
+        """Return a logged in connection to the account.
+
+        An unused connection is reused if it's still alive, otherwise a new
+        one is opened with ``imapclient`` (``IMAPClient`` by default).
+
+        """
+        imap_options = imap_options or {}
+        account = self.get_account(host, username, imap_options)
+        while True:
+            with self.condition:
+                while True:
+                    idle = self.idle.get(account)
+                    if idle:
+                        client = idle.pop()
+                        break
+                    count = self.counts.get(account, 0)
+                    if (self.max_connections is None or
+                            count < self.max_connections):
+                        client = None
+                        self.counts[account] = count + 1
+                        break
+                    self.condition.wait()
+            if client is None:
+                try:
+                    client = (imapclient or self.imapclient)(host,
+                                                             **imap_options)
+                    client.login(username, password)
+                except Exception:
+                    self.forget(account)
+                    raise
+                break
+            if self.check(client):
+                break
+            logger.info("Dropping a dead connection to %s", host)
+            self.logout(client)
+            self.forget(account)
+        with self.condition:
+            self.borrowed[id(client)] = (account, client)
+        return client
+
+    def release(self, client, discard=False):
+        """Give back a borrowed connection, to be reused.
+
+        If ``discard`` is True (for example, if the connection is known to be
+        broken), the connection is logged out instead.
+
+        """
+        with self.condition:
+            account, client = self.borrowed.pop(id(client), (None, client))
+            if account is not None and not discard:
+                idle = self.idle.setdefault(account, [])
+                if len(idle) < self.max_idle:
+                    idle.append(client)
+                    self.condition.notify()
+                    return
+        self.logout(client)
+        if account is not None:
+            self.forget(account)
+
+    def enable(self, client, *capabilities):
+        """Enable the extensions not enabled yet on the borrowed connection."""
+        with self.condition:
+            enabled = self.enabled.get(id(client), set())
+        missing = [capability for capability in capabilities
+                   if capability not in enabled]
+        if missing:
+            client.enable(*missing)
+        with self.condition:
+            self.enabled.setdefault(id(client), set()).update(missing)
+
+    @contextmanager
+    def connection(self, host, username, password, imap_options=None,
+                   imapclient=None):
+        """Context manager borrowing a connection, see ``acquire``.
+
+        The connection is discarded if an exception is raised.
+
+        """
+        client = self.acquire(host, username, password, imap_options,
+                              imapclient)
+        try:
+            yield client
+        except Exception:
+            self.release(client, discard=True)
+            raise
+        self.release(client)
+
+    def check(self, client):
+        """Is the connection still alive?"""
+        try:
+            client.noop()
+        except Exception:
+            return False
+        return True
+
+    def logout(self, client):
+        with self.condition:
+            self.enabled.pop(id(client), None)
+        try:
+            client.logout()
+        except Exception:  # the connection is most probably already dead
+            pass
+
+    def forget(self, account):
+        """A connection to the account was closed."""
+        with self.condition:
+            self.counts[account] -= 1
+            self.condition.notify()
+
+    def close(self):
+        """Logout all the unused connections."""
+        with self.condition:
+            idle, self.idle = self.idle, {}
+        for account, clients in idle.items():
+            for client in clients:
+                self.logout(client)
+                self.forget(account)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Guards against the regexps which may take forever.
+
+A regexp with nested quantifiers, like ``(\\w+\\s?)+$``, may backtrack for
+minutes on a long enough body, stalling the whole mailbox. The regexps of
+the rules are linted when registering them (see ``lint_regexp``), and the
+callbacks may set budgets on their rules (see ``mailbot.callback.Callback``),
+or use another regexp engine:
+
+* 'regex': the ``regex`` package, which supports timeouts, so the
+  ``regexp_timeout`` of the callbacks interrupts the matching
+* 're2': the ``re2`` package (``google-re2``), whose matching time is linear,
+  for untrusted rules (backreferences and lookarounds aren't supported)
+
+"""
+
+from __future__ import absolute_import
+
+import re
+
+from .compat import string_types
+
+try:
+    from re import _parser as sre_parse  # python 3.11+
+except ImportError:
+    import sre_parse
+
+try:
+    TimeoutError = TimeoutError
+except NameError:  # python 2
+    class TimeoutError(Exception):
+        pass
+
+
+ENGINES = {'regex': "The 'regex' package is needed for the 'regex' engine",
+           're2': "The 'google-re2' package is needed for the 're2' engine"}
+REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+# these don't backtrack into their content
+ATOMIC = tuple(getattr(sre_parse, name) for name in ('POSSESSIVE_REPEAT',
+                                                     'ATOMIC_GROUP')
+               if hasattr(sre_parse, name))
+
+
+def get_engine(name):
+    """Return the module of the engine: ``re`` for None, 'regex' or 're2'."""
+    if name is None:
+        return re
+    if name not in ENGINES:
+        raise ValueError('Unknown regexp engine: %r' % name)
+    try:
+        return __import__(name)
+    except ImportError:
+        raise ImportError(ENGINES[name])
+
+
+def supports_timeout(regexp):
+    """Can the matching of this compiled regexp be interrupted?"""
+    return type(regexp).__module__ in ('regex', '_regex')
+
+
+def findall(regexp, value, timeout=None):
+    """Return the matches of the regexp, interrupted after ``timeout``.
+
+    The matching is only interrupted with the 'regex' engine: TimeoutError
+    is then raised.
+
+    """
+    if not hasattr(regexp, 'findall'):  # not compiled
+        return re.findall(regexp, value)
+    if timeout is not None and supports_timeout(regexp):
+        return regexp.findall(value, timeout=timeout)
+    return regexp.findall(value)
+
+
+def lint_regexp(pattern):
+    """Return the list of the problems found in the pattern.
+
+    The quantifiers nested in another quantifier, with a variable number of
+    repetitions, are reported: the ways of splitting the text between them
+    grow exponentially, and a failing match tries all of them. Some of the
+    regexps reported are fine, if the repeated parts can't overlap.
+
+    """
+    if not isinstance(pattern, string_types):
+        return []
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:  # the regexp compiled, but not with this parser
+        return []
+    if has_nested_repeats(parsed):
+        return ['nested quantifiers, prone to catastrophic backtracking']
+    return []
+
+
+def has_nested_repeats(parsed, repeated=False):
+    """Is there a variable repeat in a repeat of the parsed pattern?"""
+    for op, av in parsed:
+        if op in REPEATS:
+            low, high, item = av
+            if repeated and low != high:
+                return True
+            if has_nested_repeats(item, repeated or high > 1):
+                return True
+        elif op not in ATOMIC:
+            if any(has_nested_repeats(item, repeated)
+                   for item in get_subpatterns(op, av)):
+                return True
+    return False
+
+
+def get_subpatterns(op, av):
+    """Return the subpatterns of a node of the parsed pattern."""
+    if op == sre_parse.SUBPATTERN:
+        return [av[-1]]
+    if op == sre_parse.BRANCH:
+        return av[1]
+    if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return [av[1]]
+    if op == sre_parse.GROUPREF_EXISTS:
+        return [branch for branch in av[1:] if branch is not None]
+    return []
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Queue of the failed callbacks, to trigger them again later.
+
+When a MailBot has a ``retry_queue``, a callback raising an exception
+doesn't stop the processing: the raw mail and the callback are added to the
+queue, and only this callback is triggered again on the following runs, with
+an exponential backoff. The UID of the mail (with the UIDVALIDITY of its
+folder) is kept too, for the callback done to be recorded in the ``ledger``
+of the MailBot, if any, and for the parts of a mail downloaded with its
+headers only (``headers_only``) to be fetched again.
+
+After too many failures, the mail and the callback are moved to the dead
+letters, for a human to have a look. A mail which can't be processed at all
+(eg it can't be parsed) goes to the dead letters straight away, with
+``MESSAGE`` as its callback.
+
+"""
+
+from __future__ import absolute_import
+
+import sqlite3
+from collections import namedtuple
+from threading import Lock
+from time import time
+
+from .compat import text_type
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS retries (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    callback TEXT NOT NULL,
+    message_id TEXT,
+    raw BLOB NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL,
+    error TEXT,
+    uid INTEGER,
+    uidvalidity INTEGER,
+    headers_only INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS retries_due ON retries (key, next_attempt);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    callback TEXT NOT NULL,
+    message_id TEXT,
+    raw BLOB NOT NULL,
+    attempts INTEGER NOT NULL,
+    failed_at REAL NOT NULL,
+    error TEXT,
+    uid INTEGER,
+    uidvalidity INTEGER,
+    headers_only INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+COLUMNS = ('id, key, callback, message_id, raw, attempts, error, uid, '
+           'uidvalidity, headers_only')
+MESSAGE = '(message)'  # the callback of the mails failing as a whole
+
+Entry = namedtuple('Entry', COLUMNS.replace(',', ''))
+
+
+def get_callback_name(callback_class):
+    """Return the name identifying the callback class in the queue."""
+    return '%s.%s' % (callback_class.__module__, callback_class.__name__)
+
+
+def describe(error):
+    """Return a short description of the exception."""
+    return '%s: %s' % (type(error).__name__, error)
+
+
+class RetryQueue(object):
+    """Keep the failed callbacks in a SQLite database (thread safe).
+
+    The database is in memory by default, or in the file at ``path`` to
+    survive restarts. A failed callback is retried after ``backoff`` seconds,
+    then twice as long after each new failure (``max_backoff`` at most), and
+    moved to the dead letters after ``max_attempts`` failures.
+
+    The entries are kept by mailbox ``key`` (see ``MailBot.get_state_key``),
+    so a single queue may be shared by many MailBots.
+
+    """
+
+    def __init__(self, path=':memory:', max_attempts=5, backoff=60,
+                 max_backoff=60 * 60):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.executescript(SCHEMA)
+
+    def get_delay(self, attempts):
+        """Return the delay before the next attempt, after ``attempts``."""
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+    def add(self, key, callback, raw, message_id=None, error=None,
+            uid=None, uidvalidity=None, headers_only=False, now=None):
+        """Add the callback (its name) which failed on the raw mail."""
+        now = time() if now is None else now
+        if not isinstance(raw, text_type):
+            raw = sqlite3.Binary(raw)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO retries (key, callback, message_id, raw, '
+                'attempts, next_attempt, error, uid, uidvalidity, '
+                'headers_only) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)',
+                (key, callback, message_id, raw, now + self.get_delay(1),
+                 error, uid, uidvalidity, int(headers_only)))
+
+    def add_dead_letter(self, key, callback, raw, message_id=None,
+                        error=None, uid=None, uidvalidity=None,
+                        headers_only=False, now=None):
+        """Add the callback (its name) to the dead letters straight away."""
+        now = time() if now is None else now
+        if not isinstance(raw, text_type):
+            raw = sqlite3.Binary(raw)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO dead_letters (key, callback, message_id, raw, '
+                'attempts, failed_at, error, uid, uidvalidity, '
+                'headers_only) VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)',
+                (key, callback, message_id, raw, now, error, uid,
+                 uidvalidity, int(headers_only)))
+
+    def get_due(self, key, now=None):
+        """Return the entries of the mailbox to retry now, oldest first."""
+        now = time() if now is None else now
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT %s FROM retries WHERE key = ? AND next_attempt <= ? '
+                'ORDER BY id' % COLUMNS, (key, now)).fetchall()
+        return [get_entry(row) for row in rows]
+
+    def done(self, entry_id):
+        """The callback succeeded (or doesn't apply anymore)."""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM retries WHERE id = ?', (entry_id,))
+
+    def failed(self, entry_id, error=None, now=None):
+        """The callback failed again: retry later, or give up.
+
+        Return True if the entry was moved to the dead letters.
+
+        """
+        now = time() if now is None else now
+        with self.lock, self.db:
+            attempts, = self.db.execute(
+                'SELECT attempts FROM retries WHERE id = ?',
+                (entry_id,)).fetchone()
+            attempts += 1
+            if attempts < self.max_attempts:
+                self.db.execute(
+                    'UPDATE retries SET attempts = ?, next_attempt = ?, '
+                    'error = ? WHERE id = ?',
+                    (attempts, now + self.get_delay(attempts), error,
+                     entry_id))
+                return False
+            self.move_to_dead_letters(entry_id, attempts, error, now)
+            return True
+
+    def give_up(self, entry_id, error=None, now=None):
+        """Move the entry to the dead letters straight away."""
+        now = time() if now is None else now
+        with self.lock, self.db:
+            attempts, = self.db.execute(
+                'SELECT attempts FROM retries WHERE id = ?',
+                (entry_id,)).fetchone()
+            self.move_to_dead_letters(entry_id, attempts, error, now)
+
+    def move_to_dead_letters(self, entry_id, attempts, error, now):
+        self.db.execute(
+            'INSERT INTO dead_letters (key, callback, message_id, raw, '
+            'attempts, failed_at, error, uid, uidvalidity, headers_only) '
+            'SELECT key, callback, message_id, raw, ?, ?, ?, uid, '
+            'uidvalidity, headers_only FROM retries WHERE id = ?',
+            (attempts, now, error, entry_id))
+        self.db.execute('DELETE FROM retries WHERE id = ?', (entry_id,))
+
+    def get_dead_letters(self, key=None):
+        """Return the entries given up, of the mailbox or of all of them."""
+        query = 'SELECT %s FROM dead_letters' % COLUMNS
+        params = ()
+        if key is not None:
+            query += ' WHERE key = ?'
+            params = (key,)
+        with self.lock:
+            rows = self.db.execute(query + ' ORDER BY id', params).fetchall()
+        return [get_entry(row) for row in rows]
+
+    def discard_dead_letter(self, entry_id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM dead_letters WHERE id = ?',
+                            (entry_id,))
+
+    def __len__(self):
+        with self.lock:
+            count, = self.db.execute('SELECT COUNT(*) FROM retries').fetchone()
+            return count
+
+    def close(self):
+        self.db.close()
+
+
+def get_entry(row):
+    row = list(row)
+    if not isinstance(row[4], text_type):  # raw mail
+        row[4] = bytes(row[4])
+    row[9] = bool(row[9])  # headers_only
+    return Entry(*row)
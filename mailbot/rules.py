@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import re
+import warnings
+from collections import defaultdict, OrderedDict
+
+from .callback import Callback, order_rules, REGEXP_SPECIALS
+from .compat import string_types
+from .exceptions import RegexpWarning, RegisterException
+from .keywords import Keywords
+from .regexps import get_engine, lint_regexp
+
+
+DEFAULT_FLAGS = re.compile('').flags
+# backreferences are renumbered when regexps are combined
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+# IMAP search keys of the items, other headers are searched with HEADER
+SEARCH_KEYS = {'from': 'FROM', 'to': 'TO', 'cc': 'CC', 'bcc': 'BCC',
+               'subject': 'SUBJECT', 'body': 'BODY'}
+# characters which can't be sent in an IMAP atom (IMAPClient only quotes
+# strings with spaces, quotes or backslashes)
+ATOM_SPECIALS = frozenset('(){%*"\\]')
+
+
+def compile_regexps(regexps, engine=None):
+    """Return the list of regexps compiled.
+
+    A single regexp may be given instead of a list. The automatons of the
+    ``Keywords`` are built. Anything else than regexps is returned as is.
+
+    The regexps are compiled by the ``engine`` (see
+    ``mailbot.regexps.get_engine``), and a RegexpWarning is issued for the
+    ones which may backtrack for too long (see ``lint_regexp``).
+
+    """
+    module = get_engine(engine)
+    if isinstance(regexps, string_types):
+        regexps = [regexps]
+    try:
+        compiled = [regexp.compile() if isinstance(regexp, Keywords)
+                    else module.compile(regexp) for regexp in regexps]
+    except TypeError:  # not a list of regexps
+        return regexps
+    except (re.error, getattr(module, 'error', re.error)) as e:
+        raise RegisterException('Invalid regexp in %s: %s' % (regexps, e))
+    if engine != 're2':  # linear time, whatever the regexp
+        for regexp in compiled:
+            for problem in lint_regexp(getattr(regexp, 'pattern', None)):
+                warnings.warn('Regexp %r: %s' % (regexp.pattern, problem),
+                              RegexpWarning)
+    return compiled
+
+
+def compile_rules(rules, engine=None):
+    """Return a copy of the rules with all their regexps compiled.
+
+    The copy is an OrderedDict, the cheapest items first (see
+    ``mailbot.callback.get_rule_cost``).
+
+    """
+    return OrderedDict(order_rules(dict(
+        (item, compile_regexps(regexps, engine))
+        for item, regexps in rules.items())))
+
+
+def combine_regexps(regexps):
+    """Combine the regexps in a single one matching if any of them matches.
+
+    Return None if the regexps can't be safely combined.
+
+    """
+    sources = []
+    for regexp in regexps:
+        if (not hasattr(regexp, 'pattern') or
+                not isinstance(regexp.pattern, string_types) or
+                regexp.flags != DEFAULT_FLAGS or
+                BACKREFERENCE.search(regexp.pattern)):
+            return None
+        sources.append('(?:%s)' % regexp.pattern)
+    try:
+        return re.compile('|'.join(sources))
+    except (re.error, AssertionError):  # too many groups, flags...
+        return None
+
+
+def is_searchable(string):
+    """Can the string be sent as is in an IMAP search key?"""
+    return bool(string) and all(32 <= ord(char) < 127 and
+                                char not in ATOM_SPECIALS
+                                for char in string)
+
+
+def get_literal(regexp):
+    """Return the string searched by the regexp, or None if it's not literal.
+
+    Anchors at the start and the end of the regexp are ignored: the string
+    is then found in (at least) all the values matching the regexp.
+
+    """
+    if (not hasattr(regexp, 'pattern') or
+            not isinstance(regexp.pattern, string_types) or
+            regexp.flags != DEFAULT_FLAGS):
+        return None
+    pattern = regexp.pattern
+    chars = []
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        if char == '\\':
+            position += 1
+            char = pattern[position:position + 1]
+            if not char or char.isalnum():  # \d, \b, \1...
+                return None
+        elif char == '^' and position == 0:
+            char = ''
+        elif char == '$' and position == len(pattern) - 1:
+            char = ''
+        elif char in REGEXP_SPECIALS:
+            return None
+        chars.append(char)
+        position += 1
+    literal = ''.join(chars)
+    return literal if is_searchable(literal) else None
+
+
+def any_search_key(keys):
+    """Combine the IMAP search keys (lists of criteria) with OR."""
+    key = keys[-1]
+    for other in reversed(keys[:-1]):
+        key = ['OR'] + other + key
+    return key
+
+
+def get_item_search_key(item, regexps):
+    """Return the IMAP search key for the regexps of an item, or None."""
+    if not isinstance(regexps, list) or not regexps:
+        return None
+    literals = [get_literal(regexp) for regexp in regexps]
+    if None in literals:
+        return None
+    name = SEARCH_KEYS.get(item.lower())
+    if name is not None:
+        return any_search_key([[name, literal] for literal in literals])
+    if not is_searchable(item) or ' ' in item:
+        return None
+    return any_search_key([['HEADER', item, literal]
+                           for literal in literals])
+
+
+def get_search_key(rules):
+    """Return an IMAP search key for the mails which may match the rules.
+
+    The items which can't be searched by the server are left out (they're
+    checked locally anyway). Return None if no item can be searched.
+
+    """
+    keys = [get_item_search_key(item, regexps)
+            for item, regexps in rules.items()]
+    keys = [key for key in keys if key is not None]
+    if not keys:
+        return None
+    if len(keys) == 1:
+        return keys[0]
+    return [[criterion for key in keys for criterion in key]]  # all of them
+
+
+def has_default_checks(callback_class):
+    """Is the callback using the default rules checking of Callback?"""
+    if not isinstance(callback_class, type) or not issubclass(callback_class,
+                                                              Callback):
+        return False
+    for name in ('check_rules', 'check_item', 'get_value', 'get_email_body'):
+        method = getattr(callback_class, name)
+        if getattr(method, '__func__', method) is not Callback.__dict__[name]:
+            return False
+    return True
+
+
+def is_guarded(callback_class):
+    """Does the callback limit the matching of its regexps?
+
+    This is the case if it has a ``regexp_engine``, a ``regexp_timeout`` or
+    a ``max_item_length``.
+
+    """
+    return any(getattr(callback_class, name, None) is not None
+               for name in ('regexp_engine', 'regexp_timeout',
+                            'max_item_length'))
+
+
+class RulesIndex(object):
+    """Rules of the registered callbacks, compiled once and for all.
+
+    For each item, the regexps of all the callbacks are also combined in a
+    single regexp: if this regexp doesn't match the item of a mail, none of
+    the callbacks with a rule on this item can match this mail.
+
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self._prefilters = None
+        self._filterable = None
+
+    def add(self, callback_class, rules):
+        """Compile and store the rules of the callback class.
+
+        Raise RegisterException if the callback has a ``regexp_timeout``, but
+        an engine which can't interrupt the matching.
+
+        """
+        engine = getattr(callback_class, 'regexp_engine', None)
+        if (getattr(callback_class, 'regexp_timeout', None) is not None and
+                engine != 'regex'):
+            raise RegisterException(
+                "%s: the regexp_timeout needs the 'regex' regexp_engine, "
+                "others can't interrupt the matching"
+                % callback_class.__name__)
+        self.rules[callback_class] = compile_rules(rules, engine)
+        self._prefilters = None
+        return self.rules[callback_class]
+
+    def discard(self, callback_class):
+        self.rules.pop(callback_class, None)
+        self._prefilters = None
+
+    def get(self, callback_class, default=None):
+        """Return the compiled rules for this callback class."""
+        return self.rules.get(callback_class, default)
+
+    @property
+    def prefilters(self):
+        """Combined regexp for each item, or None if they can't be combined.
+
+        Only the callbacks using the default rules checking, and not guarded
+        (see ``is_guarded``), are taken into account: the other ones are
+        always checked.
+
+        """
+        if self._prefilters is None:
+            self._filterable = set()
+            regexps = defaultdict(list)
+            for callback_class, rules in self.rules.items():
+                if (not has_default_checks(callback_class) or
+                        is_guarded(callback_class)):
+                    continue
+                self._filterable.add(callback_class)
+                for item, item_regexps in rules.items():
+                    if isinstance(item_regexps, list):
+                        regexps[item].extend(item_regexps)
+                    else:  # unknown rule: don't filter on this item
+                        regexps[item].append(item_regexps)
+            self._prefilters = dict((item, combine_regexps(item_regexps))
+                                    for item, item_regexps in regexps.items())
+        return self._prefilters
+
+    def is_filterable(self, callback_class):
+        """Is this callback taken into account by the prefilters?"""
+        self.prefilters  # make sure they're up to date
+        return callback_class in self._filterable
+
+    def matcher(self, message):
+        return RulesMatcher(self, message)
+
+    def search_key(self, callbacks):
+        """Return an IMAP search key for the mails the callbacks may match.
+
+        Return None if the server can't tell, for example if a callback has
+        no rules, or doesn't use the default rules checking.
+
+        """
+        keys = []
+        for callback_class, rules in callbacks.items():
+            if not has_default_checks(callback_class):
+                return None
+            key = get_search_key(self.get(callback_class, rules) or {})
+            if key is None:
+                return None
+            keys.append(key)
+        if not keys:
+            return None
+        return any_search_key(keys)
+
+    def candidates(self, callbacks, message):
+        """Yield the (callback_class, rules) which may match the message.
+
+        The rules are the compiled ones for the callbacks in the index.
+
+        """
+        matcher = self.matcher(message)
+        for callback_class, rules in callbacks.items():
+            if matcher.may_match(callback_class):
+                yield callback_class, self.get(callback_class, rules)
+
+
+class RulesMatcher(object):
+    """Test the items of a mail against the combined regexps of an index.
+
+    Each item is only decoded and tested once, whatever the number of
+    callbacks.
+
+    """
+
+    def __init__(self, index, message):
+        self.index = index
+        self.callback = Callback(message, {})
+        self.hits = {}
+
+    def hit(self, item):
+        """May any regexp match this item of the mail?"""
+        if item not in self.hits:
+            prefilter = self.index.prefilters.get(item)
+            if prefilter is None:  # no way to tell
+                self.hits[item] = True
+            else:
+                value = self.callback.get_value(item)
+                self.hits[item] = (value is not None and
+                                   prefilter.search(value) is not None)
+        return self.hits[item]
+
+    def may_match(self, callback_class, headers_only=False):
+        """May the rules of this callback match the mail?
+
+        If ``headers_only`` is True, the rules on the body aren't tested.
+
+        """
+        if not self.index.is_filterable(callback_class):
+            return True
+        return all(self.hit(item) for item in self.index.get(callback_class)
+                   if not (headers_only and item == 'body'))
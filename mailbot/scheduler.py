@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+
+import logging
+from threading import Event, Lock
+
+from .mailbot import get_executor, MailBot
+
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler(object):
+    """Process many mailboxes, on many accounts, in a single process.
+
+    Mailboxes are processed in rounds: during each round, each mailbox gets a
+    turn, processing at most ``max_messages`` messages, so a busy mailbox
+    doesn't starve the other ones. Turns are run by a pool of ``workers``
+    threads, with at most ``max_connections`` connections open to each host:
+    the turn of a mailbox whose host has no connection left is put back in
+    the queue, and run after a turn on this host ends, while the workers run
+    the turns of the other hosts.
+
+    Between its turns, a mailbox doesn't keep its connection (unless
+    ``keep_connections`` is True), so the number of connections depends on
+    the number of workers, not on the number of mailboxes. With
+    ``keep_connections``, a mailbox keeps its connection until another
+    mailbox of the same host needs it.
+
+    All the mailboxes trigger their callbacks in the same ``executor``, if
+    any (see ``MailBot``).
+
+    """
+    mailbot_class = MailBot
+
+    def __init__(self, workers=4, max_connections=2, max_messages=100,
+                 keep_connections=False, executor=None, callback_workers=None,
+                 interval=60):
+        self.pool = get_executor('thread', workers)
+        self.max_connections = max_connections
+        self.max_messages = max_messages
+        self.keep_connections = keep_connections
+        self.executor = get_executor(executor, callback_workers)
+        self.interval = interval
+        self.mailboxes = []
+        self.offset = 0  # first mailbox of the next round
+        self.host_connections = {}  # the mailboxes connected, by host
+        self.lock = Lock()
+        self.stopping = Event()
+
+    def add_mailbox(self, host, username, password, folder='INBOX',
+                    callbacks=None, **kwargs):
+        """Add a mailbox to process, return its (not connected) MailBot.
+
+        ``callbacks`` is a dict of {callback_class: rules} to use instead of
+        the registered callbacks for this mailbox. The remaining parameters
+        are given to the MailBot.
+
+        """
+        kwargs.setdefault('max_messages', self.max_messages)
+        kwargs.setdefault('executor', self.executor)
+        mailbot = self.mailbot_class(host, username, password, folder=folder,
+                                     callbacks=callbacks, lazy=True, **kwargs)
+        self.host_connections.setdefault(host, set())
+        self.mailboxes.append(mailbot)
+        return mailbot
+
+    def remove_mailbox(self, mailbot):
+        self.mailboxes.remove(mailbot)
+        self.disconnect(mailbot)
+
+    def disconnect(self, mailbot):
+        """Disconnect the mailbox, freeing its connection to the host."""
+        mailbot.disconnect()
+        self.host_connections[mailbot.host].discard(mailbot)
+
+    def acquire_connection(self, mailbot, busy):
+        """Return True if the mailbox may be connected to its host.
+
+        A mailbox already connected keeps its connection. Otherwise, if the
+        host has ``max_connections`` connections already, the connection of
+        a mailbox between its turns (not ``busy``) is taken over.
+
+        """
+        connected = self.host_connections[mailbot.host]
+        if mailbot in connected:
+            return True
+        if len(connected) >= self.max_connections:
+            idle = [other for other in connected if other not in busy]
+            if not idle:
+                return False
+            self.disconnect(idle[0])
+        connected.add(mailbot)
+        return True
+
+    def run_turn(self, mailbot):
+        """Process (some of) the messages of the mailbox.
+
+        Return the number of messages processed. Errors are logged, and
+        don't prevent the other mailboxes from being processed.
+
+        """
+        try:
+            if mailbot.client is None:
+                mailbot.connect()
+            processed = mailbot.process_messages()
+        except Exception:
+            logger.exception("Error processing %s@%s/%s",
+                             mailbot.username, mailbot.host,
+                             mailbot.home_folder)
+            mailbot.disconnect()  # start afresh on the next turn
+            return 0
+        if not self.keep_connections:
+            mailbot.disconnect()
+        return processed
+
+    def run_once(self):
+        """Give a turn to each mailbox, return the number of mails processed.
+
+        The mailbox starting the round changes from one round to the other.
+        The turns are submitted to the pool in this order, as soon as their
+        host has a connection left (see ``acquire_connection``).
+
+        """
+        from concurrent.futures import FIRST_COMPLETED, wait
+
+        with self.lock:
+            mailboxes = self.mailboxes[self.offset:] + \
+                self.mailboxes[:self.offset]
+            self.offset = (self.offset + 1) % (len(self.mailboxes) or 1)
+        running = {}  # {future: mailbot}
+        processed = 0
+        while mailboxes or running:
+            busy = set(running.values())
+            for mailbot in list(mailboxes):
+                if self.acquire_connection(mailbot, busy):
+                    mailboxes.remove(mailbot)
+                    busy.add(mailbot)
+                    running[self.pool.submit(self.run_turn, mailbot)] = \
+                        mailbot
+            if not running:  # no connection allowed at all
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                mailbot = running.pop(future)
+                if mailbot.client is None:  # disconnected after its turn
+                    self.host_connections[mailbot.host].discard(mailbot)
+                processed += future.result()
+        return processed
+
+    def run_forever(self):
+        """Run rounds until ``stop`` is called.
+
+        Wait for ``interval`` seconds after a round that didn't process any
+        message.
+
+        """
+        self.stopping.clear()
+        while not self.stopping.is_set():
+            if not self.run_once():
+                self.stopping.wait(self.interval)
+
+    def stop(self):
+        """Ask ``run_forever`` to return after the current round."""
+        self.stopping.set()
+
+    def shutdown(self):
+        """Disconnect all the mailboxes, and stop the pools."""
+        for mailbot in self.mailboxes:
+            self.disconnect(mailbot)
+        self.pool.shutdown()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Stores of the synchronization state of the mailboxes.
+
+A state store keeps a small dict (the UIDVALIDITY of the folder, the highest
+processed UID, the HIGHESTMODSEQ...) for each mailbox, identified by a string
+key. Any object with the same ``get`` and ``set`` methods may be used.
+
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+from threading import Lock
+
+
+class MemoryStateStore(object):
+    """Keep the states in memory: they're lost when the process exits."""
+
+    def __init__(self):
+        self.states = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        """Return the state of the mailbox, or None if unknown."""
+        with self.lock:
+            state = self.states.get(key)
+            return dict(state) if state is not None else None
+
+    def set(self, key, state):
+        with self.lock:
+            self.states[key] = dict(state)
+            self.save()
+
+    def save(self):
+        pass
+
+
+class JSONStateStore(MemoryStateStore):
+    """Keep the states in a JSON file, rewritten on each change."""
+
+    def __init__(self, path):
+        super(JSONStateStore, self).__init__()
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self.states = json.load(state_file)
+
+    def save(self):
+        # write a new file then rename it, so the file is never half written
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.states, state_file, sort_keys=True)
+        os.rename(tmp_path, self.path)
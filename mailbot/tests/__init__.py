@@ -2,7 +2,8 @@
 
 from unittest2 import TestCase
 
-from .. import CALLBACKS_MAP
+from .. import CALLBACKS_MAP, RULES_INDEX, Callback, MailBot
+from ..fakeimap import FakeIMAPServer
 
 
 class MailBotTestCase(TestCase):
@@ -10,6 +11,49 @@ class MailBotTestCase(TestCase):
 
     def setUp(self):
         self.callbacks_map_save = CALLBACKS_MAP.copy()
+        self.rules_index_save = RULES_INDEX.rules.copy()
 
     def tearDown(self):
-        CALLBACKS_MAP = self.callbacks_map_save  # noqa
+        CALLBACKS_MAP.clear()
+        CALLBACKS_MAP.update(self.callbacks_map_save)
+        for callback_class in list(RULES_INDEX.rules):
+            if callback_class not in self.rules_index_save:
+                RULES_INDEX.discard(callback_class)
+
+
+class FakeServerTestCase(MailBotTestCase):
+    """TestCase with a ``FakeIMAPServer``, and no callback registered.
+
+    ``self.RecordingCallback`` (not registered) appends the subject of the
+    mails it's triggered on to ``self.triggered``. The MailBots of
+    ``make_bot`` connect to the fake server, with the ``mailbot_attributes``
+    as class attributes: override ``imapclient`` to connect them elsewhere.
+
+    """
+    mailbot_attributes = {}
+
+    def setUp(self):
+        super(FakeServerTestCase, self).setUp()
+        self.server = FakeIMAPServer()
+        self.triggered = triggered = []
+
+        class RecordingCallback(Callback):
+
+            def trigger(self):
+                triggered.append(self.message['subject'])
+
+        self.RecordingCallback = RecordingCallback
+        CALLBACKS_MAP.clear()
+
+    def imapclient(self, host, **kwargs):
+        """Connect to the fake server, like ``IMAPClient.__init__``."""
+        return self.server.client(host, **kwargs)
+
+    def get_mailbot_class(self):
+        """Return a MailBot class connecting with ``self.imapclient``."""
+        attributes = dict(self.mailbot_attributes, imapclient=self.imapclient)
+        return type('FakeServerMailBot', (MailBot,), attributes)
+
+    def make_bot(self, **kwargs):
+        """Return a MailBot connected to the fake server."""
+        return self.get_mailbot_class()('somehost', 'john', 'doe', **kwargs)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""asyncio IMAP server serving the mailbox of a FakeIMAPServer (python 3.5+).
+
+"""
+
+import asyncio
+
+from ..aio import parse_response
+
+
+def parse_sequence_set(value):
+    uids = []
+    for part in value.decode('ascii').split(','):
+        if ':' in part:
+            start, end = part.split(':')
+            uids.extend(range(int(start), int(end) + 1))
+        else:
+            uids.append(int(part))
+    return uids
+
+
+def literal(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return b'{' + str(len(value)).encode('ascii') + b'}\r\n' + value
+
+
+class IMAPStub(object):
+    """Speak just enough IMAP for the AsyncIMAPClient."""
+
+    def __init__(self, server):
+        self.server = server
+        self.port = None
+        self.tcp_server = None
+
+    async def start(self):
+        self.tcp_server = await asyncio.start_server(self.handle, '127.0.0.1',
+                                                     0)
+        self.port = self.tcp_server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.tcp_server.close()
+        await self.tcp_server.wait_closed()
+
+    async def handle(self, reader, writer):
+        client = self.server.client('127.0.0.1')
+        writer.write(b'* OK IMAP4rev1 stub ready\r\n')
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            tokens = parse_response([line.rstrip(b'\r\n')])
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            if command == b'UID':
+                command, args = b'UID ' + args[0].upper(), args[1:]
+            handler = getattr(self, command.decode().replace(' ', '_').lower(),
+                              None)
+            if handler is None:
+                writer.write(tag + b' BAD unknown command\r\n')
+            else:
+                writer.write(handler(client, *args))
+                writer.write(tag + b' OK ' + command + b' completed\r\n')
+            await writer.drain()
+            if command == b'LOGOUT':
+                break
+        writer.close()
+
+    def login(self, client, username, password):
+        client.login(username.decode(), password.decode())
+        return b''
+
+    def logout(self, client):
+        return b'* BYE logging out\r\n'
+
+    def noop(self, client):
+        client.noop()
+        return b''
+
+    def select(self, client, folder):
+        data = client.select_folder(folder.decode())
+        return ('* %(EXISTS)s EXISTS\r\n'
+                '* OK [UIDVALIDITY %(UIDVALIDITY)s] UIDs valid\r\n'
+                '* OK [UIDNEXT %(UIDNEXT)s] Predicted next UID\r\n'
+                '* OK [PERMANENTFLAGS (\\Seen \\Flagged \\*)] Flags\r\n'
+                % data).encode('ascii')
+
+    def uid_search(self, client, *criteria):
+        uids = client.search([criterion.decode() for criterion in criteria])
+        return b'* SEARCH ' + ' '.join(map(str, uids)).encode() + b'\r\n'
+
+    def uid_fetch(self, client, uids, items):
+        items = [item.decode().upper() for item in items]
+        response = b''
+        messages = client.fetch(parse_sequence_set(uids), items)
+        for uid, data in sorted(messages.items()):
+            values = [b'UID ' + str(uid).encode()]
+            for item in items:
+                key = item.replace('.PEEK', '')
+                value = data[key]
+                if key == 'RFC822.SIZE':
+                    value = str(value).encode()
+                elif key == 'FLAGS':
+                    value = ('(%s)' % ' '.join(sorted(value))).encode()
+                elif key == 'INTERNALDATE':
+                    value = value.strftime(
+                        '"%d-%b-%Y %H:%M:%S +0000"').encode()
+                else:
+                    value = literal(value)
+                values.append(key.encode() + b' ' + value)
+            response += (b'* ' + str(uid).encode() + b' FETCH (' +
+                         b' '.join(values) + b')\r\n')
+        return response
+
+    def uid_store(self, client, uids, action, flags):
+        flags = [flag.decode() for flag in flags]
+        if action.upper().startswith(b'+'):
+            client.add_flags(parse_sequence_set(uids), flags)
+        else:
+            client.remove_flags(parse_sequence_set(uids), flags)
+        return b''
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import sys
+from datetime import datetime, timedelta
+from time import time
+
+from mock import Mock
+from unittest2 import skipIf
+
+from . import MailBotTestCase
+from ..fakeimap import FakeIMAPServer
+from .. import CALLBACKS_MAP, Callback, register
+from ..exceptions import IMAPError
+
+if sys.version_info >= (3, 5):  # async/await syntax
+    import asyncio
+    from .aio_stub import IMAPStub
+    from ..aio import (AsyncMailBot, Literal, parse_internaldate,
+                       parse_response, quote)
+else:  # pragma: no cover
+    asyncio = None
+
+
+@skipIf(asyncio is None, 'AsyncMailBot needs python 3.5+')
+class ParseTest(MailBotTestCase):
+
+    def test_quote(self):
+        self.assertEqual(quote('foo'), b'"foo"')
+        self.assertEqual(quote(u'a "b" \\c'), b'"a \\"b\\" \\\\c"')
+
+    def test_parse_response(self):
+        self.assertEqual(parse_response([b'* SEARCH 1 2']),
+                         [b'*', b'SEARCH', b'1', b'2'])
+        self.assertEqual(
+            parse_response([b'* 1 FETCH (UID 3 FLAGS (\\Seen) RFC822 ',
+                            Literal(b'Subject: (foo)\r\n'), b')']),
+            [b'*', b'1', b'FETCH',
+             [b'UID', b'3', b'FLAGS', [b'\\Seen'],
+              b'RFC822', b'Subject: (foo)\r\n']])
+        self.assertEqual(parse_response([b'* OK "quoted \\" string"']),
+                         [b'*', b'OK', b'quoted " string'])
+
+    def test_parse_internaldate(self):
+        self.assertEqual(parse_internaldate(b' 7-Mar-2013 10:28:51 +0100'),
+                         datetime(2013, 3, 7, 9, 28, 51))
+
+
+@skipIf(asyncio is None, 'AsyncMailBot needs python 3.5+')
+class AsyncMailBotTest(MailBotTestCase):
+
+    def setUp(self):
+        super(AsyncMailBotTest, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.server = FakeIMAPServer()
+        self.stub = IMAPStub(self.server)
+        self.complete(self.stub.start())
+        self.addCleanup(self.complete, self.stub.stop())
+        self.bot = AsyncMailBot('127.0.0.1', 'john', 'doe',
+                                port=self.stub.port)
+        self.complete(self.bot.connect())
+        self.addCleanup(self.complete, self.bot.logout())
+        CALLBACKS_MAP.clear()
+
+    def complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_connect(self):
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.commands[:2], ['LOGIN', 'SELECT'])
+
+    def test_select_folder(self):
+        self.server.deliver('')
+        self.assertEqual(self.complete(self.bot.client.select_folder('INBOX')),
+                         {'EXISTS': 1, 'UIDVALIDITY': 1, 'UIDNEXT': 2})
+
+    def test_get_message_ids(self):
+        self.assertEqual(self.complete(self.bot.get_message_ids()), [])
+        self.server.deliver('')
+        self.server.deliver('', flags=['\\Seen'])
+        self.server.deliver('')
+        self.assertEqual(self.complete(self.bot.get_message_ids()), [1, 3])
+
+    def test_get_messages(self):
+        date = datetime(2013, 3, 15, 9, 28, 51)
+        self.server.deliver('Subject: foo\r\n\r\nbody', internaldate=date)
+
+        messages = self.complete(self.bot.get_messages())
+        self.assertEqual(messages, {
+            1: {'SEQ': 1, 'RFC822': b'Subject: foo\r\n\r\nbody'}})
+
+        data = self.complete(self.bot.client.fetch(
+            [1], ['RFC822.SIZE', 'INTERNALDATE', 'FLAGS']))
+        self.assertEqual(data, {1: {'SEQ': 1, 'RFC822.SIZE': 20,
+                                    'INTERNALDATE': date,
+                                    'FLAGS': ('\\Seen',)}})
+
+    def test_fetch_unsolicited(self):
+        self.server.deliver('Subject: foo\r\n\r\n')
+        uid_fetch = self.stub.uid_fetch
+
+        def unsolicited_fetch(client, uids, items):
+            # the flags of another mail changed by another session
+            return (b'* 7 FETCH (FLAGS (\\Seen))\r\n' +
+                    uid_fetch(client, uids, items))
+
+        self.stub.uid_fetch = unsolicited_fetch
+
+        self.assertEqual(self.complete(self.bot.get_messages()), {
+            1: {'SEQ': 1, 'RFC822': b'Subject: foo\r\n\r\n'}})
+
+    def test_mark_processing_processed(self):
+        uid = self.server.deliver('')
+
+        self.complete(self.bot.mark_processing(uid))
+        self.assertEqual(self.server.flags(uid), set(['\\Flagged', '\\Seen']))
+
+        self.complete(self.bot.mark_processed(uid))
+        self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+
+    def test_reset_timeout_messages(self):
+        old = self.server.deliver('', flags=['\\Flagged', '\\Seen'],
+                                  internaldate=datetime.utcnow() -
+                                  timedelta(minutes=10))
+        recent = self.server.deliver('', flags=['\\Flagged', '\\Seen'])
+        self.bot.timeout = 180
+
+        self.complete(self.bot.reset_timeout_messages())
+
+        self.assertEqual(self.server.flags(old), set())
+        self.assertEqual(self.server.flags(recent),
+                         set(['\\Flagged', '\\Seen']))
+
+    def test_process_messages(self):
+        triggered = []
+
+        class SyncCallback(Callback):
+
+            def trigger(self):
+                triggered.append(('sync', self.matches['subject']))
+
+        class AsyncCallback(Callback):
+
+            def trigger(self):
+                triggered.append(('async', self.matches['subject']))
+                return asyncio.sleep(0)  # an awaitable
+
+        register(SyncCallback, {'subject': [r'^sync (\w+)']})
+        register(AsyncCallback, {'subject': [r'async (\w+)']})
+        uids = [self.server.deliver('Subject: sync foo\r\n\r\n'),
+                self.server.deliver('Subject: async bar\r\n\r\n'),
+                self.server.deliver('Subject: nothing\r\n\r\n')]
+
+        self.complete(self.bot.process_messages())
+
+        self.assertEqual(sorted(triggered),
+                         [('async', ['bar']), ('sync', ['foo'])])
+        for uid in uids:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+
+    def test_process_messages_concurrently(self):
+        running = []
+        max_running = []
+
+        loop = self.loop
+
+        class SlowCallback(Callback):
+
+            def trigger(self):
+                running.append(self)
+                max_running.append(len(running))
+                future = loop.create_future()
+
+                def done():
+                    running.remove(self)
+                    future.set_result(None)
+
+                loop.call_later(0.1, done)
+                return future
+
+        register(SlowCallback)
+        for i in range(10):
+            self.server.deliver('Subject: %s\r\n\r\n' % i)
+        self.bot.concurrency = 5
+
+        start = time()
+        self.complete(self.bot.process_messages())
+
+        self.assertEqual(len(max_running), 10)
+        self.assertEqual(max(max_running), 5)
+        self.assertTrue(time() - start < 0.5)  # 10 * 0.1s if sequential
+
+    def test_process_message_awaits(self):
+        callback = Mock()
+        callback.check_rules.return_value = True
+        future = self.loop.create_future()
+        future.set_result('result')
+        callback.trigger.return_value = future
+
+        result = self.complete(self.bot.process_message(
+            None, Mock(return_value=callback), {}))
+
+        self.assertEqual(result, 'result')
+
+    def test_command_error(self):
+        self.assertRaises(IMAPError, self.complete,
+                          self.bot.client.command('UNKNOWN'))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from . import MailBotTestCase
+from .test_mime import read_mail
+from ..attachments import (Attachment, decode_chunks, get_attachments,
+                           parse_bodystructure, PartFetcher, save_attachment)
+from ..message import ParsedMessage
+
+
+# like IMAPClient's BodyData, with bytes
+BODYSTRUCTURE = (
+    [([(b'text', b'plain', (b'charset', b'UTF-8'), None, None, b'7bit', 19,
+        1, None, None, None, None),
+       (b'text', b'html', (b'charset', b'UTF-8'), None, None, b'7bit', 44, 1,
+        None, None, None, None)],
+      b'alternative', (b'boundary', b'b2'), None, None, None),
+     (b'application', b'pdf', (b'name', b'=?utf-8?q?caf=C3=A9.pdf?='), None,
+      None, b'base64', 4096, None, (b'inline', None), None, None),
+     (b'image', b'png', None, None, None, b'base64', 1024, None,
+      (b'attachment', (b'filename*', b"utf-8''%C3%A9t%C3%A9.png")), None,
+      None),
+     (b'text', b'csv', None, None, None, b'quoted-printable', 20, 2, None,
+      (b'attachment', None), None, None)],
+    b'mixed', (b'boundary', b'b1'), None, None, None)
+
+
+class FakeFetcher(object):
+
+    def __init__(self, structure, sections):
+        self.structure = structure
+        self.sections = sections
+        self.fetched = []
+
+    def fetch_bodystructure(self):
+        self.fetched.append('BODYSTRUCTURE')
+        return self.structure
+
+    def iter_section(self, section, chunk_size):
+        self.fetched.append(section)
+        data = self.sections[section]
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+
+class ParseBodystructureTest(MailBotTestCase):
+
+    def test_attachments(self):
+        self.assertEqual(parse_bodystructure(BODYSTRUCTURE), [
+            Attachment('2', u'café.pdf', 'application/pdf', 4096, 'base64'),
+            Attachment('3', u'été.png', 'image/png', 1024, 'base64'),
+            Attachment('4', None, 'text/csv', 20, 'quoted-printable')])
+
+    def test_nested_sections(self):
+        structure = ([BODYSTRUCTURE, BODYSTRUCTURE[0][1]], 'mixed')
+
+        self.assertEqual([attachment.section for attachment
+                          in parse_bodystructure(structure)],
+                         ['1.2', '1.3', '1.4', '2'])
+
+    def test_single_part(self):
+        structure = ('application', 'pdf', ('name', 'doc.pdf'), None, None,
+                     'base64', 100)
+
+        self.assertEqual(parse_bodystructure(structure), [
+            Attachment('1', 'doc.pdf', 'application/pdf', 100, 'base64')])
+        self.assertEqual(parse_bodystructure(BODYSTRUCTURE[0][0][0]), [])
+
+
+class DecodeChunksTest(MailBotTestCase):
+
+    def test_base64(self):
+        # the quanta and the line breaks are split between the chunks
+        chunks = [b'dGVzd', b'CBma\r', b'\nWxlCg', b'==\r\n']
+
+        self.assertEqual(b''.join(decode_chunks(chunks, 'base64')),
+                         b'test file\n')
+
+    def test_quoted_printable(self):
+        chunks = [b'caf=C', b'3=A9 =\r\nau lait\r', b'\n=3D']
+
+        self.assertEqual(b''.join(decode_chunks(chunks, 'quoted-printable')),
+                         u'café au lait\r\n='.encode('utf-8'))
+
+    def test_binary(self):
+        self.assertEqual(list(decode_chunks([b'a', b'b'], '8bit')),
+                         [b'a', b'b'])
+
+
+class AttachmentsTest(MailBotTestCase):
+
+    def test_downloaded_mail(self):
+        message = ParsedMessage(read_mail('mail_with_attachment.txt'))
+        attachment = Attachment('2', 'test.txt', 'text/plain', 16, 'base64')
+        self.assertEqual(get_attachments(message), [attachment])
+
+        target = BytesIO()
+        self.assertEqual(save_attachment(message, attachment, target), 10)
+        self.assertEqual(target.getvalue(), b'test file\n')
+
+    def test_headers_only(self):
+        message = ParsedMessage('Subject: report\r\n\r\n')
+        message.headers_only = True
+        message.fetcher = FakeFetcher(BODYSTRUCTURE,
+                                      {'4': b'a,b\r\n=C3=A9,d=\r\n'})
+
+        attachments = get_attachments(message)
+        self.assertEqual(len(attachments), 3)
+        get_attachments(message)  # the BODYSTRUCTURE is only fetched once
+        tmpdir = mkdtemp()
+        self.addCleanup(rmtree, tmpdir)
+        path = join(tmpdir, 'report.csv')
+        self.assertEqual(save_attachment(message, attachments[2], path,
+                                         chunk_size=4), 9)
+        with open(path, 'rb') as saved:
+            self.assertEqual(saved.read(), u'a,b\r\né,d'.encode('utf-8'))
+        self.assertEqual(message.fetcher.fetched, ['BODYSTRUCTURE', '4'])
+
+    def test_no_fetcher(self):
+        message = ParsedMessage('Subject: report\r\n\r\n')
+        message.headers_only = True
+
+        self.assertRaises(ValueError, get_attachments, message)
+
+
+class PartFetcherTest(MailBotTestCase):
+
+    def test_iter_section(self):
+        responses = []
+
+        class Client(object):
+            def fetch(self, uids, items):
+                responses.append(items)
+                offset = len(responses) - 1
+                return {uids[0]: {b'BODY[2]<%d>' % offset:
+                                  b'abcde'[offset:offset + 1]}}
+
+        fetcher = PartFetcher(Client(), 42)
+
+        self.assertEqual(list(fetcher.iter_section('2', chunk_size=1)),
+                         [b'a', b'b', b'c', b'd', b'e'])
+        self.assertEqual(responses[1], ['BODY.PEEK[2]<1.1>'])
+        self.assertEqual(len(responses), 6)  # the last one is empty
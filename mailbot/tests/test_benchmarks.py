@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+
+from unittest2 import skipIf
+
+from . import MailBotTestCase
+from ..benchmarks.__main__ import main
+from ..benchmarks.corpus import CORPORA, make_callbacks
+from ..benchmarks.runner import (compare, percentile, run_scenario,
+                                 tracemalloc)
+from ..mime import parse_mail
+
+
+class BenchmarksTest(MailBotTestCase):
+
+    def test_corpora(self):
+        for name, make_mail in CORPORA.items():
+            self.assertTrue(parse_mail(make_mail(3))['subject'])
+        self.assertEqual(CORPORA['tiny'](3), CORPORA['tiny'](3))
+
+    def test_make_callbacks(self):
+        callbacks = make_callbacks(3)
+        self.assertEqual(len(callbacks), 3)
+        self.assertEqual(sorted(len(rules) for rules in callbacks.values()),
+                         [2, 2, 3])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([4], 90), 4)
+
+    def test_run_scenario(self):
+        result = run_scenario('tiny', 2, messages=4, repeat=2)
+
+        self.assertEqual(result['triggered'], 2)  # the mails 0 and 1
+        self.assertTrue(result['messages_per_second'] > 0)
+        # mark processing, then mark processed (2 STORE commands)
+        self.assertEqual(result['round_trips_per_message'], 3.5)
+        self.assertEqual(result['stages']['message']['count'], 8)
+        self.assertEqual(result['stages']['trigger']['count'], 4)
+        # the rules index prefilter leaves out the mails 2 and 3
+        self.assertEqual(result['stages']['rules']['count'], 8)
+
+    @skipIf(tracemalloc is None, 'The peak memory needs python 3.4+')
+    def test_peak_memory(self):
+        result = run_scenario('large', 1, messages=2, repeat=1)
+
+        # the two mails downloaded, of about 1.4MB each, are included
+        self.assertTrue(result['peak_memory'] > 2 * 1024 * 1024)
+
+    def test_compare(self):
+        baseline = {'tiny': {'messages_per_second': 100, 'peak_memory': 1000,
+                             'round_trips_per_message': 3}}
+        results = {'tiny': {'messages_per_second': 80, 'peak_memory': 1050,
+                            'round_trips_per_message': 1},
+                   'new': {'messages_per_second': 80}}
+
+        rows = compare(results, baseline, threshold=0.1)
+
+        self.assertEqual(
+            [(name, metric, regressed)
+             for name, metric, old, new, change, regressed in rows],
+            [('tiny', 'messages_per_second', True),
+             ('tiny', 'peak_memory', False),
+             ('tiny', 'round_trips_per_message', False)])
+
+    def test_main(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'baseline.json')
+        argv = ['--corpus', 'tiny', '--callbacks', '1', '--messages', '2',
+                '--repeat', '1', '--no-memory']
+
+        self.assertEqual(main(argv + ['--save', path]), 0)
+        with open(path) as baseline_file:
+            self.assertEqual(list(json.load(baseline_file)['results']),
+                             ['tiny/1 callbacks'])
+        # nothing is more than 100000% slower than the baseline
+        self.assertEqual(
+            main(argv + ['--compare', path, '--threshold', '1000']), 0)
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import re
+from collections import OrderedDict
 from email import message_from_file, message_from_string
 from os.path import dirname, join
 
-from mock import Mock
+from mock import Mock, patch
 
 from . import MailBotTestCase
-from .. import Callback
+from .. import Callback, Keywords
+from ..callback import get_rule_cost
+from ..regexps import TimeoutError
 
 
 class CallbackTest(MailBotTestCase):
@@ -41,6 +45,52 @@ class CallbackTest(MailBotTestCase):
         callback.rules = {'foo': True, 'bar': ['test'], 'baz': 'barf'}
         self.assertEqual(callback.check_rules(), True)
 
+    def test_check_rules_short_circuit(self):
+        callback = Callback(message_from_string('From: foo\r\n\r\nbar'), {})
+        checked = []
+
+        def check_item(item, regexps):
+            checked.append(item)
+            return item != 'from'
+        callback.check_item = check_item
+
+        # the body is the most expensive to check, and isn't checked as the
+        # other items don't match
+        self.assertFalse(callback.check_rules(
+            {'body': ['bar'], 'subject': [r'\d+'], 'from': ['foo']}))
+        self.assertEqual(checked, ['from'])
+
+        # all the items, in the order of the rules
+        del checked[:]
+        callback.full_evaluation = True
+        self.assertFalse(callback.check_rules(
+            OrderedDict([('body', ['bar']), ('from', ['foo'])])))
+        self.assertEqual(checked, ['body', 'from'])
+
+    def test_check_rules_ordered(self):
+        callback = Callback('foo', 'bar')
+        checked = []
+        callback.check_item = lambda item, regexps: checked.append(item) or 1
+
+        self.assertTrue(callback.check_rules(
+            {'body': ['bar'], 'subject': [r'\d+'], 'from': ['foo']}))
+        self.assertEqual(checked, ['from', 'subject', 'body'])
+
+        # an OrderedDict is checked in its own order
+        del checked[:]
+        self.assertTrue(callback.check_rules(
+            OrderedDict([('body', ['bar']), ('from', ['foo'])])))
+        self.assertEqual(checked, ['body', 'from'])
+
+    def test_get_rule_cost(self):
+        self.assertEqual(get_rule_cost('from', ['foo', 'bar baz']), 0)
+        self.assertEqual(get_rule_cost('from', 'foo'), 0)
+        self.assertEqual(get_rule_cost('from', ['foo', r'\d']), 1)
+        self.assertEqual(get_rule_cost('subject', [re.compile('a.b')]), 1)
+        self.assertEqual(get_rule_cost('body', ['foo']), 2)
+        self.assertEqual(get_rule_cost('body', ['(foo)']), 3)
+        self.assertEqual(get_rule_cost('to', None), 0)
+
     def test_check_item_non_existent(self):
         empty = message_from_string('')
         callback = Callback(empty, {})
@@ -91,6 +141,42 @@ class CallbackTest(MailBotTestCase):
         self.assertTrue(callback.check_item('body', ['.+']))
         self.assertEqual(callback.matches['body'], ['some mail body'])
 
+    def test_check_item_keywords(self):
+        message = message_from_string('Subject: ID-1, ID-3 and ID-1\r\n\r\n')
+        callback = Callback(message, {})
+
+        self.assertTrue(callback.check_item(
+            'subject', [Keywords(['ID-1', 'ID-2', 'ID-3']), r'and (\w+)']))
+        self.assertEqual(callback.matches['subject'],
+                         ['ID-1', 'ID-3', 'ID-1', 'ID'])
+
+        callback = Callback(message, {})
+        self.assertFalse(callback.check_item('subject', [Keywords(['ID-2'])]))
+
+    def test_check_item_max_length(self):
+        message = message_from_string('Subject: foo\r\n\r\n' + 'a' * 20)
+        callback = Callback(message, {})
+        callback.max_item_length = 10
+
+        self.assertTrue(callback.check_item('subject', ['foo']))
+        self.assertFalse(callback.check_item('body', ['a']))
+        self.assertEqual(callback.matches['body'], [])
+        self.assertEqual(callback.over_budget, [('body', 'length')])
+
+    @patch('mailbot.callback.findall')
+    def test_check_item_timeout(self, findall):
+        message = message_from_string('Subject: foo\r\n\r\n')
+        callback = Callback(message, {})
+        callback.regexp_timeout = 1
+        findall.side_effect = [['foo'], TimeoutError]
+
+        # the matching of the second regexp was interrupted: the rule doesn't
+        # match, and the captures of the first one are dropped
+        self.assertFalse(callback.check_item('subject', ['foo', 'o']))
+        self.assertEqual(callback.matches['subject'], [])
+        self.assertEqual(callback.over_budget, [('subject', 'timeout')])
+        findall.assert_called_with('o', 'foo', 1)
+
     def test_get_email_body(self):
         callback = Callback('foo', 'bar')
 
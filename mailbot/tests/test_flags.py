@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from mock import Mock
+
+from . import MailBotTestCase
+from ..flags import FlagsBackend, KeywordsBackend
+
+
+class FlagsBackendTest(MailBotTestCase):
+
+    def setUp(self):
+        super(FlagsBackendTest, self).setUp()
+        self.backend = FlagsBackend()
+        self.client = Mock()
+
+    def test_criteria(self):
+        self.assertEqual(self.backend.unprocessed, ['Unseen', 'Unflagged'])
+        self.assertEqual(self.backend.processing, ['Flagged', 'Seen'])
+        self.assertEqual(self.backend.fetch_item, 'RFC822')
+
+    def test_transitions(self):
+        self.backend.mark_processing(self.client, [1])
+        self.client.add_flags.assert_called_once_with([1], ['\\Flagged',
+                                                            '\\Seen'])
+
+        self.backend.mark_processed_batch(self.client, [1])
+        self.client.remove_flags.assert_called_once_with([1], ['\\Flagged'])
+
+        self.backend.reset(self.client, [1])
+        self.client.remove_flags.assert_called_with([1], ['\\Flagged',
+                                                          '\\Seen'])
+
+
+class KeywordsBackendTest(MailBotTestCase):
+
+    def setUp(self):
+        super(KeywordsBackendTest, self).setUp()
+        self.backend = KeywordsBackend()
+        self.client = Mock()
+
+    def test_criteria(self):
+        self.assertEqual(self.backend.unprocessed,
+                         ['UNKEYWORD', '$MailbotDone'])
+        self.assertEqual(self.backend.processing,
+                         ['KEYWORD', '$MailbotProcessing'])
+        self.assertEqual(self.backend.fetch_item, 'BODY.PEEK[]')
+
+        backend = KeywordsBackend(processing='$Busy', done='$Done')
+        self.assertEqual(backend.unprocessed, ['UNKEYWORD', '$Done'])
+        self.assertEqual(backend.processing, ['KEYWORD', '$Busy'])
+
+    def test_transitions(self):
+        # a single STORE command for each state change
+        self.backend.mark_processing(self.client, [1, 2])
+        self.client.add_flags.assert_called_once_with(
+            [1, 2], ['$MailbotDone', '$MailbotProcessing'])
+
+        for method in (self.backend.mark_processed,
+                       self.backend.mark_processed_batch):
+            self.client.reset_mock()
+            method(self.client, [1, 2])
+            self.client.remove_flags.assert_called_once_with(
+                [1, 2], ['$MailbotProcessing'])
+            self.assertFalse(self.client.add_flags.called)
+
+        self.client.reset_mock()
+        self.backend.reset(self.client, [1])
+        self.client.remove_flags.assert_called_once_with(
+            [1], ['$MailbotDone', '$MailbotProcessing'])
+
+        self.client.reset_mock()
+        self.backend.mark_skipped(self.client, [3])
+        self.client.add_flags.assert_called_once_with([3], ['$MailbotDone'])
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from . import MailBotTestCase
-from .. import register, CALLBACKS_MAP, RegisterException
+from .. import register, CALLBACKS_MAP, RULES_INDEX, RegisterException
 
 
 class RegisterTest(MailBotTestCase):
@@ -41,3 +41,13 @@ class RegisterTest(MailBotTestCase):
         register(self.with_rules_callback, {'baz': 'wow'})
         self.assertEqual(CALLBACKS_MAP[self.with_rules_callback],
                          {'foo': 'bar', 'baz': 'wow'})
+
+    def test_register_compiles_rules(self):
+        register(self.empty_callback, {'subject': [r'foo (\w+)']})
+        compiled = RULES_INDEX.get(self.empty_callback)
+        self.assertEqual(compiled['subject'][0].findall('foo bar'), ['bar'])
+
+    def test_register_invalid_regexp(self):
+        self.assertRaises(RegisterException, register, self.empty_callback,
+                          {'subject': ['(foo']})
+        self.assertFalse(self.empty_callback in CALLBACKS_MAP)
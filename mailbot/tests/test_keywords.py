@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+from . import MailBotTestCase
+from ..keywords import build_automaton, Keywords
+
+
+class KeywordsTest(MailBotTestCase):
+
+    def test_findall(self):
+        keywords = Keywords(['he', 'she', 'his', 'hers', ''])
+
+        self.assertEqual(keywords.findall('ushers'), ['she', 'he', 'hers'])
+        self.assertEqual(keywords.findall('he said he'), ['he', 'he'])
+        self.assertEqual(keywords.findall('HE'), [])
+        self.assertEqual(keywords.findall(''), [])
+
+    def test_fail_transitions(self):
+        keywords = Keywords(['abcd', 'bce', 'c'])
+
+        self.assertEqual(keywords.findall('abce abcd'),
+                         ['c', 'bce', 'c', 'abcd'])
+
+    def test_ignore_case(self):
+        keywords = Keywords(['ID-12', u'Café'], ignore_case=True)
+
+        self.assertEqual(keywords.findall(u'id-12, CAFÉ'), ['ID-12', u'Café'])
+
+    def test_whole_words(self):
+        keywords = Keywords(['ID-12', 'ID-123'], whole_words=True)
+
+        self.assertEqual(keywords.findall('ID-123, ID-12.'),
+                         ['ID-123', 'ID-12'])
+        self.assertEqual(keywords.findall('XID-12 ID-12_'), [])
+
+    def test_many_keywords(self):
+        keywords = Keywords(['CUST-%05d' % index for index in range(5000)])
+
+        self.assertEqual(keywords.findall('CUST-00042 and CUST-04999'),
+                         ['CUST-00042', 'CUST-04999'])
+        self.assertEqual(keywords.findall('CUST-5000'), [])
+
+    def test_build_automaton(self):
+        goto, fail, output = build_automaton([('ab', 'ab'), ('b', 'B'),
+                                              ('ab', 'ab')])
+
+        self.assertEqual(len(goto), 4)  # root, a, ab, b
+        ab = goto[goto[0]['a']]['b']
+        self.assertEqual(fail[ab], goto[0]['b'])
+        self.assertEqual(output[ab], [(2, 'ab'), (1, 'B')])
+
+    def test_compile(self):
+        keywords = Keywords(['foo'])
+        self.assertEqual(keywords.automaton, None)
+
+        self.assertTrue(keywords.compile() is keywords)
+        automaton = keywords.automaton
+        keywords.compile()
+        self.assertTrue(keywords.automaton is automaton)
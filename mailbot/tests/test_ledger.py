@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from . import MailBotTestCase
+from ..ledger import Ledger
+
+
+class LedgerTest(MailBotTestCase):
+
+    def setUp(self):
+        super(LedgerTest, self).setUp()
+        self.ledger = Ledger(max_age=100)
+        self.addCleanup(self.ledger.close)
+
+    def test_get_completed(self):
+        self.ledger.add('box', 7, 1, '<a@host>', 'mod.First')
+        self.ledger.add('box', 7, 1, '<a@host>', 'mod.Second')
+        self.ledger.add('box', 7, 1, '<a@host>', 'mod.Second')  # again
+        self.ledger.add('box', 7, 2, None, 'mod.First')
+
+        self.assertEqual(self.ledger.get_completed('box', 7, 1),
+                         set(['mod.First', 'mod.Second']))
+        self.assertEqual(self.ledger.get_completed('box', 7, 2, '<b@host>'),
+                         set(['mod.First']))
+        self.assertEqual(len(self.ledger), 3)
+
+        # other mailbox, other mail, UIDs of another UIDVALIDITY
+        self.assertEqual(self.ledger.get_completed('other box', 7, 1), set())
+        self.assertEqual(self.ledger.get_completed('box', 7, 3), set())
+        self.assertEqual(self.ledger.get_completed('box', 8, 1), set())
+
+    def test_message_id(self):
+        self.ledger.add('box', 7, 1, '<a@host>', 'mod.First')
+
+        # the UIDs changed, but the Message-ID didn't
+        self.assertEqual(self.ledger.get_completed('box', 8, 5, '<a@host>'),
+                         set(['mod.First']))
+        self.assertEqual(
+            self.ledger.get_completed('other box', 8, 5, '<a@host>'), set())
+
+    def test_no_uidvalidity(self):
+        self.ledger.add('box', None, 1, None, 'mod.First')
+
+        self.assertEqual(self.ledger.get_completed('box', None, 1),
+                         set(['mod.First']))
+
+    def test_compact(self):
+        self.ledger.add('box', 7, 1, None, 'mod.First', now=10)
+        self.ledger.add('box', 7, 2, None, 'mod.First', now=50)
+
+        self.assertEqual(self.ledger.compact(now=100), 0)
+        self.assertEqual(self.ledger.compact(now=120), 1)
+        self.assertEqual(self.ledger.get_completed('box', 7, 1), set())
+        self.assertEqual(len(self.ledger), 1)
+
+    def test_persistence(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ledger.db')
+        ledger = Ledger(path)
+        ledger.add('box', 7, 1, None, 'mod.First')
+        ledger.close()
+
+        ledger = Ledger(path)
+        self.addCleanup(ledger.close)
+        self.assertEqual(ledger.get_completed('box', 7, 1),
+                         set(['mod.First']))
@@ -1,11 +1,54 @@
 # -*- coding: utf-8 -*-
 
+import os
+import socket
+from base64 import b64encode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from email import message_from_string
+from io import BytesIO
+from threading import Thread
+from time import sleep, time
 
 from mock import patch, sentinel, Mock, DEFAULT, call
+from unittest2 import skipIf
 
-from . import MailBotTestCase
-from .. import CALLBACKS_MAP, MailBot
+from . import FakeServerTestCase, MailBotTestCase
+from .. import CALLBACKS_MAP, RULES_INDEX, Callback, MailBot, register
+from ..mailbot import get_executor, has_new_messages, trigger_callback
+from ..exceptions import RulesError
+from ..flags import KeywordsBackend
+from ..matching import SUPPORTED
+from ..message import ParsedMessage
+from ..metrics import InstrumentedClient, Metrics
+from ..ledger import Ledger
+from ..pool import ConnectionPool
+from ..retry import MESSAGE, RetryQueue, get_callback_name
+from ..state import MemoryStateStore
+
+
+class PidCallback(Callback):
+    """Module level, to be usable in a process pool."""
+
+    def trigger(self):
+        return os.getpid()
+
+
+class HelloCallback(Callback):
+    """Module level, to be checked in a match pool."""
+    rules = {'subject': [r'Hello (\w+)']}
+    triggered = []
+
+    def trigger(self):
+        self.triggered.append((self.message['Subject'],
+                               self.matches['subject']))
+
+
+class BrokenRulesCallback(Callback):
+    """Module level, to be checked in a match pool."""
+
+    def check_rules(self):
+        raise ValueError('broken rules')
 
 
 class TestableMailBot(MailBot):
@@ -58,6 +101,178 @@ class MailBotTest(MailBotClientTest):
         self.bot.client.fetch.assert_called_once_with(sentinel.ids, ['RFC822'])
         self.assertEqual(messages, sentinel.message_list)
 
+    def test_get_messages_max_messages(self):
+        self.bot.get_message_ids = Mock(return_value=[3, 1, 2])
+        self.bot.max_messages = 2
+
+        self.bot.get_messages()
+
+        self.bot.client.fetch.assert_called_once_with([1, 2], ['RFC822'])
+
+    @patch.multiple('imapclient.imapclient.IMAPClient',
+                    login=DEFAULT, __init__=DEFAULT, select_folder=DEFAULT)
+    def test_init_lazy_folder(self, login, __init__, select_folder):
+        __init__.return_value = None
+
+        bot = MailBot('somehost', 'john', 'doe', folder='Other', lazy=True)
+
+        self.assertIsNone(bot.client)
+        self.assertFalse(__init__.called)
+        bot.connect()
+        login.assert_called_once_with('john', 'doe')
+        select_folder.assert_called_once_with('Other')
+
+    def test_disconnect(self):
+        client = self.bot.client
+        client.logout.side_effect = socket.error
+
+        self.bot.disconnect()
+
+        client.logout.assert_called_once_with()
+        self.assertIsNone(self.bot.client)
+        self.bot.disconnect()  # already disconnected: nothing to do
+
+    def test_get_callbacks(self):
+        self.assertIs(self.bot.get_callbacks(), CALLBACKS_MAP)
+        self.assertIs(self.bot.get_rules_index(), RULES_INDEX)
+
+        callbacks = {Callback: {'subject': ['foo']}}
+        self.bot.set_callbacks(callbacks)
+
+        self.assertIs(self.bot.get_callbacks(), callbacks)
+        rules = self.bot.get_rules_index().get(Callback)
+        self.assertEqual(rules['subject'][0].pattern, 'foo')
+
+    def test_iter_messages(self):
+        messages = {1: {'RFC822': sentinel.mail1}}
+        self.bot.get_messages = Mock(return_value=messages)
+
+        self.assertEqual(list(self.bot.iter_messages()),
+                         [(1, {'RFC822': sentinel.mail1})])
+
+    def test_iter_messages_fetch_size(self):
+        self.bot.fetch_size = 2
+        self.bot.get_message_ids = Mock(return_value=[3, 1, 2])
+        self.bot.client.fetch.side_effect = lambda ids, items: dict(
+            (i, {'RFC822': i}) for i in ids if i != 2)  # 2 was deleted
+
+        messages = self.bot.iter_messages()
+        # nothing is downloaded until the first message is needed
+        self.assertFalse(self.bot.client.fetch.mock_calls)
+
+        self.assertEqual(next(messages), (1, {'RFC822': 1}))
+        self.bot.client.fetch.assert_called_once_with([1, 2], ['RFC822'])
+        self.assertEqual(list(messages), [(3, {'RFC822': 3})])
+        self.bot.client.fetch.assert_called_with([3], ['RFC822'])
+
+    def test_get_fetch_batches(self):
+        self.bot.fetch_size = 2
+        self.assertEqual(list(self.bot.get_fetch_batches([1, 2, 3])),
+                         [[1, 2], [3]])
+        self.assertFalse(self.bot.client.fetch.mock_calls)
+
+    def test_get_fetch_batches_bytes(self):
+        self.bot.fetch_bytes = 100
+        self.bot.client.fetch.return_value = {
+            1: {'RFC822.SIZE': 40}, 2: {'RFC822.SIZE': 50},
+            3: {'RFC822.SIZE': 500},  # bigger than fetch_bytes: alone
+            4: {'RFC822.SIZE': 10}, 5: {'RFC822.SIZE': 10}}
+
+        self.assertEqual(self.bot.get_fetch_batches([1, 2, 3, 4, 5, 6]),
+                         [[1, 2], [3], [4, 5]])
+        self.bot.client.fetch.assert_called_once_with(
+            [1, 2, 3, 4, 5, 6], ['RFC822.SIZE'])
+
+        self.bot.fetch_size = 1
+        self.assertEqual(self.bot.get_fetch_batches([1, 2, 3, 4, 5, 6]),
+                         [[1], [2], [3], [4], [5]])
+
+    def test_iter_messages_header_first(self):
+        self.bot.header_first = True
+        self.bot.get_message_ids = Mock(return_value=[1, 2])
+        headers = {1: {'BODY[HEADER]': 'Subject: foo\r\n\r\n'},
+                   2: {'BODY[HEADER]': 'Subject: bar\r\n\r\n'}}
+        full = {1: {'RFC822': 'Subject: foo\r\n\r\nbody'}}
+        self.bot.client.fetch.side_effect = [dict(headers), full]
+        self.bot.needs_body = Mock(
+            side_effect=lambda message: message['subject'] == 'foo')
+
+        self.assertEqual(list(self.bot.iter_messages()),
+                         [(1, full[1]), (2, headers[2])])
+        self.bot.client.fetch.assert_has_calls(
+            [call([1, 2], ['BODY.PEEK[HEADER]']), call([1], ['RFC822'])])
+
+    def test_iter_messages_header_first_no_body_needed(self):
+        self.bot.header_first = True
+        self.bot.get_message_ids = Mock(return_value=[1])
+        headers = {1: {'BODY[HEADER]': 'Subject: foo\r\n\r\n'}}
+        self.bot.client.fetch.return_value = dict(headers)
+        self.bot.needs_body = Mock(return_value=False)
+
+        self.assertEqual(list(self.bot.iter_messages()), [(1, headers[1])])
+        self.bot.client.fetch.assert_called_once_with(
+            [1], ['BODY.PEEK[HEADER]'])
+
+    def test_needs_body(self):
+        message = message_from_string('Subject: foo\r\n\r\n')
+
+        class HeadersCallback(Callback):
+            needs_body = False
+
+        CALLBACKS_MAP.clear()
+        self.assertFalse(self.bot.needs_body(message))
+
+        # header rules match, but the callback doesn't need the body
+        CALLBACKS_MAP[HeadersCallback] = {'subject': ['foo']}
+        self.assertFalse(self.bot.needs_body(message))
+
+        # header rules don't match
+        CALLBACKS_MAP[Callback] = {'subject': ['bar'], 'body': ['foo']}
+        self.assertFalse(self.bot.needs_body(message))
+
+        # the body is needed to check the remaining rules
+        CALLBACKS_MAP[HeadersCallback] = {'subject': ['foo'], 'body': ['baz']}
+        self.assertTrue(self.bot.needs_body(message))
+
+        # the callback itself needs the body
+        CALLBACKS_MAP.clear()
+        CALLBACKS_MAP[Callback] = {'subject': ['foo']}
+        self.assertTrue(self.bot.needs_body(message))
+
+    def test_process_callbacks_headers_only(self):
+        self.bot.process_message = Mock()
+        CALLBACKS_MAP.clear()
+        CALLBACKS_MAP[sentinel.callback] = sentinel.rules
+
+        self.bot.process_callbacks({'BODY[HEADER]': 'Subject: foo\r\n\r\n'})
+
+        message = self.bot.process_message.call_args[0][0]
+        self.assertTrue(isinstance(message, ParsedMessage))
+        self.assertEqual(message['subject'], 'foo')
+
+    def test_process_callbacks_prefilter(self):
+        self.bot.process_message = Mock()
+
+        class MatchingCallback(Callback):
+            pass
+
+        class FailingCallback(Callback):
+            pass
+
+        CALLBACKS_MAP.clear()
+        register(MatchingCallback, {'subject': ['fo(o)']})
+        register(FailingCallback, {'subject': ['foo'], 'from': ['bar']})
+
+        self.bot.process_callbacks(
+            {'RFC822': 'Subject: foo\r\nFrom: foo\r\n\r\n'})
+
+        # the failing callback isn't even instantiated, and the compiled rules
+        # are used
+        self.assertEqual(self.bot.process_message.call_count, 1)
+        message, callback_class, rules = self.bot.process_message.call_args[0]
+        self.assertEqual(callback_class, MatchingCallback)
+        self.assertEqual(rules, RULES_INDEX.get(MatchingCallback))
+
     def test_process_message_trigger(self):
         callback = Mock()
         callback.check_rules.return_value = True
@@ -84,14 +299,14 @@ class MailBotTest(MailBotClientTest):
         callback.check_rules.assert_called_once_with()
         self.assertEqual(res, None)
 
-    @patch('mailbot.mailbot.message_from_string')
-    def test_process_messages(self, message_from_string):
+    @patch('mailbot.mailbot.ParsedMessage')
+    def test_process_messages(self, ParsedMessage):
         messages = {1: {'RFC822': sentinel.mail1},
                     2: {'RFC822': sentinel.mail2}}
         self.bot.get_messages = Mock(return_value=messages)
-        # mock of email.message_from_string will return exactly what it's given
+        # mock of ParsedMessage will return exactly what it's given
         # to be used in the "self.bot.process_message.assert_has_calls" below
-        message_from_string.side_effect = lambda m: m
+        ParsedMessage.side_effect = lambda m: m
         self.bot.process_message = Mock()
         self.bot.mark_processed = Mock()
         CALLBACKS_MAP.update({sentinel.callback1: sentinel.rules1,
@@ -107,6 +322,118 @@ class MailBotTest(MailBotClientTest):
              call(sentinel.mail2, sentinel.callback2, sentinel.rules2)],
             any_order=True)
 
+    def test_process_messages_batch(self):
+        messages = {1: {'RFC822': sentinel.mail1},
+                    2: {'RFC822': sentinel.mail2},
+                    3: {'RFC822': sentinel.mail3}}
+        self.bot.get_messages = Mock(return_value=messages)
+        self.bot.process_callbacks = Mock(return_value=[])
+        self.bot.mark_processing = Mock()
+        self.bot.mark_processed = Mock()
+        self.bot.batch_size = 2
+
+        self.bot.process_messages()
+
+        # one STORE to claim each batch, one STORE to commit it
+        claimed = [c[1][0] for c in self.bot.client.add_flags.mock_calls]
+        committed = [c[1][0] for c in self.bot.client.remove_flags.mock_calls]
+        self.assertEqual([len(uids) for uids in claimed], [2, 1])
+        self.assertEqual(sorted(sum(claimed, [])), [1, 2, 3])
+        self.assertEqual(committed, claimed)
+        self.assertEqual(self.bot.process_callbacks.call_count, 3)
+        self.assertFalse(self.bot.mark_processing.mock_calls)
+        self.assertFalse(self.bot.mark_processed.mock_calls)
+
+    def test_get_executor(self):
+        self.assertEqual(get_executor(None), None)
+        self.assertEqual(get_executor(sentinel.executor), sentinel.executor)
+
+        executor = get_executor('thread', 3)
+        self.addCleanup(executor.shutdown)
+        self.assertTrue(isinstance(executor, ThreadPoolExecutor))
+        self.assertEqual(executor._max_workers, 3)
+
+        executor = get_executor('process', 2)
+        self.addCleanup(executor.shutdown)
+        self.assertTrue(isinstance(executor, ProcessPoolExecutor))
+
+    def test_process_message_executor(self):
+        callback = Mock()
+        callback.check_rules.return_value = True
+        self.bot.executor = Mock()
+        self.bot.executor.submit.return_value = sentinel.future
+
+        res = self.bot.process_message(sentinel.message, Mock(
+            return_value=callback), sentinel.rules)
+
+        self.assertEqual(res, sentinel.future)
+        self.assertFalse(callback.trigger.mock_calls)
+        self.bot.executor.submit.assert_called_once_with(
+            trigger_callback, callback)
+
+    def test_process_message_process_pool(self):
+        self.bot.executor = ProcessPoolExecutor(max_workers=1)
+        self.addCleanup(self.bot.executor.shutdown)
+        message = ParsedMessage(message_from_string('Subject: foo\r\n\r\n'))
+
+        future = self.bot.process_message(message, PidCallback,
+                                          {'subject': ['foo']})
+
+        self.assertNotEqual(future.result(), os.getpid())
+
+    def test_process_callbacks_futures(self):
+        self.bot.executor = Mock()
+        self.bot.process_message = Mock(side_effect=[sentinel.future, None])
+        CALLBACKS_MAP.clear()
+        CALLBACKS_MAP.update({sentinel.callback1: sentinel.rules1,
+                              sentinel.callback2: sentinel.rules2})
+
+        futures = self.bot.process_callbacks({'RFC822': ''})
+
+        self.assertEqual(futures, [sentinel.future])
+
+    def test_process_messages_executor(self):
+        self.bot.get_messages = Mock(return_value={1: sentinel.mail1,
+                                                   2: sentinel.mail2,
+                                                   3: sentinel.mail3})
+        self.bot.executor = Mock()
+        self.bot.max_pending = 1
+        events = []
+        futures = {}
+
+        def process_callbacks(msg, uid):
+            future = Mock()
+            future.done.return_value = False
+            future.result.side_effect = lambda: events.append(('done', msg))
+            futures[msg] = future
+            return [future]
+
+        self.bot.process_callbacks = process_callbacks
+        self.bot.mark_processing = lambda uid: events.append(('claim', uid))
+        self.bot.mark_processed = lambda uid: events.append(('commit', uid))
+
+        self.bot.process_messages()
+
+        # the fetch loop waits when more than one message is pending, and
+        # messages are only marked processed after their callbacks are done
+        self.assertEqual(events, [
+            ('claim', 1), ('claim', 2), ('done', sentinel.mail1),
+            ('commit', 1), ('claim', 3), ('done', sentinel.mail2),
+            ('commit', 2), ('done', sentinel.mail3), ('commit', 3)])
+
+    def test_process_messages_executor_done(self):
+        self.bot.get_messages = Mock(return_value={1: sentinel.mail1})
+        self.bot.executor = Mock()
+        future = Mock()
+        future.done.return_value = True
+        self.bot.process_callbacks = Mock(return_value=[future])
+        self.bot.mark_processed = Mock()
+
+        self.bot.process_messages()
+
+        future.result.assert_called_once_with()
+        self.bot.mark_processed.assert_called_once_with(1)
+
     def test_mark_processing(self):
         self.bot.mark_processing(sentinel.id)
         self.bot.client.add_flags.assert_called_once_with(
@@ -119,6 +446,21 @@ class MailBotTest(MailBotClientTest):
         self.bot.client.add_flags.assert_called_once_with([sentinel.id],
                                                           ['\\Seen'])
 
+    def test_mark_processing_batch(self):
+        self.bot.mark_processing_batch([sentinel.id1, sentinel.id2])
+        self.bot.client.add_flags.assert_called_once_with(
+            [sentinel.id1, sentinel.id2], ['\\Flagged', '\\Seen'])
+
+        self.bot.client.reset_mock()
+        self.bot.mark_processing_batch([])
+        self.assertFalse(self.bot.client.add_flags.mock_calls)
+
+    def test_mark_processed_batch(self):
+        self.bot.mark_processed_batch([sentinel.id1, sentinel.id2])
+        self.bot.client.remove_flags.assert_called_once_with(
+            [sentinel.id1, sentinel.id2], ['\\Flagged'])
+        self.assertFalse(self.bot.client.add_flags.mock_calls)
+
     def test_reset_timeout_messages_timeout_none(self):
         self.bot.timeout = None  # don't reset messages, no timeout!
         self.bot.reset_timeout_messages()
@@ -155,3 +497,966 @@ class MailBotTest(MailBotClientTest):
 
         self.bot.client.search.assert_called_once_with(['Flagged', 'Seen'])
         self.assertFalse(self.bot.client.remove_flags.mock_calls)
+
+
+class RunForeverTest(FakeServerTestCase):
+    mailbot_attributes = {'poll_interval': 0.01, 'stop_latency': 0.01,
+                          'reconnect_delay': 0.01}
+
+    def setUp(self):
+        super(RunForeverTest, self).setUp()
+        register(self.RecordingCallback)
+        self.bot = self.make_bot()
+
+    def start(self):
+        self.thread = Thread(target=self.bot.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.addCleanup(self.thread.join, 5)
+        self.addCleanup(self.bot.stop)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time() + timeout
+        while not condition() and time() < deadline:
+            sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_has_new_messages(self):
+        self.assertFalse(has_new_messages([]))
+        self.assertFalse(has_new_messages([(1, b'EXPUNGE')]))
+        self.assertTrue(has_new_messages([(1, b'EXPUNGE'), (3, b'EXISTS')]))
+        self.assertTrue(has_new_messages([(2, 'RECENT')]))
+
+    def test_run_forever_idle(self):
+        self.server.deliver('Subject: before\r\n\r\n')
+        self.start()
+        self.wait_for(lambda: self.triggered == ['before'])
+
+        uid = self.server.deliver('Subject: after\r\n\r\n')
+        self.wait_for(lambda: self.triggered == ['before', 'after'])
+        self.wait_for(lambda: self.server.flags(uid) == set(['\\Seen']))
+        self.assertIn('IDLE', self.server.commands)
+        self.assertNotIn('NOOP', self.server.commands)
+
+        # nothing happens while there's no new mail
+        searches = self.server.commands.count('SEARCH')
+        sleep(0.1)
+        self.assertEqual(self.server.commands.count('SEARCH'), searches)
+
+        self.bot.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(self.server.commands[-2:], ['DONE', 'LOGOUT'])
+
+    def test_run_forever_noop(self):
+        self.server.capabilities = ('IMAP4REV1',)
+        self.start()
+        self.wait_for(lambda: 'NOOP' in self.server.commands)
+
+        self.server.deliver('Subject: polled\r\n\r\n')
+        self.wait_for(lambda: self.triggered == ['polled'])
+        self.assertNotIn('IDLE', self.server.commands)
+
+    def test_run_forever_reconnect(self):
+        self.start()
+        self.wait_for(lambda: 'IDLE' in self.server.commands)
+
+        # the connection is dropped, and the server is down for two attempts
+        self.server.disconnect(failures=2)
+        self.server.deliver('Subject: while down\r\n\r\n')
+        self.wait_for(lambda: self.triggered == ['while down'])
+        self.assertEqual(self.server.logins, 2)
+
+    def test_delivered_while_processing(self):
+        server = self.server
+
+        class DeliveringCallback(Callback):
+
+            def trigger(self):
+                if self.message['subject'] == 'first':
+                    server.deliver('Subject: second\r\n\r\n')
+
+        register(DeliveringCallback)
+        self.server.deliver('Subject: first\r\n\r\n')
+        self.start()
+
+        # the EXISTS was sent along the STORE marking the first mail
+        self.wait_for(lambda: self.triggered == ['first', 'second'])
+        self.assertEqual(self.bot.client._imap.untagged_responses, {})
+
+    def test_stop_before_run(self):
+        self.bot.stop()
+        self.bot.run_forever()  # returns immediately
+        self.assertEqual(self.server.commands, ['LOGIN', 'SELECT', 'LOGOUT'])
+
+    def test_wait_for_messages_stop(self):
+        self.bot.client = Mock()
+        self.bot.client._imap.untagged_responses = {}
+        self.bot.client.has_capability.return_value = True
+        self.bot.client.idle_check.return_value = []
+        self.bot.client.idle_done.return_value = ('IDLE terminated', [])
+        self.bot.idle_timeout = 0.05
+
+        self.assertFalse(self.bot.wait_for_messages())
+        self.bot.client.idle.assert_called_once_with()
+        self.bot.client.idle_done.assert_called_once_with()
+
+    def test_wait_for_messages_idle_done(self):
+        self.bot.client = Mock()
+        self.bot.client._imap.untagged_responses = {}
+        self.bot.client.has_capability.return_value = True
+        self.bot.client.idle_check.return_value = []
+        self.bot.client.idle_done.return_value = ('IDLE terminated',
+                                                  [(3, b'EXISTS')])
+        self.bot.idle_timeout = 0.05
+
+        # notified between the last IDLE check and the end of the IDLE
+        self.assertTrue(self.bot.wait_for_messages())
+
+    def test_run_forever_connection_error(self):
+        self.bot.process_messages = Mock(side_effect=socket.error)
+        self.bot.reconnect = Mock(side_effect=self.bot.stop)
+
+        self.bot.run_forever()
+
+        self.bot.reconnect.assert_called_once_with()
+
+    def test_process_messages_thread_pool(self):
+        self.bot.executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(self.bot.executor.shutdown)
+        uids = [self.server.deliver('Subject: mail %s\r\n\r\n' % i)
+                for i in range(5)]
+
+        self.bot.process_messages()
+
+        self.assertEqual(sorted(self.triggered),
+                         ['mail %s' % i for i in range(5)])
+        for uid in uids:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+
+
+class IncrementalSyncTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(IncrementalSyncTest, self).setUp()
+        self.store = MemoryStateStore()
+        register(self.RecordingCallback)
+        self.bot = self.make_bot(state_store=self.store)
+
+    def deliver(self, subject, **kwargs):
+        return self.server.deliver('Subject: %s\r\n\r\n' % subject, **kwargs)
+
+    def test_incremental(self):
+        self.deliver('foo')
+        self.deliver('seen', flags=['\\Seen'])
+
+        self.bot.process_messages()  # full sync
+        self.assertEqual(self.store.get('john@somehost/INBOX'),
+                         {'uidvalidity': 1, 'uid': 2, 'modseq': None})
+
+        self.deliver('bar')
+        del self.server.commands[:]
+        self.assertEqual(self.bot.get_message_ids(), [3])
+        self.bot.sync_state = None
+
+        self.bot.process_messages()
+        self.assertEqual(self.triggered, ['foo', 'bar'])
+        self.assertEqual(self.store.get('john@somehost/INBOX')['uid'], 3)
+
+    def test_uid_search(self):
+        self.store.set('john@somehost/INBOX',
+                       {'uidvalidity': 1, 'uid': 2, 'modseq': None})
+        self.bot.client.search = Mock(return_value=[3])
+
+        self.bot.get_message_ids()
+
+        self.bot.client.search.assert_called_once_with(
+            ['UID', '3:*', 'Unseen', 'Unflagged'])
+
+    def test_uidvalidity_change(self):
+        self.deliver('foo')
+        self.bot.process_messages()
+        self.server.uidvalidity = 2  # UIDs renumbered: resync everything
+        self.server.messages[1]['FLAGS'].clear()
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.triggered, ['foo', 'foo'])
+        self.assertEqual(self.store.get('john@somehost/INBOX'),
+                         {'uidvalidity': 2, 'uid': 1, 'modseq': None})
+
+    def test_failed_run(self):
+        self.deliver('foo')
+        self.bot.complete = Mock(side_effect=ValueError)
+
+        self.assertRaises(ValueError, self.bot.process_messages)
+
+        self.assertIsNone(self.store.get('john@somehost/INBOX'))
+
+    def test_max_messages(self):
+        self.bot.process_messages()  # empty folder
+        for i in range(3):
+            self.deliver('mail %s' % i)
+        self.bot.max_messages = 2
+
+        self.bot.process_messages()
+        self.assertEqual(self.store.get('john@somehost/INBOX')['uid'], 2)
+
+        self.bot.process_messages()
+        self.assertEqual(self.triggered, ['mail 0', 'mail 1', 'mail 2'])
+
+    def test_reset_messages(self):
+        uid = self.deliver('old', flags=['\\Flagged', '\\Seen'],
+                           internaldate=datetime.utcnow() -
+                           timedelta(minutes=10))
+        self.deliver('foo')
+        self.bot.process_messages()
+        self.bot.timeout = 180
+
+        self.bot.process_messages()  # reset below the saved UID
+
+        self.assertEqual(self.triggered, ['foo', 'old'])
+        self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+
+    def test_condstore(self):
+        self.server.capabilities = ('IMAP4REV1', 'ENABLE', 'CONDSTORE')
+        bot = self.make_bot(state_store=self.store)
+        self.assertIn('ENABLE', self.server.commands)
+        uid = self.deliver('foo')
+        modseq = self.server.modseq  # before the changes of the run
+        bot.process_messages()
+        self.assertEqual(self.store.get('john@somehost/INBOX')['modseq'],
+                         modseq)
+
+        # reset by someone else
+        self.server.messages[uid]['FLAGS'].clear()
+        self.server.touch(uid)
+        bot.client.search = Mock(wraps=bot.client.search)
+        bot.process_messages()
+
+        bot.client.search.assert_called_once_with(
+            ['OR', 'UID', '2:*', 'MODSEQ', modseq + 1, 'Unseen', 'Unflagged'])
+        self.assertEqual(self.triggered, ['foo', 'foo'])
+
+
+class ServerFilterTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(ServerFilterTest, self).setUp()
+        self.callback_class = self.RecordingCallback
+        self.bot = self.make_bot(server_filter=True)
+
+    def deliver(self, subject, sender='foo@example.com'):
+        return self.server.deliver('From: %s\r\nSubject: %s\r\n\r\nbody'
+                                   % (sender, subject))
+
+    def test_search_messages(self):
+        register(self.callback_class, {'from': ['alice@'],
+                                       'subject': [r'^Invoice (\d+)']})
+        alice = self.deliver('Invoice 12', 'alice@example.com')
+        invoice = self.deliver('Invoice 13')
+        other = self.deliver('Hello', 'alice@example.com')
+        self.bot.client.search = Mock(wraps=self.bot.client.search)
+
+        self.assertEqual(self.bot.get_message_ids(), [alice, other])
+
+        self.bot.client.search.assert_has_calls([
+            call(['Unseen', 'Unflagged', 'NOT', 'FROM', 'alice@']),
+            call(['Unseen', 'Unflagged', 'FROM', 'alice@'])])
+        # can't match, marked as processed without being downloaded
+        self.assertEqual(self.server.flags(invoice), set(['\\Seen']))
+        self.assertNotIn('FETCH', self.server.commands)
+
+    def test_process_messages(self):
+        register(self.callback_class, {'subject': ['foo', 'bar']})
+        uids = [self.deliver('foo'), self.deliver('baz'), self.deliver('bar')]
+
+        self.assertEqual(self.bot.process_messages(), 2)
+
+        self.assertEqual(self.triggered, ['foo', 'bar'])
+        for uid in uids:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+
+    def test_not_translatable(self):
+        register(self.callback_class, {'subject': [r'\d+']})
+        uids = [self.deliver('foo'), self.deliver('42')]
+
+        self.assertEqual(self.bot.get_message_ids(), uids)
+        self.assertEqual(self.server.commands.count('SEARCH'), 1)
+        self.bot.process_messages()
+        self.assertEqual(self.triggered, ['42'])
+
+    def test_incremental(self):
+        register(self.callback_class, {'subject': ['foo']})
+        self.bot.state_store = MemoryStateStore()
+        self.bot.process_messages()
+        self.deliver('foo')
+        self.deliver('bar')
+
+        self.assertEqual(self.bot.process_messages(), 1)
+
+        self.assertEqual(self.triggered, ['foo'])
+        self.assertEqual(self.server.flags(2), set(['\\Seen']))
+
+
+class FastResetTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(FastResetTest, self).setUp()
+        self.bot = self.make_bot(timeout=180, fast_reset=True)
+
+    def deliver(self, age, flags=('\\Flagged', '\\Seen')):
+        return self.server.deliver('', flags=flags,
+                                   internaldate=datetime.utcnow() - age)
+
+    def test_reset_timeout_messages(self):
+        old = self.deliver(timedelta(days=10))
+        expired = self.deliver(timedelta(minutes=10))
+        recent = self.deliver(timedelta(minutes=1))
+        self.deliver(timedelta(days=10), flags=['\\Seen'])  # processed
+        self.bot.client.fetch = Mock(wraps=self.bot.client.fetch)
+
+        self.bot.reset_timeout_messages()
+
+        self.assertEqual(self.server.flags(old), set())
+        self.assertEqual(self.server.flags(expired), set())
+        self.assertEqual(self.server.flags(recent),
+                         set(['\\Flagged', '\\Seen']))
+        # only the INTERNALDATE of the recent mails is fetched
+        self.bot.client.fetch.assert_called_once_with([expired, recent],
+                                                      ['INTERNALDATE'])
+
+    def test_leases(self):
+        old = self.deliver(timedelta(days=10), flags=())
+        self.bot.claim([old])
+        self.assertEqual(list(self.bot.leases), [old])
+
+        # received long ago, but claimed just now: not reset
+        self.bot.reset_timeout_messages()
+        self.assertEqual(self.server.flags(old), set(['\\Flagged', '\\Seen']))
+
+        # the lease expired: reset, even if its INTERNALDATE were recent
+        self.bot.leases[old] -= 200
+        self.bot.reset_timeout_messages()
+        self.assertEqual(self.server.flags(old), set())
+        self.assertEqual(self.bot.leases, {})
+
+    def test_complete(self):
+        uid = self.deliver(timedelta(0), flags=())
+        self.bot.claim([uid])
+
+        self.bot.complete([uid])
+
+        self.assertEqual(self.bot.leases, {})
+        self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+
+
+class KeywordsBackendTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(KeywordsBackendTest, self).setUp()
+        register(self.RecordingCallback)
+        self.bot = self.make_bot(state_backend=KeywordsBackend())
+
+    def test_process_messages(self):
+        starred = self.server.deliver('Subject: starred\r\n\r\n',
+                                      flags=['\\Flagged', '\\Seen'])
+        done = self.server.deliver('Subject: done\r\n\r\n',
+                                   flags=['$MailbotDone'])
+
+        self.assertEqual(self.bot.process_messages(), 1)
+
+        self.assertEqual(self.triggered, ['starred'])
+        # the flags used by humans are left untouched
+        self.assertEqual(self.server.flags(starred),
+                         set(['\\Flagged', '\\Seen', '$MailbotDone']))
+        self.assertEqual(self.server.flags(done), set(['$MailbotDone']))
+
+    def test_batch(self):
+        uids = [self.server.deliver('Subject: %s\r\n\r\n' % i)
+                for i in range(3)]
+        self.bot.batch_size = 3
+        self.bot.fetch_size = 3
+        del self.server.commands[:]
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.server.commands,
+                         ['SEARCH', 'FETCH', 'STORE', 'STORE'])
+        for uid in uids:
+            self.assertEqual(self.server.flags(uid), set(['$MailbotDone']))
+
+    def test_reset_timeout_messages(self):
+        uid = self.server.deliver(
+            '', flags=['$MailbotDone', '$MailbotProcessing', '\\Flagged'],
+            internaldate=datetime.utcnow() - timedelta(minutes=10))
+        self.bot.timeout = 180
+
+        self.bot.reset_timeout_messages()
+
+        self.assertEqual(self.server.flags(uid), set(['\\Flagged']))
+
+    def test_adopt_messages(self):
+        read = self.server.deliver('Subject: read\r\n\r\n',
+                                   flags=['\\Seen'])
+        unread = self.server.deliver('Subject: unread\r\n\r\n')
+        self.server.deliver('Subject: starred\r\n\r\n',
+                            flags=['\\Flagged', '\\Seen'])
+
+        self.assertEqual(self.bot.adopt_messages(), 1)
+        self.assertEqual(self.bot.process_messages(), 2)
+
+        self.assertEqual(sorted(self.triggered), ['starred', 'unread'])
+        self.assertEqual(self.server.flags(read),
+                         set(['\\Seen', '$MailbotDone']))
+        self.assertEqual(self.server.flags(unread), set(['$MailbotDone']))
+        self.assertEqual(self.bot.adopt_messages(['ALL']), 0)
+
+
+class BytesMailsTest(FakeServerTestCase):
+    """IMAPClient returns the mails as bytes on python 3."""
+
+    def setUp(self):
+        super(BytesMailsTest, self).setUp()
+        triggered = self.triggered
+
+        class BodyCallback(Callback):
+            rules = {'subject': [u'côté'], 'body': [u'(\\w+) attaché']}
+
+            def trigger(self):
+                triggered.append(self.matches['body'][0])
+
+        register(BodyCallback)
+        self.bot = self.make_bot()
+        self.server.deliver(
+            u'Subject: =?utf-8?q?c=C3=B4t=C3=A9?=\r\n'
+            u'Content-Type: multipart/mixed; boundary=b\r\n\r\n'
+            u'--b\r\n'
+            u'Content-Type: text/plain; charset=utf-8\r\n\r\n'
+            u'fichier attaché\r\n'
+            u'--b\r\n'
+            u'Content-Type: application/octet-stream\r\n'
+            u'Content-Disposition: attachment; filename=data.bin\r\n\r\n'
+            u'\x00\xff\r\n'
+            u'--b--\r\n'.encode('utf-8'))
+
+    def test_process_messages(self):
+        self.bot.process_messages()
+
+        self.assertEqual(self.triggered, [u'fichier'])
+
+    def test_header_first(self):
+        self.bot.header_first = True
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.triggered, [u'fichier'])
+
+    def test_raw_8bit_subject(self):
+        uid = self.server.deliver(u'Subject: côté brut\r\n\r\n'
+                                  u'texte attaché\r\n'.encode('utf-8'))
+        other = self.server.deliver(b'Subject: other\r\n\r\n')
+
+        self.assertEqual(self.bot.process_messages(), 3)
+
+        self.assertEqual(self.triggered, [u'fichier', u'texte'])
+        for uid in [uid, other]:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+
+
+class MetricsTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.metrics = Metrics()
+
+        class HelloCallback(Callback):
+            rules = {'subject': ['Hello']}
+
+            def trigger(self):
+                pass
+
+        class FailingCallback(Callback):
+            rules = {'subject': ['Fail']}
+
+            def trigger(self):
+                raise ValueError('failed')
+
+        class LongCallback(Callback):
+            rules = {'body': ['long']}
+            max_item_length = 10
+
+            def trigger(self):
+                pass
+
+        register(HelloCallback)
+        register(FailingCallback)
+        register(LongCallback)
+        self.bot = self.make_bot(metrics=self.metrics)
+
+    def test_process_messages(self):
+        self.server.deliver('Subject: Hello\r\n\r\nbody')
+        self.server.deliver('Subject: Bye\r\n\r\nbody')
+
+        self.bot.process_messages()
+
+        get_counter = self.metrics.get_counter
+        self.assertEqual(get_counter('messages_fetched'), 2)
+        self.assertEqual(get_counter('bytes_downloaded'), 42)
+        self.assertEqual(get_counter('messages_matched',
+                                     callback='HelloCallback'), 1)
+        self.assertEqual(get_counter('imap_commands', command='fetch'), 1)
+        self.assertEqual(get_counter('imap_commands', command='add_flags'),
+                         4)
+        for stage, count in [('reset', 1), ('search', 1), ('fetch', 1),
+                             ('process', 2), ('mark', 4)]:
+            self.assertEqual(self.metrics.get_histogram(
+                'stage_seconds', stage=stage)[0], count)
+        self.assertEqual(self.metrics.get_histogram(
+            'callback_seconds', callback='HelloCallback', step='rules')[0], 1)
+        self.assertEqual(self.metrics.get_histogram(
+            'callback_seconds', callback='HelloCallback', step='trigger')[0],
+            1)
+
+    def test_failure(self):
+        self.server.deliver('Subject: Fail\r\n\r\nbody')
+
+        self.assertRaises(ValueError, self.bot.process_messages)
+
+        self.assertEqual(self.metrics.get_counter(
+            'messages_failed', callback='FailingCallback'), 1)
+
+    def test_over_budget(self):
+        self.server.deliver('Subject: Hello\r\n\r\na long, long body')
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.metrics.get_counter(
+            'rules_over_budget', callback='LongCallback', item='body',
+            reason='length'), 1)
+        self.assertEqual(self.metrics.get_counter(
+            'messages_matched', callback='LongCallback'), 0)
+
+    def test_executor_failure(self):
+        self.server.deliver('Subject: Fail\r\n\r\nbody')
+        self.bot.executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(self.bot.executor.shutdown)
+
+        self.assertRaises(ValueError, self.bot.process_messages)
+        self.bot.executor.shutdown()  # wait for the done callbacks
+
+        self.assertEqual(self.metrics.get_counter(
+            'messages_failed', callback='FailingCallback'), 1)
+        self.assertEqual(self.metrics.get_histogram(
+            'callback_seconds', callback='FailingCallback',
+            step='trigger')[0], 1)
+
+    def test_pool(self):
+        pool = ConnectionPool(imapclient=self.server.client)
+        self.bot.disconnect()
+        self.bot.pool = pool
+        self.bot.connect()
+
+        self.bot.disconnect()
+
+        # the pool gets the connection back, not the wrapper
+        self.assertFalse(isinstance(pool.acquire('somehost', 'john', 'doe'),
+                                    InstrumentedClient))
+
+
+class RetryQueueTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(RetryQueueTest, self).setUp()
+        self.queue = RetryQueue(max_attempts=2, backoff=0)
+        self.addCleanup(self.queue.close)
+        triggered = self.triggered
+        self.failures = failures = {'Flaky': 1, 'Poison': 10}
+
+        class FailingCallback(Callback):
+            rules = {'subject': [r'(\w+)']}
+
+            def trigger(self):
+                subject = self.matches['subject'][0]
+                if failures.get(subject):
+                    failures[subject] -= 1
+                    raise ValueError(subject)
+                triggered.append(subject)
+
+        class OtherCallback(Callback):
+
+            def trigger(self):
+                triggered.append('other')
+
+        register(FailingCallback)
+        register(OtherCallback)
+        self.FailingCallback = FailingCallback
+        self.bot = self.make_bot(retry_queue=self.queue)
+
+    def test_isolation(self):
+        flaky = self.server.deliver('Subject: Flaky\r\n\r\n')
+        ok = self.server.deliver('Subject: Ok\r\n\r\n')
+
+        self.assertEqual(self.bot.process_messages(), 2)
+
+        # the processing went on, and all the messages are processed
+        self.assertEqual(sorted(self.triggered), ['Ok', 'other', 'other'])
+        for uid in [flaky, ok]:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+        entry, = self.queue.get_due(self.bot.get_state_key())
+        self.assertEqual(entry.error, 'ValueError: Flaky')
+
+        del self.triggered[:]
+        self.assertEqual(self.bot.process_messages(), 0)
+
+        # only the failed callback was triggered again
+        self.assertEqual(self.triggered, ['Flaky'])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_dead_letters(self):
+        self.server.deliver('Subject: Poison\r\nMessage-ID: <p@host>\r\n\r\n')
+
+        self.bot.process_messages()
+        self.bot.process_messages()
+
+        self.assertEqual(len(self.queue), 0)
+        dead, = self.queue.get_dead_letters()
+        self.assertEqual(dead.callback,
+                         get_callback_name(self.FailingCallback))
+        self.assertEqual(dead.message_id, '<p@host>')
+        self.assertEqual(dead.attempts, 2)
+
+    def test_rules_failure(self):
+        class BrokenRulesCallback(Callback):
+
+            def check_rules(self):
+                if self.message['Subject'] == 'Broken':
+                    raise ValueError('broken rules')
+                return False
+
+        register(BrokenRulesCallback)
+        broken = self.server.deliver('Subject: Broken\r\n\r\n')
+        ok = self.server.deliver('Subject: Ok\r\n\r\n')
+
+        self.assertEqual(self.bot.process_messages(), 2)
+
+        self.assertIn('Ok', self.triggered)
+        for uid in [broken, ok]:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+        entry, = self.queue.get_due(self.bot.get_state_key())
+        self.assertEqual(entry.callback,
+                         get_callback_name(BrokenRulesCallback))
+        self.assertEqual(entry.error, 'ValueError: broken rules')
+
+    def test_message_failure(self):
+        poisoned = self.server.deliver('Subject: Poisoned\r\n\r\n')
+        ok = self.server.deliver('Subject: Ok\r\n\r\n')
+        self.bot.get_completed = Mock(side_effect=[ValueError('poisoned'),
+                                                   ()])
+
+        self.assertEqual(self.bot.process_messages(), 2)
+
+        self.assertEqual(sorted(self.triggered), ['Ok', 'other'])
+        for uid in [poisoned, ok]:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+        dead, = self.queue.get_dead_letters()
+        self.assertEqual((dead.callback, dead.error),
+                         (MESSAGE, 'ValueError: poisoned'))
+        self.assertIn('Subject: Poisoned', dead.raw)
+
+    def test_header_first_rules_failure(self):
+        self.bot.header_first = True
+        self.FailingCallback.needs_body = False
+        self.server.deliver('Subject: Ok\r\n\r\n')
+
+        with patch.object(self.FailingCallback, 'check_rules',
+                          side_effect=ValueError('broken rules')):
+            self.assertEqual(self.bot.process_messages(), 1)
+
+        self.assertEqual(self.triggered, ['other'])
+        self.assertEqual(len(self.queue), 1)
+
+    def test_unknown_callback(self):
+        self.server.deliver('Subject: Flaky\r\n\r\n')
+        self.bot.process_messages()
+        CALLBACKS_MAP.pop(self.FailingCallback)
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.queue.get_dead_letters()[0].error,
+                         'Unknown callback')
+
+    def test_executor(self):
+        self.server.deliver('Subject: Flaky\r\n\r\n')
+        self.bot.executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(self.bot.executor.shutdown)
+
+        self.bot.process_messages()
+        self.bot.executor.shutdown()  # wait for the done callbacks
+
+        self.assertEqual(len(self.queue), 1)
+
+
+class LedgerTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(LedgerTest, self).setUp()
+        self.ledger = Ledger()
+        self.addCleanup(self.ledger.close)
+        triggered = self.triggered
+        self.broken = broken = set(['Second'])
+
+        def make_callback(name):
+            def trigger(self):
+                if name in broken:
+                    raise ValueError(name)
+                triggered.append(name)
+            return type(name, (Callback,), {'trigger': trigger})
+
+        register(make_callback('First'))
+        register(make_callback('Second'))
+        self.bot = self.make_bot(ledger=self.ledger)
+
+    def crash_and_reset(self, uid):
+        # the second callback failed, leaving the mail in the processing
+        # state: reset it, as after the timeout
+        self.assertRaises(ValueError, self.bot.process_messages)
+        self.assertEqual(self.triggered, ['First'])
+        self.bot.client.remove_flags([uid], ['\\Flagged', '\\Seen'])
+        self.broken.clear()
+        del self.triggered[:]
+
+    def test_skip_completed(self):
+        uid = self.server.deliver('Subject: foo\r\n\r\n')
+        self.crash_and_reset(uid)
+
+        self.assertEqual(self.bot.process_messages(), 1)
+
+        self.assertEqual(self.triggered, ['Second'])
+        self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+        self.assertEqual(len(self.ledger), 2)
+
+    def test_uidvalidity(self):
+        uid = self.server.deliver('Subject: foo\r\n\r\n')
+        self.crash_and_reset(uid)
+        self.server.uidvalidity += 1
+        self.bot.reconnect()
+
+        self.bot.process_messages()
+
+        # the UID is meaningless now, and there's no Message-ID
+        self.assertEqual(sorted(self.triggered), ['First', 'Second'])
+
+    def test_uidvalidity_message_id(self):
+        uid = self.server.deliver(
+            'Subject: foo\r\nMessage-ID: <a@host>\r\n\r\n')
+        self.crash_and_reset(uid)
+        self.server.uidvalidity += 1
+        self.bot.reconnect()
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.triggered, ['Second'])
+
+    def test_executor(self):
+        uid = self.server.deliver('Subject: foo\r\n\r\n')
+        self.bot.executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(self.bot.executor.shutdown)
+        self.crash_and_reset(uid)
+        self.bot.executor.shutdown()  # wait for the done callbacks
+        self.bot.executor = None
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.triggered, ['Second'])
+
+    def test_retry(self):
+        self.bot.retry_queue = RetryQueue(backoff=0)
+        self.addCleanup(self.bot.retry_queue.close)
+        uid = self.server.deliver('Subject: foo\r\n\r\n')
+        self.bot.process_messages()
+        self.broken.clear()
+
+        self.bot.process_messages()  # the second callback is retried
+
+        self.assertEqual(self.triggered, ['First', 'Second'])
+        self.assertEqual(len(self.ledger), 2)
+        self.bot.client.remove_flags([uid], ['\\Seen'])
+        self.bot.process_messages()
+        self.assertEqual(self.triggered, ['First', 'Second'])
+
+
+@skipIf(not SUPPORTED, 'MatchPool needs python 3.7+')
+class MatchPoolTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(MatchPoolTest, self).setUp()
+        register(HelloCallback)
+        self.addCleanup(HelloCallback.triggered.__delitem__, slice(None))
+        self.metrics = Metrics()
+        self.bot = self.make_bot(match_workers=2, metrics=self.metrics)
+        self.addCleanup(self.bot.disconnect)
+
+    def test_disconnect(self):
+        self.server.deliver('Subject: Hello Alice\r\n\r\n')
+        self.bot.process_messages()
+        match_pool = self.bot.match_pool
+
+        self.bot.disconnect()
+
+        self.assertIsNone(self.bot.match_pool)
+        self.assertRaises(RuntimeError, match_pool.submit, b'')
+        # started again by the next run
+        self.bot.connect()
+        self.server.deliver('Subject: Hello Bob\r\n\r\n')
+        self.bot.process_messages()
+        self.assertEqual([subject for subject, matches
+                          in HelloCallback.triggered],
+                         ['Hello Alice', 'Hello Bob'])
+
+    def test_process_messages(self):
+        names = ['Alice', 'Bob', 'Carol', 'Dave', 'Eve', 'Mallory']
+        uids = [self.server.deliver('Subject: Hello %s\r\n\r\n' % name)
+                for name in names]
+        self.server.deliver('Subject: Bye\r\n\r\n')
+
+        self.assertEqual(self.bot.process_messages(), 7)
+
+        # triggered in this process, in order, with the matches of the workers
+        self.assertEqual(HelloCallback.triggered,
+                         [('Hello %s' % name, [name]) for name in names])
+        for uid in uids:
+            self.assertEqual(self.server.flags(uid), set(['\\Seen']))
+        self.assertEqual(self.metrics.get_counter(
+            'messages_matched', callback='HelloCallback'), 6)
+        self.assertEqual(self.metrics.get_histogram(
+            'stage_seconds', stage='match')[0], 7)
+
+    def test_ledger(self):
+        self.bot.ledger = ledger = Ledger()
+        self.addCleanup(ledger.close)
+        uid = self.server.deliver('Subject: Hello Alice\r\n\r\n')
+        ledger.add(self.bot.get_state_key(), self.bot.uidvalidity, uid, None,
+                   get_callback_name(HelloCallback))
+
+        self.bot.process_messages()
+
+        self.assertEqual(HelloCallback.triggered, [])
+        self.assertEqual(self.metrics.get_counter(
+            'callbacks_skipped', callback='HelloCallback'), 1)
+
+    def test_rules_failure(self):
+        register(BrokenRulesCallback)
+        self.bot.retry_queue = queue = RetryQueue()
+        self.addCleanup(queue.close)
+        self.server.deliver('Subject: Hello Alice\r\n\r\n')
+
+        self.assertEqual(self.bot.process_messages(), 1)
+
+        # only the broken callback failed, the other one was triggered
+        self.assertEqual(HelloCallback.triggered,
+                         [('Hello Alice', ['Alice'])])
+        entry, = queue.get_due(self.bot.get_state_key(), now=time() + 60)
+        self.assertEqual(entry.callback,
+                         get_callback_name(BrokenRulesCallback))
+        self.assertEqual(entry.error,
+                         'RulesError: ValueError: broken rules')
+        self.assertEqual(queue.get_dead_letters(), [])
+
+    def test_rules_failure_no_retry_queue(self):
+        register(BrokenRulesCallback)
+        self.server.deliver('Subject: Hello Alice\r\n\r\n')
+
+        self.assertRaises(RulesError, self.bot.process_messages)
+
+
+class AttachmentsTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(AttachmentsTest, self).setUp()
+        self.saved = saved = []
+
+        class ReportCallback(Callback):
+            rules = {'subject': ['Report']}
+            needs_body = False
+
+            def trigger(self):
+                for attachment in self.get_attachments():
+                    if attachment.content_type == 'text/csv':
+                        target = BytesIO()
+                        self.save_attachment(attachment, target,
+                                             chunk_size=16)
+                        saved.append((attachment.filename,
+                                      target.getvalue()))
+
+        register(ReportCallback)
+        self.ReportCallback = ReportCallback
+        self.bot = self.make_bot()
+        self.report = b'day,count\r\n' * 20
+        self.server.deliver(
+            b'Subject: Report\r\n'
+            b'Content-Type: multipart/mixed; boundary=b\r\n\r\n'
+            b'--b\r\n'
+            b'Content-Type: text/plain\r\n\r\n'
+            b'the report\r\n'
+            b'--b\r\n'
+            b'Content-Type: application/octet-stream\r\n'
+            b'Content-Disposition: attachment; filename=huge.bin\r\n'
+            b'Content-Transfer-Encoding: base64\r\n\r\n' +
+            b'AAAA' * 1000 + b'\r\n'
+            b'--b\r\n'
+            b'Content-Type: text/csv\r\n'
+            b'Content-Disposition: attachment; filename=report.csv\r\n'
+            b'Content-Transfer-Encoding: base64\r\n\r\n' +
+            b64encode(self.report) + b'\r\n--b--\r\n')
+
+    def test_header_first(self):
+        self.bot.header_first = True
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.saved, [('report.csv', self.report)])
+        # only the headers, the structure and the report were downloaded
+        self.assertNotIn('RFC822', self.server.fetched)
+        self.assertIn('BODYSTRUCTURE', self.server.fetched)
+        self.assertIn('BODY.PEEK[3]<16.16>', self.server.fetched)
+        self.assertFalse([item for item in self.server.fetched
+                          if item.startswith('BODY.PEEK[2]')])
+
+    def test_header_first_retry(self):
+        self.bot.header_first = True
+        self.bot.retry_queue = RetryQueue(backoff=0)
+        self.addCleanup(self.bot.retry_queue.close)
+        with patch.object(self.ReportCallback, 'trigger',
+                          side_effect=ValueError('boom')):
+            self.bot.process_messages()
+
+        self.bot.process_messages()
+
+        # the retry fetched the parts of the mail from the server too
+        self.assertEqual(self.saved, [('report.csv', self.report)])
+        self.assertNotIn('RFC822', self.server.fetched)
+        self.assertEqual(len(self.bot.retry_queue), 0)
+
+    def test_header_first_retry_uidvalidity(self):
+        self.bot.header_first = True
+        self.bot.retry_queue = RetryQueue(backoff=0)
+        self.addCleanup(self.bot.retry_queue.close)
+        with patch.object(self.ReportCallback, 'trigger',
+                          side_effect=ValueError('boom')):
+            self.bot.process_messages()
+        self.server.uidvalidity += 1
+        self.bot.reconnect()
+
+        self.bot.process_messages()
+
+        self.assertEqual(self.saved, [])
+        dead, = self.bot.retry_queue.get_dead_letters()
+        self.assertEqual(dead.error, 'UIDVALIDITY changed')
+        self.assertTrue(dead.headers_only)
+
+    def test_full_mail(self):
+        self.bot.process_messages()
+
+        self.assertEqual(self.saved, [('report.csv', self.report)])
+        self.assertNotIn('BODYSTRUCTURE', self.server.fetched)
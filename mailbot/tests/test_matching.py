@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from mock import patch
+from unittest2 import skipIf
+
+from . import MailBotTestCase
+from .. import Callback, MailBot
+from ..matching import (init_worker, match_message, MatchPool, SUPPORTED,
+                        WORKER)
+
+
+class HelloCallback(Callback):
+    """Module level, to be usable in a process pool."""
+    rules = {'subject': [r'Hello (\w+)']}
+
+
+class LongBodyCallback(Callback):
+    max_item_length = 5
+
+
+class BrokenRulesCallback(Callback):
+
+    def check_rules(self):
+        raise ValueError('broken rules')
+
+
+class PidCallback(Callback):
+
+    def check_rules(self):
+        self.matches['pid'] = [os.getpid()]
+        return True
+
+
+class MatchingTest(MailBotTestCase):
+
+    def setUp(self):
+        super(MatchingTest, self).setUp()
+        self.addCleanup(WORKER.clear)
+
+    def test_match_message(self):
+        init_worker([(HelloCallback, HelloCallback.rules),
+                     (Callback, {'subject': ['Bye']}),
+                     (LongBodyCallback, {'body': ['body']})])
+
+        results = match_message(b'Subject: Hello World\r\n\r\nlong body')
+
+        self.assertEqual(results, [(0, {'subject': ['World']}, [], None),
+                                   (2, None, [('body', 'length')], None)])
+        self.assertEqual(match_message(b'Subject: Bye\r\n\r\n'),
+                         [(1, {'subject': ['Bye']}, [], None)])
+
+    def test_match_message_error(self):
+        init_worker([(BrokenRulesCallback, None),
+                     (HelloCallback, HelloCallback.rules)])
+
+        # the other callbacks are still checked
+        self.assertEqual(match_message(b'Subject: Hello World\r\n\r\n'),
+                         [(0, None, [], 'ValueError: broken rules'),
+                          (1, {'subject': ['World']}, [], None)])
+
+    @skipIf(not SUPPORTED, 'MatchPool needs python 3.7+')
+    def test_match_pool(self):
+        pool = MatchPool({HelloCallback: HelloCallback.rules,
+                          PidCallback: None}, workers=2)
+        self.addCleanup(pool.shutdown)
+
+        self.assertEqual(pool.workers, 2)
+        results = dict((pool.get_callback(index)[0], matches)
+                       for index, matches, over_budget, error
+                       in pool.submit(b'Subject: Hello you\r\n\r\n').result())
+        self.assertEqual(results[HelloCallback], {'subject': ['you']})
+        self.assertNotEqual(results[PidCallback]['pid'], [os.getpid()])
+
+    @patch('mailbot.matching.SUPPORTED', False)
+    def test_not_supported(self):
+        self.assertRaises(ValueError, MatchPool, {})
+        self.assertRaises(ValueError, MailBot, 'somehost', 'john', 'doe',
+                          lazy=True, match_workers=2)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import pickle
+from email import message_from_file, message_from_string
+from os.path import dirname, join
+
+from mock import patch
+
+from . import MailBotTestCase
+from .. import Callback
+from ..message import decode_header_value, get_text_body, ParsedMessage
+from ..mime import parse_mail
+
+
+class ParsedMessageTest(MailBotTestCase):
+
+    def setUp(self):
+        super(ParsedMessageTest, self).setUp()
+        email_file = join(dirname(__file__), 'mails/mail_encoded_headers.txt')
+        self.email = message_from_file(open(email_file, 'r'))
+        self.message = ParsedMessage(self.email)
+
+    def test_decode_header_value(self):
+        self.assertEqual(decode_header_value('=?utf-8?q?cr=C3=A9ation?='),
+                         u'création')
+        self.assertEqual(decode_header_value('plain'), 'plain')
+
+    def test_get_text_body(self):
+        self.assertEqual(get_text_body(self.email),
+                         u'Test de création de bannette\n')
+        self.assertEqual(get_text_body(message_from_string('')), '')
+
+    def test_behaves_like_message(self):
+        self.assertEqual(self.message['subject'], self.email['subject'])
+        self.assertTrue('to' in self.message)
+        self.assertFalse('foobar' in self.message)
+        self.assertEqual(list(self.message), list(self.email))
+        self.assertEqual(len(self.message), len(self.email))
+        self.assertEqual(str(self.message), str(self.email))
+        self.assertEqual(self.message.get_content_type(),
+                         self.email.get_content_type())
+        self.assertEqual(len(list(self.message.walk())),
+                         len(list(self.email.walk())))
+
+    def test_get_header(self):
+        self.assertTrue(self.message.get_header('to').startswith(
+            u'test création <testmagopian'))
+        self.assertEqual(self.message.get_header('foobar'), None)
+
+        with patch('mailbot.message.decode_header_value') as decode:
+            self.message.get_header('to')  # already decoded
+            self.assertFalse(decode.mock_calls)
+
+    def test_get_body(self):
+        self.assertEqual(self.message.get_body(),
+                         u'Test de création de bannette\n')
+
+        with patch('mailbot.message.get_text_body') as get_text_body:
+            self.message.get_body()  # already decoded
+            self.assertFalse(get_text_body.mock_calls)
+
+    def test_shared_by_callbacks(self):
+        callback1 = Callback(self.message, {})
+        callback2 = Callback(self.message, {})
+        self.assertTrue(callback1.check_item('to', [r'(.*) <testmagopian']))
+        self.assertTrue(callback1.check_item('body', [r'(\w+) de bannette']))
+
+        with patch('mailbot.message.decode_header_value') as decode:
+            with patch('mailbot.message.get_text_body') as get_text_body:
+                self.assertTrue(callback2.check_item('to', ['création']))
+                self.assertTrue(callback2.check_item('body', ['création']))
+        self.assertFalse(decode.mock_calls)
+        self.assertFalse(get_text_body.mock_calls)
+        self.assertEqual(callback1.matches['to'], [u'test création'])
+        self.assertEqual(callback1.matches['body'], [u'création'])
+
+    def test_pickle(self):
+        message = pickle.loads(pickle.dumps(self.message))
+        self.assertEqual(message['subject'], self.email['subject'])
+
+
+class LazyParsedMessageTest(ParsedMessageTest):
+    """Same tests, with a ParsedMessage built from the raw mail."""
+
+    def setUp(self):
+        super(LazyParsedMessageTest, self).setUp()
+        self.message = ParsedMessage(self.email.as_string())
+
+    def test_lazy_parsing(self):
+        with patch('mailbot.message.parse_mail') as parse:
+            parse.side_effect = parse_mail
+            self.message.get_header('subject')
+            self.assertFalse(parse.mock_calls)
+            self.message.get_body()  # only the text part is parsed
+            self.assertEqual(len(parse.mock_calls), 1)
+            self.assertNotEqual(parse.call_args[0][0], self.message.raw)
+
+            self.message.walk()  # the whole mail is needed
+            parse.assert_called_with(self.message.raw)
+            self.message.get_content_type()  # already parsed
+            self.assertEqual(len(parse.mock_calls), 2)
+
+
+class BytesParsedMessageTest(LazyParsedMessageTest):
+    """Same tests, with a ParsedMessage built from the raw mail as bytes."""
+
+    def setUp(self):
+        super(BytesParsedMessageTest, self).setUp()
+        email_file = join(dirname(__file__), 'mails/mail_encoded_headers.txt')
+        with open(email_file, 'rb') as raw:
+            raw = raw.read()
+        self.email = parse_mail(raw)
+        self.message = ParsedMessage(raw)
+
+    def test_8bit_body(self):
+        raw = (u'Subject: =?utf-8?q?cr=C3=A9ation?=\r\n'
+               u'Content-Type: multipart/mixed; boundary=b\r\n\r\n'
+               u'--b\r\n'
+               u'Content-Type: text/plain; charset=utf-8\r\n'
+               u'Content-Transfer-Encoding: 8bit\r\n\r\n'
+               u'Test de création\r\n'
+               u'--b--\r\n').encode('utf-8')
+        message = ParsedMessage(raw)
+        self.assertEqual(message.get_header('subject'), u'création')
+        self.assertEqual(message.get_body(), u'Test de création')
+
+    def test_raw_8bit(self):
+        # not encoded, and no charset: UTF-8, or latin-1 if it's not UTF-8
+        for charset in ['utf-8', 'latin-1']:
+            raw = u'Subject: création\r\n\r\nTest de création\r\n'.encode(
+                charset)
+            for message in [ParsedMessage(raw),
+                            ParsedMessage(parse_mail(raw))]:
+                self.assertEqual(message.get_header('subject'), u'création')
+                self.assertEqual(message.get_body(), u'Test de création\r\n')
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import socket
+
+from mock import Mock
+
+from . import MailBotTestCase
+from ..metrics import (InstrumentedClient, Metrics, NullMetrics,
+                       StatsDMetrics)
+
+
+class NullMetricsTest(MailBotTestCase):
+
+    def test_discard(self):
+        metrics = NullMetrics()
+        self.assertFalse(metrics.enabled)
+        metrics.increment('messages_fetched', 3)
+        metrics.observe('stage_seconds', 0.1, stage='fetch')
+        with metrics.timer('stage_seconds', stage='fetch'):
+            pass
+
+
+class MetricsTest(MailBotTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.metrics = Metrics(buckets=[0.1, 1])
+
+    def test_counters(self):
+        self.metrics.increment('messages_fetched', 3)
+        self.metrics.increment('messages_fetched')
+        self.metrics.increment('messages_matched', callback='Foo')
+
+        self.assertEqual(self.metrics.get_counter('messages_fetched'), 4)
+        self.assertEqual(
+            self.metrics.get_counter('messages_matched', callback='Foo'), 1)
+        self.assertEqual(
+            self.metrics.get_counter('messages_matched', callback='Bar'), 0)
+
+    def test_histograms(self):
+        self.metrics.observe('stage_seconds', 0.05, stage='fetch')
+        self.metrics.observe('stage_seconds', 0.5, stage='fetch')
+        with self.metrics.timer('stage_seconds', stage='search'):
+            pass
+
+        self.assertEqual(
+            self.metrics.get_histogram('stage_seconds', stage='fetch'),
+            (2, 0.55))
+        self.assertEqual(
+            self.metrics.get_histogram('stage_seconds', stage='search')[0], 1)
+        self.assertEqual(
+            self.metrics.get_histogram('stage_seconds', stage='mark'), (0, 0))
+
+    def test_to_prometheus(self):
+        self.metrics.increment('messages_matched', callback='Say "hi"')
+        self.metrics.observe('stage_seconds', 0.05, stage='fetch')
+        self.metrics.observe('stage_seconds', 5, stage='fetch')
+
+        self.assertEqual(self.metrics.to_prometheus(), '\n'.join([
+            '# TYPE mailbot_messages_matched_total counter',
+            'mailbot_messages_matched_total{callback="Say \\"hi\\""} 1',
+            '# TYPE mailbot_stage_seconds histogram',
+            'mailbot_stage_seconds_bucket{stage="fetch",le="0.1"} 1',
+            'mailbot_stage_seconds_bucket{stage="fetch",le="1"} 1',
+            'mailbot_stage_seconds_bucket{stage="fetch",le="+Inf"} 2',
+            'mailbot_stage_seconds_sum{stage="fetch"} 5.05',
+            'mailbot_stage_seconds_count{stage="fetch"} 2',
+        ]) + '\n')
+
+
+class StatsDMetricsTest(MailBotTestCase):
+
+    def setUp(self):
+        super(StatsDMetricsTest, self).setUp()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.server.close)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.metrics = StatsDMetrics('127.0.0.1',
+                                     self.server.getsockname()[1])
+        self.addCleanup(self.metrics.socket.close)
+
+    def test_send(self):
+        self.metrics.increment('messages_matched', callback='My.Callback')
+        self.metrics.observe('stage_seconds', 0.25, stage='fetch')
+
+        self.assertEqual(self.server.recv(1024),
+                         b'mailbot.messages_matched.My_Callback:1|c')
+        self.assertEqual(self.server.recv(1024),
+                         b'mailbot.stage_seconds.fetch:250.000|ms')
+        # also collected
+        self.assertEqual(self.metrics.get_counter(
+            'messages_matched', callback='My.Callback'), 1)
+
+    def test_server_down(self):
+        self.metrics.socket = Mock()
+        self.metrics.socket.sendto.side_effect = socket.error
+        self.metrics.increment('messages_fetched')  # doesn't raise
+
+
+class InstrumentedClientTest(MailBotTestCase):
+
+    def test_count_commands(self):
+        metrics = Metrics()
+        client = InstrumentedClient(Mock(), metrics)
+
+        client.search(['UNSEEN'])
+        client.search(['SEEN'])
+        client.has_capability('IDLE')  # not an IMAP command
+        client.normalise_times = False
+
+        self.assertEqual(
+            metrics.get_counter('imap_commands', command='search'), 2)
+        client.client.search.assert_called_with(['SEEN'])
+        self.assertEqual(set(metrics.counters),
+                         set([('imap_commands', (('command', 'search'),))]))
+        self.assertEqual(client.client.normalise_times, False)
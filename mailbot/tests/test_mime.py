@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+from os.path import dirname, join
+
+from . import MailBotTestCase
+from ..message import get_text_body
+from ..mime import find_text_part, parse_mail, parse_mail_headers
+
+
+def read_mail(name):
+    with open(join(dirname(__file__), 'mails', name)) as mail_file:
+        return mail_file.read()
+
+
+def get_body(raw):
+    span = find_text_part(raw)
+    if span is None:
+        return ''
+    start, end = span
+    return get_text_body(parse_mail(raw[start:end]))
+
+
+ATTACHMENT_FIRST = (
+    'Subject: report\r\n'
+    'Content-Type: multipart/mixed; boundary="outer"\r\n'
+    '\r\n'
+    'preamble\r\n'
+    '--outer\r\n'
+    'Content-Type: text/plain; name="report.txt"\r\n'
+    'Content-Disposition: attachment; filename="report.txt"\r\n'
+    '\r\n'
+    'not the body\r\n'
+    '--outer\r\n'
+    'Content-Type: multipart/alternative; boundary="inner"\r\n'
+    '\r\n'
+    '--inner\r\n'
+    'Content-Type: text/plain; charset=utf-8\r\n'
+    '\r\n'
+    'the body\r\n'
+    '\r\n'
+    '--inner\r\n'
+    'Content-Type: text/html\r\n'
+    '\r\n'
+    '<p>the body</p>\r\n'
+    '--inner--\r\n'
+    '--outer--\r\n'
+    'epilogue\r\n')
+
+DIGEST = (
+    'Content-Type: multipart/digest; boundary=digest\n'
+    '\n'
+    '--digest\n'
+    '\n'
+    'Subject: first\n'
+    'Content-Type: image/png\n'
+    '\n'
+    'iVBORw0KGgo=\n'
+    '--digest\n'
+    '\n'
+    'Subject: second\n'
+    '\n'
+    'digested body\n'
+    '--digest--\n')
+
+
+class FindTextPartTest(MailBotTestCase):
+
+    def assertSameBody(self, raw):
+        self.assertEqual(get_body(raw), get_text_body(parse_mail(raw)))
+
+    def test_mails(self):
+        for name in ['mail_with_attachment.txt', 'mail_encoded_headers.txt']:
+            self.assertSameBody(read_mail(name))
+
+    def test_nested_parts(self):
+        self.assertEqual(get_body(ATTACHMENT_FIRST), 'the body\r\n')
+        self.assertSameBody(ATTACHMENT_FIRST)
+        start, end = find_text_part(ATTACHMENT_FIRST)
+        # the attachment and the html alternative are never parsed
+        self.assertTrue(ATTACHMENT_FIRST.index('not the body') < start)
+        self.assertTrue(end < ATTACHMENT_FIRST.index('<p>'))
+
+    def test_digest(self):
+        self.assertEqual(get_body(DIGEST), 'digested body')
+        self.assertSameBody(DIGEST)
+
+    def test_no_text_part(self):
+        raw = ('Content-Type: multipart/mixed; boundary=b\n\n'
+               '--b\nContent-Type: image/png\n\niVBORw0KGgo=\n--b--\n')
+        self.assertIsNone(find_text_part(raw))
+        self.assertSameBody(raw)
+        # no boundary: parsed as a single (non text) part
+        raw = 'Content-Type: multipart/mixed\n\n--b\n\nbody\n--b--\n'
+        self.assertIsNone(find_text_part(raw))
+        self.assertSameBody(raw)
+
+    def test_missing_close_delimiter(self):
+        raw = ('Content-Type: multipart/mixed; boundary=b\n\n'
+               '--b\nContent-Type: image/png\n\niVBORw0KGgo=\n'
+               '--b\n\ntruncated body\n')
+        self.assertSameBody(raw)
+
+    def test_whole_mail(self):
+        for raw in ['', 'Subject: plain\r\n\r\nbody\r\n', 'no headers\n']:
+            self.assertEqual(find_text_part(raw), (0, len(raw)))
+            self.assertSameBody(raw)
+        # malformed mails are left to the email package
+        raw = 'Content-Type: multipart/mixed; boundary=b\rno header\r\r--b\r'
+        self.assertEqual(find_text_part(raw), (0, len(raw)))
+
+    def test_bytes(self):
+        for raw in [ATTACHMENT_FIRST, DIGEST, 'Subject: plain\r\n\r\nbody']:
+            self.assertEqual(find_text_part(raw.encode('ascii')),
+                             find_text_part(raw))
+            self.assertSameBody(raw.encode('ascii'))
+        raw = ATTACHMENT_FIRST.replace('the body', u'le côté').encode('utf-8')
+        self.assertEqual(get_body(raw), u'le côté\r\n')
+        self.assertSameBody(raw)
+
+    def test_parse_mail_headers(self):
+        headers = parse_mail_headers(ATTACHMENT_FIRST)
+        self.assertEqual(headers['subject'], 'report')
+        self.assertEqual(headers.get_payload(), '')
+        headers = parse_mail_headers('Subject: foo\r\nnot a header\r\n')
+        self.assertEqual(headers['subject'], 'foo')
+        headers = parse_mail_headers(b'Subject: foo\r\n\r\nbody')
+        self.assertEqual(headers['subject'], 'foo')
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+import socket
+from threading import Thread
+
+from mock import Mock
+
+from . import FakeServerTestCase, MailBotTestCase
+from .. import register
+from ..fakeimap import FakeIMAPServer
+from ..pool import ConnectionPool
+from ..state import MemoryStateStore
+
+
+class ConnectionPoolTest(MailBotTestCase):
+
+    def setUp(self):
+        super(ConnectionPoolTest, self).setUp()
+        self.server = FakeIMAPServer()
+        self.pool = ConnectionPool(imapclient=self.server.client)
+        self.addCleanup(self.pool.close)
+
+    def acquire(self, username='john'):
+        return self.pool.acquire('somehost', username, 'doe')
+
+    def test_enable(self):
+        client = self.acquire()
+        self.pool.enable(client, 'CONDSTORE')
+        self.pool.release(client)
+
+        client = self.acquire()
+        self.pool.enable(client, 'CONDSTORE')
+
+        self.assertEqual(self.server.commands.count('ENABLE'), 1)
+        self.pool.release(client, discard=True)
+        self.assertEqual(self.pool.enabled, {})
+
+    def test_reuse(self):
+        client = self.acquire()
+        self.pool.release(client)
+
+        self.assertIs(self.acquire(), client)
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.commands, ['LOGIN', 'NOOP'])
+
+    def test_borrowed_connections(self):
+        first = self.acquire()
+        second = self.acquire()
+
+        self.assertIsNot(first, second)  # first is borrowed
+        self.assertIsNot(self.acquire('jane'), first)  # other account
+        self.assertEqual(self.server.logins, 3)
+
+    def test_dead_connection(self):
+        client = self.acquire()
+        self.pool.release(client)
+        self.server.disconnect()  # drop all the connections
+
+        new_client = self.acquire()
+
+        self.assertIsNot(new_client, client)
+        self.assertEqual(self.server.logins, 2)
+        new_client.noop()  # alive
+
+    def test_discard(self):
+        client = self.acquire()
+        self.pool.release(client, discard=True)
+
+        self.assertIsNot(self.acquire(), client)
+        self.assertEqual(self.server.commands.count('LOGOUT'), 1)
+
+    def test_max_idle(self):
+        self.pool.max_idle = 1
+        clients = [self.acquire(), self.acquire()]
+        for client in clients:
+            self.pool.release(client)
+
+        self.assertEqual(self.server.commands.count('LOGOUT'), 1)
+
+    def test_max_connections(self):
+        self.pool.max_connections = 1
+        client = self.acquire()
+        acquired = []
+        thread = Thread(target=lambda: acquired.append(self.acquire()))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.05)
+        self.assertEqual(acquired, [])  # waiting for a connection
+
+        self.pool.release(client)
+        thread.join(5)
+
+        self.assertEqual(acquired, [client])
+
+    def test_login_failure(self):
+        self.pool.max_connections = 1
+        self.server.failures = 1
+
+        self.assertRaises(socket.error, self.acquire)
+        self.acquire()  # the failed connection doesn't count
+
+    def test_connection(self):
+        with self.pool.connection('somehost', 'john', 'doe') as client:
+            pass
+        self.assertIs(self.acquire(), client)
+
+        try:
+            with self.pool.connection('somehost', 'jane', 'doe') as client:
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertIsNot(self.acquire('jane'), client)
+
+    def test_close(self):
+        self.pool.release(self.acquire())
+
+        self.pool.close()
+
+        self.assertEqual(self.server.commands.count('LOGOUT'), 1)
+        self.acquire()
+        self.assertEqual(self.server.logins, 2)
+
+
+class MailBotPoolTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(MailBotPoolTest, self).setUp()
+        self.pool = ConnectionPool()
+        self.addCleanup(self.pool.close)
+
+    def test_reuse(self):
+        for i in range(3):
+            bot = self.make_bot(pool=self.pool)
+            bot.process_messages()
+            bot.disconnect()
+
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.commands.count('SELECT'), 3)
+        self.assertNotIn('LOGOUT', self.server.commands)
+
+    def test_reconnect(self):
+        bot = self.make_bot(pool=self.pool)
+        self.server.disconnect()
+
+        bot.reconnect()
+
+        bot.process_messages()
+        self.assertEqual(self.server.logins, 2)
+
+    def test_condstore(self):
+        self.server.capabilities = ('IMAP4REV1', 'ENABLE', 'CONDSTORE')
+        store = MemoryStateStore()
+        register(self.RecordingCallback)
+        self.server.deliver('Subject: foo\r\n\r\n')
+
+        for i in range(2):  # ENABLE is refused once the folder is selected
+            bot = self.make_bot(pool=self.pool, state_store=store)
+            bot.process_messages()
+            bot.disconnect()
+
+        self.assertEqual(self.server.logins, 1)
+        self.assertEqual(self.server.commands.count('ENABLE'), 1)
+        self.assertEqual(self.triggered, ['foo'])
+
+    def test_run_forever_releases(self):
+        bot = self.make_bot(pool=self.pool)
+        bot.process_messages = Mock(side_effect=bot.stop)
+
+        bot.run_forever()
+
+        self.assertIsNone(bot.client)
+        self.assertNotIn('LOGOUT', self.server.commands)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from unittest2 import skipIf
+
+from . import MailBotTestCase
+from ..regexps import findall, get_engine, lint_regexp, TimeoutError
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+
+class RegexpsTest(MailBotTestCase):
+
+    def test_lint_regexp(self):
+        for pattern in [r'(a+)+', r'(\w+\s?)+$', r'(.*)*', r'(?:x+x+)+y',
+                        r'(?=(a+)+)', r'(a)?(?(1)(b+)*|c)']:
+            self.assertEqual(len(lint_regexp(pattern)), 1, pattern)
+
+        for pattern in [r'a+b+', r'(ab{2})+', r'(?:a|b)+', r'\d{3}-\d{4}',
+                        r'(a{2}){3}']:
+            self.assertEqual(lint_regexp(pattern), [], pattern)
+
+        self.assertEqual(lint_regexp(None), [])
+        self.assertEqual(lint_regexp(b'(a+)+'), [])
+
+    def test_get_engine(self):
+        self.assertTrue(get_engine(None) is re)
+        self.assertRaises(ValueError, get_engine, 'pcre')
+
+    @skipIf(regex is not None, 'the regex package is installed')
+    def test_get_engine_missing(self):
+        self.assertRaises(ImportError, get_engine, 'regex')
+
+    def test_findall(self):
+        self.assertEqual(findall(r'a(\d)', 'a1 a2'), ['1', '2'])
+        self.assertEqual(findall(re.compile(r'a\d'), 'a1 a2', 1), ['a1', 'a2'])
+
+    @skipIf(regex is None, 'the regex package is needed')
+    def test_findall_timeout(self):
+        regexp = get_engine('regex').compile(r'(\w+\s?)+$')
+
+        self.assertRaises(TimeoutError, findall, regexp, 'a' * 50 + '!',
+                          0.01)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from . import MailBotTestCase
+from ..retry import MESSAGE, RetryQueue
+
+
+class RetryQueueTest(MailBotTestCase):
+
+    def setUp(self):
+        super(RetryQueueTest, self).setUp()
+        self.queue = RetryQueue(max_attempts=3, backoff=10, max_backoff=15)
+        self.addCleanup(self.queue.close)
+
+    def test_backoff(self):
+        self.queue.add('box', 'mod.Callback', b'raw', '<id@host>',
+                       'ValueError: boom', now=100)
+
+        self.assertEqual(self.queue.get_due('box', now=109), [])
+        self.assertEqual(self.queue.get_due('other box', now=110), [])
+        entry, = self.queue.get_due('box', now=110)
+        self.assertEqual(entry.callback, 'mod.Callback')
+        self.assertEqual(entry.raw, b'raw')
+        self.assertEqual(entry.message_id, '<id@host>')
+        self.assertEqual(entry.attempts, 1)
+
+        # twice the backoff after the second failure, at most max_backoff
+        self.assertFalse(self.queue.failed(entry.id, 'again', now=110))
+        self.assertEqual(self.queue.get_due('box', now=124), [])
+        entry, = self.queue.get_due('box', now=125)
+        self.assertEqual((entry.attempts, entry.error), (2, 'again'))
+
+        self.queue.done(entry.id)
+        self.assertEqual(len(self.queue), 0)
+
+    def test_dead_letters(self):
+        self.queue.add('box', 'mod.Callback', u'raw', uid=42, uidvalidity=7,
+                       now=0)
+        entry, = self.queue.get_due('box', now=10)
+        self.assertEqual((entry.uid, entry.uidvalidity), (42, 7))
+
+        self.assertFalse(self.queue.failed(entry.id, now=10))
+        self.assertTrue(self.queue.failed(entry.id, 'last', now=100))
+
+        self.assertEqual(len(self.queue), 0)
+        dead, = self.queue.get_dead_letters()
+        self.assertEqual((dead.callback, dead.raw, dead.attempts, dead.error),
+                         ('mod.Callback', u'raw', 3, 'last'))
+        self.assertEqual((dead.uid, dead.uidvalidity), (42, 7))
+        self.assertEqual(self.queue.get_dead_letters('other box'), [])
+
+        self.queue.discard_dead_letter(dead.id)
+        self.assertEqual(self.queue.get_dead_letters(), [])
+
+    def test_give_up(self):
+        self.queue.add('box', 'mod.Callback', b'raw', now=0)
+        entry, = self.queue.get_due('box', now=10)
+
+        self.queue.give_up(entry.id, 'Unknown callback')
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.get_dead_letters('box')[0].error,
+                         'Unknown callback')
+
+    def test_add_dead_letter(self):
+        self.queue.add_dead_letter('box', MESSAGE, b'raw',
+                                   error='ValueError: unparsable')
+
+        self.assertEqual(len(self.queue), 0)
+        dead, = self.queue.get_dead_letters('box')
+        self.assertEqual((dead.callback, dead.raw, dead.attempts, dead.error),
+                         (MESSAGE, b'raw', 1, 'ValueError: unparsable'))
+
+    def test_persistence(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'retries.db')
+        queue = RetryQueue(path)
+        queue.add('box', 'mod.Callback', b'raw', now=0)
+        queue.close()
+
+        queue = RetryQueue(path)
+        self.addCleanup(queue.close)
+        self.assertEqual(len(queue.get_due('box', now=60)), 1)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import re
+import warnings
+from email import message_from_file, message_from_string
+from os.path import dirname, join
+
+from mock import sentinel
+
+from . import MailBotTestCase
+from .. import Callback, Keywords, RegisterException
+from ..exceptions import RegexpWarning
+from ..rules import (compile_regexps, compile_rules, combine_regexps,
+                     get_literal, get_search_key, has_default_checks,
+                     RulesIndex)
+
+
+class CustomCheckCallback(Callback):
+
+    def check_item(self, item, regexps, message=None):
+        return True
+
+
+class CustomBodyCallback(Callback):
+
+    def get_email_body(self, message=None):
+        return 'custom body'
+
+
+class RulesTest(MailBotTestCase):
+
+    def test_compile_regexps(self):
+        compiled = compile_regexps([r'foo (\w+)', re.compile('bar')])
+        self.assertEqual([regexp.pattern for regexp in compiled],
+                         [r'foo (\w+)', 'bar'])
+        self.assertEqual(compiled[0].findall('foo baz'), ['baz'])
+
+        # single regexp
+        self.assertEqual([regexp.pattern for regexp in compile_regexps('f')],
+                         ['f'])
+
+        # not regexps, left as is
+        self.assertEqual(compile_regexps(sentinel.rule), sentinel.rule)
+        self.assertEqual(compile_regexps(None), None)
+
+        self.assertRaises(RegisterException, compile_regexps, ['(foo'])
+        self.assertRaises(ValueError, compile_regexps, ['foo'], 'pcre')
+
+        # the regexps which may backtrack for too long are reported
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            compile_regexps([r'(\w+\s?)+$', r'\w+'])
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(issubclass(caught[0].category, RegexpWarning))
+        self.assertTrue(repr(r'(\w+\s?)+$') in str(caught[0].message))
+
+        # the automaton of the keywords is built
+        keywords = Keywords(['foo', 'bar'])
+        compiled = compile_regexps([keywords, 'baz'])
+        self.assertTrue(compiled[0] is keywords)
+        self.assertNotEqual(keywords.automaton, None)
+        self.assertEqual(compiled[1].pattern, 'baz')
+
+    def test_compile_rules(self):
+        rules = {'subject': ['foo'], 'body': []}
+        compiled = compile_rules(rules)
+        self.assertEqual(compiled['subject'][0].pattern, 'foo')
+        self.assertEqual(compiled['body'], [])
+        self.assertEqual(rules, {'subject': ['foo'], 'body': []})
+
+        # the cheapest items first
+        compiled = compile_rules({'body': ['foo'], 'subject': [r'\d+'],
+                                  'from': ['bar']})
+        self.assertEqual(list(compiled), ['from', 'subject', 'body'])
+
+    def test_combine_regexps(self):
+        combined = combine_regexps(compile_regexps(['foo', r'ba(r|z)']))
+        self.assertTrue(combined.search('a foo'))
+        self.assertTrue(combined.search('a baz'))
+        self.assertFalse(combined.search('a bat'))
+
+        # can't be combined safely
+        self.assertEqual(combine_regexps(compile_regexps([r'(a)\1'])), None)
+        self.assertEqual(combine_regexps(compile_regexps(['(?P<a>b)(?P=a)'])),
+                         None)
+        self.assertEqual(combine_regexps([re.compile('foo', re.I)]), None)
+        self.assertEqual(combine_regexps([sentinel.rule]), None)
+
+    def test_get_literal(self):
+        self.assertEqual(get_literal(re.compile('foo bar')), 'foo bar')
+        self.assertEqual(get_literal(re.compile(r'^Re: a\.b\$$')),
+                         'Re: a.b$')
+        self.assertEqual(get_literal(re.compile(r'foo (\w+)')), None)
+        self.assertEqual(get_literal(re.compile(r'\d')), None)
+        self.assertEqual(get_literal(re.compile('a|b')), None)
+        self.assertEqual(get_literal(re.compile('foo', re.I)), None)
+        self.assertEqual(get_literal(re.compile(r'\(foo\)')), None)
+        self.assertEqual(get_literal(re.compile(u'caf\xe9')), None)
+        self.assertEqual(get_literal(re.compile('^$')), None)
+        self.assertEqual(get_literal(sentinel.rule), None)
+
+    def test_get_search_key(self):
+        self.assertEqual(get_search_key(compile_rules({'from': ['foo']})),
+                         ['FROM', 'foo'])
+        self.assertEqual(
+            get_search_key(compile_rules({'subject': ['foo', 'bar'],
+                                          'X-Spam': ['yes']})),
+            [['OR', 'SUBJECT', 'foo', 'SUBJECT', 'bar',
+              'HEADER', 'X-Spam', 'yes']])
+        # items which can't be searched by the server are left out
+        self.assertEqual(
+            get_search_key(compile_rules({'body': ['foo'],
+                                          'subject': [r'\d+']})),
+            ['BODY', 'foo'])
+        self.assertEqual(get_search_key(compile_rules({'to': [r'\d+']})),
+                         None)
+        self.assertEqual(get_search_key({'to': sentinel.rules}), None)
+        self.assertEqual(get_search_key({}), None)
+
+    def test_has_default_checks(self):
+        self.assertTrue(has_default_checks(Callback))
+        self.assertFalse(has_default_checks(CustomCheckCallback))
+        self.assertFalse(has_default_checks(CustomBodyCallback))
+        self.assertFalse(has_default_checks(lambda message, rules: None))
+        self.assertFalse(has_default_checks(object))
+
+
+class RulesIndexTest(MailBotTestCase):
+
+    def setUp(self):
+        super(RulesIndexTest, self).setUp()
+        email_file = join(dirname(__file__), 'mails/mail_with_attachment.txt')
+        self.message = message_from_file(open(email_file, 'r'))
+
+        class FooCallback(Callback):
+            pass
+
+        class BarCallback(Callback):
+            pass
+
+        self.foo_callback = FooCallback
+        self.bar_callback = BarCallback
+        self.index = RulesIndex()
+
+    def test_add(self):
+        compiled = self.index.add(self.foo_callback, {'subject': ['foo']})
+        self.assertEqual(self.index.get(self.foo_callback), compiled)
+        self.assertEqual(compiled['subject'][0].pattern, 'foo')
+
+        self.index.discard(self.foo_callback)
+        self.assertEqual(self.index.get(self.foo_callback), None)
+        self.assertEqual(self.index.get(self.foo_callback, sentinel.rules),
+                         sentinel.rules)
+
+    def test_add_regexp_timeout(self):
+        class TimeoutCallback(Callback):
+            regexp_timeout = 0.5
+
+        # the default engine can't interrupt the matching
+        self.assertRaises(RegisterException, self.index.add, TimeoutCallback,
+                          {'subject': ['foo']})
+        self.assertEqual(self.index.get(TimeoutCallback), None)
+
+    def test_prefilters(self):
+        self.index.add(self.foo_callback, {'subject': ['foo'], 'to': ['to']})
+        self.index.add(self.bar_callback, {'subject': ['bar'],
+                                           'to': sentinel.rules})
+        self.index.add(CustomCheckCallback, {'from': ['baz']})
+
+        prefilters = self.index.prefilters
+        self.assertEqual(sorted(prefilters), ['subject', 'to'])
+        self.assertEqual(prefilters['subject'].pattern, '(?:foo)|(?:bar)')
+        self.assertEqual(prefilters['to'], None)  # unknown rule
+
+        # updated when registering a new callback
+        self.index.discard(self.bar_callback)
+        self.assertEqual(self.index.prefilters['subject'].pattern, '(?:foo)')
+
+        # the guarded callbacks are always checked
+        class GuardedCallback(Callback):
+            max_item_length = 1000
+
+        self.index.add(GuardedCallback, {'subject': ['baz']})
+        self.assertEqual(self.index.prefilters['subject'].pattern, '(?:foo)')
+        self.assertFalse(self.index.is_filterable(GuardedCallback))
+
+    def test_search_key(self):
+        self.index.add(self.foo_callback, {'subject': ['foo']})
+        self.index.add(self.bar_callback, {'from': ['bar']})
+        self.assertEqual(self.index.search_key({self.foo_callback: {}}),
+                         ['SUBJECT', 'foo'])
+
+        key = self.index.search_key({self.foo_callback: {},
+                                     self.bar_callback: {}})
+        self.assertIn(key, [['OR', 'SUBJECT', 'foo', 'FROM', 'bar'],
+                            ['OR', 'FROM', 'bar', 'SUBJECT', 'foo']])
+
+        # the rules of an unknown callback are used as is
+        self.assertEqual(self.index.search_key({Callback: {'to': ['baz']}}),
+                         None)
+        self.assertEqual(
+            self.index.search_key({Callback: compile_rules({'to': ['baz']})}),
+            ['TO', 'baz'])
+
+        # the server can't tell
+        self.assertEqual(self.index.search_key({}), None)
+        self.assertEqual(self.index.search_key({self.foo_callback: {},
+                                                Callback: {}}), None)
+        self.assertEqual(
+            self.index.search_key({CustomCheckCallback: {'to': ['baz']}}),
+            None)
+
+    def test_may_match(self):
+        self.index.add(self.foo_callback, {'subject': ['Task name'],
+                                           'body': ['content']})
+        self.index.add(self.bar_callback, {'subject': ['Task'],
+                                           'cc': ['NOMATCH']})
+        self.index.add(CustomCheckCallback, {'subject': ['NOMATCH']})
+
+        matcher = self.index.matcher(self.message)
+        self.assertTrue(matcher.may_match(self.foo_callback))
+        self.assertFalse(matcher.may_match(self.bar_callback))
+        # always checked, as they can't be prefiltered
+        self.assertTrue(matcher.may_match(CustomCheckCallback))
+        self.assertTrue(matcher.may_match(sentinel.callback))
+
+    def test_may_match_headers_only(self):
+        self.index.add(self.foo_callback, {'subject': ['foo'],
+                                           'body': ['content']})
+        headers = message_from_string('Subject: foo\r\n\r\n')
+
+        matcher = self.index.matcher(headers)
+        self.assertFalse(matcher.may_match(self.foo_callback))
+        self.assertTrue(matcher.may_match(self.foo_callback,
+                                          headers_only=True))
+
+    def test_hit_decodes_once(self):
+        self.index.add(self.foo_callback, {'subject': ['Task']})
+        self.index.add(self.bar_callback, {'subject': ['name']})
+        matcher = self.index.matcher(self.message)
+        values = []
+        get_value = matcher.callback.get_value
+        matcher.callback.get_value = lambda item: values.append(item) or \
+            get_value(item)
+
+        self.assertTrue(matcher.may_match(self.foo_callback))
+        self.assertTrue(matcher.may_match(self.bar_callback))
+        self.assertEqual(values, ['subject'])
+
+    def test_hit_missing_item(self):
+        self.index.add(self.foo_callback, {'cc': ['.*']})
+        matcher = self.index.matcher(message_from_string(''))
+        self.assertFalse(matcher.hit('cc'))
+        self.assertTrue(matcher.hit('unknown'))  # no prefilter
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+from time import sleep
+
+from . import FakeServerTestCase
+from ..fakeimap import FakeIMAPServer
+from .. import Callback, register
+from ..mailbot import get_executor
+from ..scheduler import Scheduler
+
+
+class SchedulerTest(FakeServerTestCase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp()
+        self.servers = {'host1': self.server, 'host2': FakeIMAPServer()}
+        register(self.RecordingCallback)
+        self.scheduler = Scheduler(workers=4, max_connections=1,
+                                   max_messages=2)
+        self.scheduler.mailbot_class = self.get_mailbot_class()
+        self.addCleanup(self.scheduler.shutdown)
+
+    def imapclient(self, host, **kwargs):
+        return self.servers[host].client(host, **kwargs)
+
+    def deliver(self, host, subject):
+        return self.servers[host].deliver('Subject: %s\r\n\r\n' % subject)
+
+    def test_add_mailbox(self):
+        bot = self.scheduler.add_mailbox('host1', 'john', 'doe',
+                                         folder='Other', batch_size=10)
+
+        self.assertIsNone(bot.client)  # not connected yet
+        self.assertEqual(bot.home_folder, 'Other')
+        self.assertEqual(bot.max_messages, 2)
+        self.assertEqual(bot.batch_size, 10)
+        self.assertEqual(self.scheduler.mailboxes, [bot])
+
+    def test_run_once(self):
+        self.scheduler.add_mailbox('host1', 'john', 'doe')
+        self.scheduler.add_mailbox('host2', 'jane', 'doe')
+        self.deliver('host1', 'foo')
+        self.deliver('host2', 'bar')
+
+        self.assertEqual(self.scheduler.run_once(), 2)
+
+        self.assertEqual(sorted(self.triggered), ['bar', 'foo'])
+        self.assertEqual(self.scheduler.run_once(), 0)
+        for server in self.servers.values():  # logged out after each turn
+            self.assertEqual(server.commands.count('LOGIN'), 2)
+            self.assertEqual(server.commands.count('LOGOUT'), 2)
+
+    def test_keep_connections(self):
+        self.scheduler.keep_connections = True
+        bot = self.scheduler.add_mailbox('host1', 'john', 'doe')
+
+        self.scheduler.run_once()
+        self.scheduler.run_once()
+
+        self.assertIsNotNone(bot.client)
+        self.assertEqual(self.servers['host1'].logins, 1)
+
+    def test_keep_connections_limit(self):
+        self.scheduler.keep_connections = True
+        bots = [self.scheduler.add_mailbox('host1', username, 'doe')
+                for username in ('john', 'jane')]
+        self.deliver('host1', 'foo')
+
+        self.assertEqual(self.scheduler.run_once(), 1)
+
+        # the second mailbox took over the connection of the first one
+        self.assertEqual(self.servers['host1'].logins, 2)
+        self.assertEqual([bot.client is not None for bot in bots],
+                         [False, True])
+        self.assertEqual(self.scheduler.host_connections['host1'],
+                         set([bots[1]]))
+
+    def test_max_messages(self):
+        self.scheduler.add_mailbox('host1', 'john', 'doe')
+        self.scheduler.add_mailbox('host2', 'jane', 'doe')
+        for i in range(5):
+            self.deliver('host1', 'busy %s' % i)
+        self.deliver('host2', 'quiet')
+
+        self.assertEqual(self.scheduler.run_once(), 3)
+
+        # the quiet mailbox doesn't wait for the busy one to be emptied
+        self.assertEqual(sorted(self.triggered),
+                         ['busy 0', 'busy 1', 'quiet'])
+        self.assertEqual(self.scheduler.run_once(), 2)
+        self.assertEqual(self.scheduler.run_once(), 1)
+
+    def test_rotation(self):
+        first = self.scheduler.add_mailbox('host1', 'john', 'doe')
+        second = self.scheduler.add_mailbox('host1', 'jane', 'doe')
+        turns = []
+        self.scheduler.run_turn = lambda mailbot: turns.append(mailbot) or 0
+
+        self.scheduler.run_once()
+        self.scheduler.run_once()
+
+        self.assertEqual(turns, [first, second, second, first])
+
+    def test_mailbox_callbacks(self):
+        other = []
+
+        class OtherCallback(Callback):
+
+            def trigger(self):
+                other.append(self.message['subject'])
+
+        self.scheduler.add_mailbox(
+            'host1', 'john', 'doe',
+            callbacks={OtherCallback: {'subject': ['foo']}})
+        self.scheduler.add_mailbox('host2', 'jane', 'doe')
+        self.deliver('host1', 'foo')
+        self.deliver('host1', 'bar')
+        self.deliver('host2', 'foo')
+
+        self.scheduler.run_once()
+
+        self.assertEqual(other, ['foo'])
+        self.assertEqual(self.triggered, ['foo'])  # only from host2
+
+    def test_max_connections(self):
+        lock = Lock()
+        connected = []
+        max_connected = []
+
+        class SlowCallback(Callback):
+
+            def trigger(self):
+                with lock:
+                    connected.append(self)
+                    max_connected.append(len(connected))
+                sleep(0.05)
+                with lock:
+                    connected.remove(self)
+
+        for username in ('john', 'jane', 'jim'):
+            self.scheduler.add_mailbox('host1', username, 'doe',
+                                       callbacks={SlowCallback: {}})
+            self.deliver('host1', username)
+
+        self.assertEqual(self.scheduler.run_once(), 3)
+
+        self.assertEqual(max(max_connected), 1)
+
+    def test_blocked_host(self):
+        self.scheduler.pool.shutdown()
+        self.scheduler.pool = get_executor('thread', 2)
+        triggered = self.triggered
+
+        class SlowCallback(Callback):
+
+            def trigger(self):
+                triggered.append(self.message['subject'])
+                sleep(0.05)
+
+        for username in ('john', 'jane', 'jim'):
+            self.scheduler.add_mailbox('host1', username, 'doe',
+                                       callbacks={SlowCallback: {}})
+            self.deliver('host1', username)
+        self.scheduler.add_mailbox('host2', 'joe', 'doe')
+        self.deliver('host2', 'quiet')
+
+        self.assertEqual(self.scheduler.run_once(), 4)
+
+        # the workers don't wait for host1 while host2 can be processed
+        self.assertEqual(sorted(self.triggered[:2]), ['john', 'quiet'])
+
+    def test_error_isolation(self):
+        self.scheduler.add_mailbox('host1', 'john', 'doe')
+        self.scheduler.add_mailbox('host2', 'jane', 'doe')
+        self.servers['host1'].failures = 1  # refuse the next connection
+        self.deliver('host1', 'foo')
+        self.deliver('host2', 'bar')
+
+        self.assertEqual(self.scheduler.run_once(), 1)
+        self.assertEqual(self.triggered, ['bar'])
+
+        self.assertEqual(self.scheduler.run_once(), 1)  # back to normal
+        self.assertEqual(self.triggered, ['bar', 'foo'])
+
+    def test_run_forever(self):
+        self.scheduler.add_mailbox('host1', 'john', 'doe')
+        self.deliver('host1', 'foo')
+        self.scheduler.interval = 0.01
+        rounds = []
+        run_once = self.scheduler.run_once
+
+        def counting_run_once():
+            rounds.append(None)
+            if len(rounds) == 3:
+                self.scheduler.stop()
+            return run_once()
+
+        self.scheduler.run_once = counting_run_once
+
+        self.scheduler.run_forever()
+
+        self.assertEqual(len(rounds), 3)
+        self.assertEqual(self.triggered, ['foo'])
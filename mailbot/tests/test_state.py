@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+
+from . import MailBotTestCase
+from ..state import JSONStateStore, MemoryStateStore
+
+
+class MemoryStateStoreTest(MailBotTestCase):
+
+    def test_get_set(self):
+        store = MemoryStateStore()
+        self.assertIsNone(store.get('key'))
+
+        state = {'uid': 3}
+        store.set('key', state)
+        state['uid'] = 4  # the store has its own copy
+
+        self.assertEqual(store.get('key'), {'uid': 3})
+        self.assertIsNone(store.get('other key'))
+
+
+class JSONStateStoreTest(MailBotTestCase):
+
+    def setUp(self):
+        super(JSONStateStoreTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'state.json')
+
+    def test_persistence(self):
+        store = JSONStateStore(self.path)
+        self.assertIsNone(store.get('key'))
+
+        store.set('key', {'uidvalidity': 1, 'uid': 3, 'modseq': None})
+
+        with open(self.path) as state_file:
+            self.assertEqual(json.load(state_file), {
+                'key': {'uidvalidity': 1, 'uid': 3, 'modseq': None}})
+        self.assertEqual(JSONStateStore(self.path).get('key'),
+                         {'uidvalidity': 1, 'uid': 3, 'modseq': None})
+        self.assertFalse(os.path.exists(self.path + '.tmp'))